@@ -13,10 +13,7 @@ import tensorflow as tf
 
 import flags
 
-from langmodel.lm import LstmLmInstance
-# from qa.mpcm import MpcmQaInstance
-from qa.qanet.instance import QANetInstance
-from discriminator.instance import DiscriminatorInstance
+from model_host import create_model_host
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -46,15 +43,8 @@ def main(_):
 
 
     if FLAGS.eval_metrics:
-        lm = LstmLmInstance()
-        # qa = MpcmQaInstance()
-        qa = QANetInstance()
-
-        lm.load_from_chkpt(FLAGS.model_dir+'saved/lmtest')
-        # qa.load_from_chkpt(FLAGS.model_dir+'saved/qatest')
-        qa.load_from_chkpt(FLAGS.model_dir+'saved/qanet')
-
-        discriminator = DiscriminatorInstance(trainable=False, path=disc_path)
+        scoring_host = create_model_host(lm_path=FLAGS.model_dir+'saved/lmtest', qa_path=FLAGS.model_dir+'saved/qanet', disc_path=disc_path)
+        lm, qa, discriminator = scoring_host.lm, scoring_host.qa, scoring_host.discriminator
 
     f1s=[]
     bleus=[]
@@ -0,0 +1,94 @@
+import os,time, json
+
+# Compare the latency, throughput and quality (BLEU) of each decoder built into the inference graph.
+# Build extra beam widths in with eg --decode_beam_widths=1,4,8
+
+mem_limit=0.5
+
+import tensorflow as tf
+import numpy as np
+import helpers.loader as loader
+import helpers.metrics as metrics
+import helpers.preprocessing as preprocessing
+import helpers.ops as ops
+from helpers.output import tokens_to_string
+from tqdm import tqdm
+
+from seq2seq_model import Seq2SeqModel
+from maluuba_model import MaluubaModel
+from datasources.squad_streamer import SquadStreamer
+
+import flags
+
+FLAGS = tf.app.flags.FLAGS
+
+def main(_):
+    model_type=FLAGS.model_type
+    chkpt_path = FLAGS.model_dir+'qgen/'+ model_type+'/'+FLAGS.eval_model_id
+
+    dev_data = loader.load_squad_triples(FLAGS.data_path, dev=FLAGS.eval_on_dev, test=FLAGS.eval_on_test)
+    if FLAGS.filter_window_size_before >-1:
+        dev_data = preprocessing.filter_squad(dev_data, window_size_before=FLAGS.filter_window_size_before, window_size_after=FLAGS.filter_window_size_after, max_tokens=FLAGS.filter_max_tokens)
+    print('Loaded SQuAD dev set with ',len(dev_data),' triples')
+
+    vocab = loader.load_vocab(chkpt_path)
+
+    with SquadStreamer(vocab, FLAGS.eval_batch_size, 1, shuffle=False) as dev_data_source:
+        if model_type[:7] == "SEQ2SEQ":
+            model = Seq2SeqModel(vocab, training_mode=False)
+        elif model_type[:7] == "MALUUBA":
+            FLAGS.qa_weight = 0
+            FLAGS.lm_weight = 0
+            model = MaluubaModel(vocab, training_mode=False)
+        else:
+            exit("Unrecognised model type: "+model_type)
+
+        with model.graph.as_default():
+            saver = tf.train.Saver()
+
+        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit)
+        with tf.Session(graph=model.graph, config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
+            if not os.path.exists(chkpt_path):
+                exit('Checkpoint path doesnt exist! '+chkpt_path)
+            saver.restore(sess, tf.train.latest_checkpoint(chkpt_path))
+
+            # Pull all the batches in up front, so only the decoding gets timed
+            dev_data_source.initialise(dev_data)
+            batches = [dev_data_source.get_batch()[0] for i in range(FLAGS.num_eval_samples//FLAGS.eval_batch_size)]
+
+            # 'beam' is just an alias for the default width
+            decoder_names = [name for name in sorted(model.decoders.keys()) if name != 'beam']
+
+            # Run each once first so graph setup doesn't count against the first decoder
+            for name in decoder_names:
+                sess.run(model.decoders[name]['ids'], feed_dict={model.input_batch: batches[0]})
+
+            results = {}
+            for name in decoder_names:
+                outputs = model.decoders[name]
+                qgolds, qpreds, latencies = [], [], []
+                for dev_batch in tqdm(batches, desc=name):
+                    start_time = time.time()
+                    pred_batch, pred_lens = sess.run([outputs['string'], outputs['lens']], feed_dict={model.input_batch: dev_batch})
+                    latencies.append(time.time()-start_time)
+
+                    gold_batch, gold_lens = dev_batch[1][0], dev_batch[1][3]
+                    qpreds.extend([q.replace(' </Sent>',"").replace(" <PAD>","") for q in ops.byte_token_array_to_str(pred_batch, pred_lens-1)])
+                    qgolds.extend([tokens_to_string(gold_batch[b][:gold_lens[b]-1]) for b in range(len(gold_lens))])
+
+                results[name] = {
+                    'bleu': metrics.bleu_corpus(qgolds, qpreds),
+                    'latency_mean': float(np.mean(latencies)),
+                    'latency_p95': float(np.percentile(latencies, 95)),
+                    'throughput': len(qpreds)/float(np.sum(latencies)),
+                    }
+
+    print('{:<10} {:>8} {:>12} {:>12} {:>12}'.format('decoder', 'bleu', 'latency (s)', 'p95 (s)', 'q/s'))
+    for name, res in sorted(results.items(), key=lambda x: x[1]['latency_mean']):
+        print('{:<10} {:>8.2f} {:>12.4f} {:>12.4f} {:>12.1f}'.format(name, res['bleu']*100, res['latency_mean'], res['latency_p95'], res['throughput']))
+
+    with open(FLAGS.log_dir+'decoding_benchmark_'+model_type+'.json', 'w') as fp:
+        json.dump(results, fp)
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,93 @@
+import time, argparse
+
+# Time building the PG batch (preprocessing.duplicate_batch_and_inject) for a synthetic batch of a realistic size,
+# against the old list based version it replaced - and check they give the same output. Only needs numpy, eg:
+# python benchmark_pg_batch.py --batch_size 64
+
+import numpy as np
+
+import helpers.preprocessing as preprocessing
+from helpers.loader import PAD
+
+# The previous implementation, kept here as a reference
+def duplicate_batch_and_inject_lists(batch, pred_q_ids, pred_q_str, pred_q_lens):
+    new_batch=[]
+    for i,x in enumerate(batch):
+        new_subbatch=[]
+        if i == 3: # ix is not nested
+            new_batch.append(np.asarray(x.tolist()+x.tolist()))
+        else:
+            for j,y in enumerate(x):
+                if i==1 and j==0:
+                    new_str_batch=pred_q_str.tolist()+y.tolist()
+                    max_len = max([len(q) for q in new_str_batch])
+                    new_str_batch = [q+[PAD.encode() for k in range(max_len-len(q))] for q in new_str_batch]
+                    new_subbatch.append(np.asarray(new_str_batch))
+                elif i==1 and j==1:
+                    new_id_batch=pred_q_ids.tolist()+y.tolist()
+                    max_len = max([len(q) for q in new_id_batch])
+                    new_id_batch = [q+[0 for k in range(max_len-len(q))] for q in new_id_batch]
+                    new_subbatch.append(np.asarray(new_id_batch))
+                elif i==1 and j==2:
+                    new_tgt_batch=[[[q_id] for q_id in q_ids] for q_ids in pred_q_ids.tolist()]+y.tolist()
+                    max_len = max([len(q) for q in new_tgt_batch])
+                    max_alts = max(np.shape(y)[2], 1)
+                    new_tgt_batch = [[ids+[-1 for k in range(max_alts-len(ids))] for ids in q]+[[-1 for k in range(max_alts)] for k in range(max_len-len(q))] for q in new_tgt_batch]
+                    new_subbatch.append(np.asarray(new_tgt_batch))
+                elif i==1 and j==3:
+                    new_subbatch.append(np.asarray(pred_q_lens.tolist()+y.tolist()))
+                else:
+                    new_subbatch.append(np.asarray(y.tolist()+y.tolist()))
+            new_batch.append(tuple(new_subbatch))
+    return tuple(new_batch)
+
+def get_synthetic_batch(batch_size, context_len, question_len, pred_len, max_alts, vocab_size, seed=0):
+    rng = np.random.RandomState(seed)
+    words = np.asarray([('w'+str(i)).encode() for i in range(vocab_size)], dtype=object)
+    raw = lambda *shape: words[rng.randint(vocab_size, size=shape)]
+    ids = lambda *shape: rng.randint(vocab_size, size=shape).astype(np.int32)
+
+    context = (raw(batch_size, context_len), ids(batch_size, context_len), ids(batch_size, context_len), np.full([batch_size], context_len, dtype=np.int32), np.full([batch_size], context_len, dtype=np.int32))
+    target_ids = ids(batch_size, question_len, max_alts)
+    target_ids[:, :, 1:] = -1
+    question = (raw(batch_size, question_len), ids(batch_size, question_len), target_ids, rng.randint(1, question_len+1, size=batch_size).astype(np.int32))
+    answer = (raw(batch_size, 5), ids(batch_size, 5), np.full([batch_size], 5, dtype=np.int32), ids(batch_size, 5))
+    batch = (context, question, answer, np.arange(batch_size, dtype=np.int32))
+    return batch, ids(batch_size, pred_len), raw(batch_size, pred_len), rng.randint(1, pred_len+1, size=batch_size).astype(np.int32)
+
+def batches_equal(x, y):
+    if isinstance(x, tuple):
+        return isinstance(y, tuple) and len(x) == len(y) and all([batches_equal(a, b) for a,b in zip(x, y)])
+    return np.array_equal(np.asarray(x, dtype=object), np.asarray(y, dtype=object))
+
+def time_fn(fn, args, reps):
+    fn(*args)
+    start_time = time.time()
+    for _ in range(reps):
+        fn(*args)
+    return (time.time()-start_time)/reps
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--context_len', type=int, default=120)
+    parser.add_argument('--question_len', type=int, default=25)
+    parser.add_argument('--pred_len', type=int, default=32)
+    parser.add_argument('--max_alts', type=int, default=2)
+    parser.add_argument('--vocab_size', type=int, default=2000)
+    parser.add_argument('--reps', type=int, default=50)
+    args = parser.parse_args()
+
+    inputs = get_synthetic_batch(args.batch_size, args.context_len, args.question_len, args.pred_len, args.max_alts, args.vocab_size)
+
+    assert batches_equal(preprocessing.duplicate_batch_and_inject(*inputs), duplicate_batch_and_inject_lists(*inputs)), "Outputs don't match!"
+
+    list_time = time_fn(duplicate_batch_and_inject_lists, inputs, args.reps)
+    numpy_time = time_fn(preprocessing.duplicate_batch_and_inject, inputs, args.reps)
+    print('{:<8} {:>10}'.format('impl', 'ms/batch'))
+    print('{:<8} {:>10.3f}'.format('lists', list_time*1000))
+    print('{:<8} {:>10.3f}'.format('numpy', numpy_time*1000))
+    print('Speedup: {:.1f}x'.format(list_time/numpy_time))
+
+if __name__ == '__main__':
+    main()
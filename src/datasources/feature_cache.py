@@ -0,0 +1,147 @@
+# An on-disk cache of preprocessed SQuAD features, so that tokenisation and vocab lookup only happen once per dataset
+# rather than once per example per epoch. Each field is stored as a flat .npy array plus an offsets array, and
+# memory-mapped back in when loading.
+import os, json, hashlib, shutil
+
+import numpy as np
+
+import helpers.preprocessing as preprocessing
+
+
+# (name, dtype) for each output of the process_squad_* fns, in the order the streamer expects them
+CONTEXT_FIELDS = [('context_raw', 'S'), ('context_ids', np.int32), ('context_copy_ids', np.int32), ('context_length', np.int32), ('context_vocab_size', np.int32)]
+QUESTION_FIELDS = [('question_raw', 'S'), ('question_ids', np.int32), ('question_target_ids', np.int32), ('question_length', np.int32)]
+ANSWER_FIELDS = [('answer_raw', 'S'), ('answer_ids', np.int32), ('answer_length', np.int32), ('answer_locs', np.int32)]
+
+# The question targets are a ragged [len x k] matrix - store the valid (position, id) pairs and rebuild them on read
+LATENT_FIELDS = [('question_latent_ids', np.int32), ('question_latent_pos', np.int32)]
+
+CACHE_VERSION = 2
+
+
+# Build a key that changes whenever anything that affects the cached features changes
+def get_cache_key(vocab, data, max_copy_size, context_as_set=False, copy_priority=False, smart_copy=True, latent_switch=False):
+    h = hashlib.sha1()
+    h.update(json.dumps(vocab, sort_keys=True).encode())
+    h.update(json.dumps({'version': CACHE_VERSION,
+                         'max_copy_size': max_copy_size,
+                         'context_as_set': context_as_set,
+                         'copy_priority': copy_priority,
+                         'smart_copy': smart_copy,
+                         'latent_switch': latent_switch}, sort_keys=True).encode())
+    for context, q, a, a_pos in data:
+        h.update(context.encode())
+        h.update(q.encode())
+        h.update(a.encode())
+        h.update(str(a_pos).encode())
+    return h.hexdigest()
+
+
+class SquadFeatureCache():
+    def __init__(self, vocab, path, max_copy_size, context_as_set=False, copy_priority=False, smart_copy=True, latent_switch=False):
+        self.vocab = vocab
+        self.path = path
+        self.max_copy_size = max_copy_size
+        self.context_as_set = context_as_set
+        self.copy_priority = copy_priority
+        self.smart_copy = smart_copy
+        self.latent_switch = latent_switch
+
+        self.arrays = {}
+        self.offsets = {}
+
+    def get_dir(self, data):
+        key = get_cache_key(self.vocab, data, self.max_copy_size, self.context_as_set, self.copy_priority, self.smart_copy, self.latent_switch)
+        return os.path.join(self.path, key)
+
+    # Load the cache for this dataset, building it first if it doesn't exist yet
+    def load_or_build(self, data):
+        cache_dir = self.get_dir(data)
+        if not os.path.exists(os.path.join(cache_dir, 'meta.json')):
+            print('Building feature cache at ', cache_dir)
+            self.build(data, cache_dir)
+        self.load(cache_dir)
+        return self
+
+    def build(self, data, cache_dir):
+        process_context = preprocessing.process_squad_context(self.vocab, context_as_set=self.context_as_set)
+        process_question = preprocessing.process_squad_question(self.vocab, max_copy_size=self.max_copy_size, context_as_set=self.context_as_set, copy_priority=self.copy_priority, smart_copy=self.smart_copy, latent_switch=self.latent_switch)
+        process_answer = preprocessing.process_squad_answer(self.vocab, context_as_set=self.context_as_set)
+
+        fields = {name: [] for name, _ in CONTEXT_FIELDS+QUESTION_FIELDS+ANSWER_FIELDS+LATENT_FIELDS if name != 'question_target_ids'}
+        lengths = {name: [] for name in fields.keys()}
+
+        def _append(name, value):
+            value = np.atleast_1d(value)
+            fields[name].append(value)
+            lengths[name].append(len(value))
+
+        for context, q, a, a_pos in data:
+            context, q, a = context.encode(), q.encode(), a.encode()
+            ctxt_feats = process_context(context)
+            q_feats = process_question(q, context, a_pos)
+            a_feats = process_answer(a, a_pos, context)
+
+            for (name, _), value in zip(CONTEXT_FIELDS, ctxt_feats):
+                _append(name, value)
+            for (name, _), value in zip(ANSWER_FIELDS, a_feats):
+                _append(name, value)
+            for (name, _), value in zip(QUESTION_FIELDS, q_feats):
+                if name == 'question_target_ids':
+                    pos, alt = np.nonzero(value >= 0)
+                    _append('question_latent_pos', pos.astype(np.int32))
+                    _append('question_latent_ids', value[pos, alt].astype(np.int32))
+                else:
+                    _append(name, value)
+
+        # write to a temp dir then move into place, so an interrupted build never leaves a half written cache
+        tmp_dir = cache_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        dtypes = dict(CONTEXT_FIELDS+QUESTION_FIELDS+ANSWER_FIELDS+LATENT_FIELDS)
+        for name, values in fields.items():
+            flat = np.concatenate(values) if dtypes[name] != 'S' else np.asarray([w for v in values for w in v], dtype=np.bytes_)
+            if len(flat) == 0:
+                flat = np.zeros([0], dtype=dtypes[name] if dtypes[name] != 'S' else np.bytes_)
+            elif dtypes[name] != 'S':
+                flat = flat.astype(dtypes[name])
+            np.save(os.path.join(tmp_dir, name+'.npy'), flat)
+            np.save(os.path.join(tmp_dir, name+'_offsets.npy'), np.concatenate([[0], np.cumsum(lengths[name])]).astype(np.int64))
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fp:
+            json.dump({'num_examples': len(data), 'vocab_size': len(self.vocab), 'max_copy_size': self.max_copy_size, 'version': CACHE_VERSION}, fp)
+
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.rename(tmp_dir, cache_dir)
+
+    def load(self, cache_dir):
+        with open(os.path.join(cache_dir, 'meta.json')) as fp:
+            self.meta = json.load(fp)
+        for name, _ in CONTEXT_FIELDS+QUESTION_FIELDS+ANSWER_FIELDS+LATENT_FIELDS:
+            if name == 'question_target_ids':
+                continue
+            self.arrays[name] = np.load(os.path.join(cache_dir, name+'.npy'), mmap_mode='r')
+            self.offsets[name] = np.load(os.path.join(cache_dir, name+'_offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.meta['num_examples']
+
+    def _get(self, name, ix):
+        return np.asarray(self.arrays[name][self.offsets[name][ix]:self.offsets[name][ix+1]])
+
+    # Returns the features for one example, in the same (flattened) form as the py_func pipeline produces
+    def get_example(self, ix):
+        res = []
+        for name, dtype in CONTEXT_FIELDS+QUESTION_FIELDS+ANSWER_FIELDS:
+            if name == 'question_target_ids':
+                q_len = self._get('question_ids', ix).shape[0]
+                pos = self._get('question_latent_pos', ix)
+                res.append(preprocessing.get_target_ids(np.split(self._get('question_latent_ids', ix), np.searchsorted(pos, np.arange(1, q_len)))))
+            elif name in ['context_length', 'context_vocab_size', 'question_length', 'answer_length']:
+                res.append(self._get(name, ix)[0])
+            else:
+                res.append(self._get(name, ix))
+        return res
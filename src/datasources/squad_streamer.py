@@ -1,22 +1,32 @@
 # An abstract class that provides a loader and preprocessor for the SQuAD dataset (or other context/q/a triples)
+import multiprocessing, queue, threading
+
 import numpy as np
 import tensorflow as tf
 
 from base_model import TFModel
 from helpers.loader import OOV, PAD, EOS, SOS
+import helpers.loader as loader
 import helpers.preprocessing as preprocessing
+from datasources.feature_cache import SquadFeatureCache
 
 import flags
 
 FLAGS = tf.app.flags.FLAGS
 
 class SquadStreamer():
-    def __init__(self, vocab, batch_size, num_epochs=1, shuffle=True):
-        self.vocab=vocab
-        self.rev_vocab = {v:k for k,v in self.vocab.items()}
+    def __init__(self, vocab, batch_size, num_epochs=1, shuffle=True, feature_cache=False, bucket_batching=False):
+        self.vocab=loader.as_vocab(vocab)
+        self.rev_vocab = self.vocab.rev
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.num_epochs=num_epochs
+        self.feature_cache = feature_cache
+        self.bucket_batching = bucket_batching
+        self.cache = None
+        self.cache_data = None
+        self.ixs = None
+        self.reset_padding_stats()
 
     def __enter__(self):
         self.graph = tf.Graph()
@@ -31,17 +41,58 @@ class SquadStreamer():
     def __exit__(self, exc_type, exc_value, traceback):
         self.sess.close()
 
-    # expects to receive a 4D tuple of squad data as generated by the loader
-    def initialise(self, data):
-        contexts, qs, answers,a_pos = zip(*data)
+    # expects to receive a 4D tuple of squad data as generated by the loader. If num_samples is set, only a random
+    # subset of that many examples is streamed - the cache still covers the whole of data, so it can be reused
+    def initialise(self, data, num_samples=None):
         # build ix here - it then refers to the index in the original (unshuffled) dataset
-        self.sess.run(self.iterator.initializer, feed_dict={self.context_ph: contexts,
-                                          self.qs_ph: qs, self.as_ph: answers, self.a_pos_ph: a_pos,
-                                          self.ix: np.arange(len(contexts))})
+        self.ixs = np.arange(len(data)) if num_samples is None else np.random.permutation(len(data))[:num_samples]
+        if self.feature_cache:
+            if self.cache_data is not data:
+                self.cache = SquadFeatureCache(self.vocab, FLAGS.feature_cache_dir, max_copy_size=FLAGS.max_copy_size, context_as_set=FLAGS.context_as_set, copy_priority=FLAGS.copy_priority, smart_copy=FLAGS.smart_copy, latent_switch=FLAGS.latent_switch).load_or_build(data)
+                self.cache_data = data
+            self.sess.run(self.iterator.initializer)
+        else:
+            contexts, qs, answers,a_pos = zip(*[data[ix] for ix in self.ixs])
+            self.sess.run(self.iterator.initializer, feed_dict={self.context_ph: contexts,
+                                              self.qs_ph: qs, self.as_ph: answers, self.a_pos_ph: a_pos,
+                                              self.ix: self.ixs})
 
     def get_batch(self):
-        return self.sess.run([self.batch_as_nested_tuple, self.batch_len])
+        batch, batch_len = self.sess.run([self.batch_as_nested_tuple, self.batch_len])
+        self.update_padding_stats(batch)
+        return batch, batch_len
+
+    # Keep track of what fraction of each batch is real tokens rather than padding
+    def reset_padding_stats(self):
+        self.padding_stats = {'context_tokens': 0, 'context_padded': 0, 'question_tokens': 0, 'question_padded': 0}
+
+    def update_padding_stats(self, batch):
+        self.padding_stats['context_tokens'] += int(np.sum(batch[0][3]))
+        self.padding_stats['context_padded'] += int(np.prod(np.shape(batch[0][1])))
+        self.padding_stats['question_tokens'] += int(np.sum(batch[1][3]))
+        self.padding_stats['question_padded'] += int(np.prod(np.shape(batch[1][1])))
+
+    def get_padding_efficiency(self):
+        ctxt_eff = self.padding_stats['context_tokens']/max(self.padding_stats['context_padded'], 1)
+        q_eff = self.padding_stats['question_tokens']/max(self.padding_stats['question_padded'], 1)
+        return ctxt_eff, q_eff
+
+
+    # Read the preprocessed examples straight out of the memory mapped cache, in a new order each epoch (the generator
+    # is restarted on each repeat). Only the examples currently being batched are ever read into memory
+    def _iter_cached(self):
+        order = np.random.permutation(self.ixs) if self.shuffle else self.ixs
+        for ix in order:
+            yield self._cached_to_nested(self.cache.get_example(ix), np.int32(ix))
+
+    def _cached_to_nested(self, feats, ix):
+        return (tuple(feats[0:5]), tuple(feats[5:9]), tuple(feats[9:13]), ix)
 
+    def _process(self, context,q,a,a_pos,ix):
+        return (tuple(tf.py_func(preprocessing.process_squad_context(self.vocab, context_as_set=FLAGS.context_as_set), [context], [tf.string, tf.int32, tf.int32, tf.int32, tf.int32])),
+                tuple(tf.py_func(preprocessing.process_squad_question(self.vocab, max_copy_size=FLAGS.max_copy_size, context_as_set=FLAGS.context_as_set, copy_priority=FLAGS.copy_priority, smart_copy=FLAGS.smart_copy, latent_switch=FLAGS.latent_switch), [q,context,a_pos], [tf.string, tf.int32, tf.int32, tf.int32])),
+                tuple(tf.py_func(preprocessing.process_squad_answer(self.vocab, context_as_set=FLAGS.context_as_set), [a,a_pos,context], [tf.string, tf.int32, tf.int32, tf.int32])),
+                ix)
 
     def build_data_pipeline(self, batch_size):
         with tf.device('/cpu:*'):
@@ -51,24 +102,27 @@ class SquadStreamer():
             self.a_pos_ph = tf.placeholder(tf.int32, [None])
             self.ix = tf.placeholder(tf.int32, [None])
 
-            dataset = tf.data.Dataset.from_tensor_slices( (self.context_ph, self.qs_ph, self.as_ph, self.a_pos_ph, self.ix) )
+            if self.feature_cache:
+                # the preprocessed examples are just read back off disk
+                dataset = tf.data.Dataset.from_generator(self._iter_cached,
+                    output_types=((tf.string, tf.int32, tf.int32, tf.int32, tf.int32), (tf.string, tf.int32, tf.int32, tf.int32), (tf.string, tf.int32, tf.int32, tf.int32), tf.int32),
+                    output_shapes=((tf.TensorShape([None]), tf.TensorShape([None]), tf.TensorShape([None]), tf.TensorShape([]), tf.TensorShape([])),
+                                   (tf.TensorShape([None]), tf.TensorShape([None]), tf.TensorShape([None, None]), tf.TensorShape([])),
+                                   (tf.TensorShape([None]), tf.TensorShape([None]), tf.TensorShape([]), tf.TensorShape([None])),
+                                   tf.TensorShape([])))
+            else:
+                dataset = tf.data.Dataset.from_tensor_slices( (self.context_ph, self.qs_ph, self.as_ph, self.a_pos_ph, self.ix) )
 
-            if self.shuffle:
-                dataset = dataset.shuffle(buffer_size=100000)
+                if self.shuffle:
+                    dataset = dataset.shuffle(buffer_size=100000)
 
-            # processing pipeline
-            dataset = dataset.map(lambda context,q,a,a_pos,ix:
-                        (tuple(tf.py_func(preprocessing.process_squad_context(self.vocab, context_as_set=FLAGS.context_as_set), [context], [tf.string, tf.int32, tf.int32, tf.int32, tf.int32])),
-                        tuple(tf.py_func(preprocessing.process_squad_question(self.vocab, max_copy_size=FLAGS.max_copy_size, context_as_set=FLAGS.context_as_set, copy_priority=FLAGS.copy_priority, smart_copy=FLAGS.smart_copy, latent_switch=FLAGS.latent_switch), [q,context,a_pos], [tf.string, tf.int32, tf.float32, tf.int32])),
-                        tuple(tf.py_func(preprocessing.process_squad_answer(self.vocab, context_as_set=FLAGS.context_as_set), [a,a_pos,context], [tf.string, tf.int32, tf.int32, tf.int32])),
-                        ix
-                        # q,a
-                        ))
+                # processing pipeline
+                dataset = dataset.map(self._process)
 
 
 
             # pad out to batches
-            dataset = dataset.padded_batch(
+            padded_batch = lambda ds: ds.padded_batch(
                 batch_size,
                 padded_shapes=((tf.TensorShape([None]),  # source vectors of unknown size
                                 tf.TensorShape([None]),  # source vectors of unknown size
@@ -91,7 +145,7 @@ class SquadStreamer():
                                  0),          # size(source) -- unused
                                 (PAD,
                                 self.vocab[PAD],  # target vectors padded on the right with tgt_eos_id
-                                 0.0,
+                                 -1,          # target ids are padded with -1, which one_hot maps to all zeros
                                  0),          # size(source) -- unused
                                 (PAD,
                                 self.vocab[PAD],  # target vectors padded on the right with tgt_eos_id
@@ -99,6 +153,16 @@ class SquadStreamer():
                                  0),# answer locs
                                  0)) # ix
 
+            if self.bucket_batching:
+                # group examples of a similar length together, so less of each batch is padding. Examples are
+                # shuffled before being bucketed, so the batches are still random
+                dataset = dataset.apply(tf.contrib.data.group_by_window(
+                    key_func=lambda context,question,answer,ix: tf.cast(bucket_key(context[3], question[3]), tf.int64),
+                    reduce_func=lambda key, ds: padded_batch(ds),
+                    window_size=batch_size))
+            else:
+                dataset = padded_batch(dataset)
+
             dataset = dataset.repeat(self.num_epochs)
 
             dataset = dataset.prefetch(buffer_size=batch_size*4)
@@ -107,7 +171,155 @@ class SquadStreamer():
             self.batch_as_nested_tuple = self.iterator.get_next()
             self.this_context, self.this_question, self.this_answer, self.this_ix = self.batch_as_nested_tuple
             (self.context_raw, self.context_ids, self.context_copy_ids, self.context_length, self.context_vocab_size) = self.this_context
-            (self.question_raw, self.question_ids, self.question_oh, self.question_length) = self.this_question
+            (self.question_raw, self.question_ids, self.question_target_ids, self.question_length) = self.this_question
             (self.answer_raw, self.answer_ids, self.answer_length, self.answer_locs) = self.this_answer
 
             self.batch_len = tf.shape(self.context_raw)[0]
+
+
+# Bucket id for length-bucketed batching - primarily by context length, then by question length.
+# Works on both python ints and tensors
+def bucket_key(context_len, question_len):
+    num_ctxt_buckets = FLAGS.max_context_len//FLAGS.bucket_ctxt_width+1
+    num_q_buckets = FLAGS.bucket_max_q_len//FLAGS.bucket_q_width+1
+    ctxt_bucket = context_len//FLAGS.bucket_ctxt_width
+    q_bucket = question_len//FLAGS.bucket_q_width
+    if isinstance(context_len, tf.Tensor):
+        ctxt_bucket = tf.minimum(ctxt_bucket, num_ctxt_buckets-1)
+        q_bucket = tf.minimum(q_bucket, num_q_buckets-1)
+    else:
+        ctxt_bucket = min(int(ctxt_bucket), num_ctxt_buckets-1)
+        q_bucket = min(int(q_bucket), num_q_buckets-1)
+    return ctxt_bucket*num_q_buckets + q_bucket
+
+
+# Preprocessing fns for the worker processes - these are built once per worker by the pool initialiser,
+# since the closures returned by the process_squad_* fns can't be pickled
+_worker_fns = None
+
+def _init_worker(vocab, max_copy_size, context_as_set, copy_priority, smart_copy, latent_switch):
+    global _worker_fns
+    _worker_fns = (preprocessing.process_squad_context(vocab, context_as_set=context_as_set),
+                    preprocessing.process_squad_question(vocab, max_copy_size=max_copy_size, context_as_set=context_as_set, copy_priority=copy_priority, smart_copy=smart_copy, latent_switch=latent_switch),
+                    preprocessing.process_squad_answer(vocab, context_as_set=context_as_set))
+
+def _process_example(example):
+    context,q,a,a_pos,ix = example
+    context,q,a = context.encode(), q.encode(), a.encode()
+    process_context, process_question, process_answer = _worker_fns
+    return (tuple(process_context(context)), tuple(process_question(q,context,a_pos)), tuple(process_answer(a,a_pos,context)), ix)
+
+# Pad a list of processed examples into a batch with the same structure (and padding values) as the tf.data pipeline
+def collate_batch(examples, vocab):
+    contexts, questions, answers, ixs = zip(*examples)
+    c_raw, c_ids, c_copy_ids, c_len, c_vocab_size = zip(*contexts)
+    q_raw, q_ids, q_target_ids, q_len = zip(*questions)
+    a_raw, a_ids, a_len, a_locs = zip(*answers)
+    pad = PAD.encode()
+    return ((preprocessing.pad_sequences(c_raw, pad, dtype=object),
+                preprocessing.pad_sequences(c_ids, vocab[PAD]),
+                preprocessing.pad_sequences(c_copy_ids, 0),
+                np.asarray(c_len, dtype=np.int32),
+                np.asarray(c_vocab_size, dtype=np.int32)),
+            (preprocessing.pad_sequences(q_raw, pad, dtype=object),
+                preprocessing.pad_sequences(q_ids, vocab[PAD]),
+                preprocessing.pad_sequences(q_target_ids, -1),
+                np.asarray(q_len, dtype=np.int32)),
+            (preprocessing.pad_sequences(a_raw, pad, dtype=object),
+                preprocessing.pad_sequences(a_ids, vocab[PAD]),
+                np.asarray(a_len, dtype=np.int32),
+                preprocessing.pad_sequences(a_locs, 0)),
+            np.asarray(ixs, dtype=np.int32))
+
+
+# Alternative streamer that does the preprocessing in a pool of worker processes instead of a single py_func thread.
+# Batches are built in a background thread and handed over via a bounded queue, and have the same structure as the
+# ones produced by SquadStreamer, so the two can be used interchangeably.
+class SquadPoolStreamer(SquadStreamer):
+    def __init__(self, vocab, batch_size, num_epochs=1, shuffle=True, feature_cache=False, bucket_batching=False, num_workers=4, ordered=True, queue_size=16):
+        super().__init__(vocab, batch_size, num_epochs, shuffle, feature_cache, bucket_batching)
+        self.num_workers = num_workers
+        self.ordered = ordered
+        self.queue_size = queue_size
+        self.producer = None
+
+    def __enter__(self):
+        self.pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                        initargs=(self.vocab, FLAGS.max_copy_size, FLAGS.context_as_set, FLAGS.copy_priority, FLAGS.smart_copy, FLAGS.latent_switch))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop_producer()
+        self.pool.terminate()
+        self.pool.join()
+
+    def initialise(self, data):
+        self._stop_producer()
+        if self.feature_cache:
+            self.cache = SquadFeatureCache(self.vocab, FLAGS.feature_cache_dir, max_copy_size=FLAGS.max_copy_size, context_as_set=FLAGS.context_as_set, copy_priority=FLAGS.copy_priority, smart_copy=FLAGS.smart_copy, latent_switch=FLAGS.latent_switch).load_or_build(data)
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.stop_event = threading.Event()
+        self.producer = threading.Thread(target=self._produce, args=(data, self.queue, self.stop_event), daemon=True)
+        self.producer.start()
+
+    def get_batch(self):
+        batch = self.queue.get()
+        if batch is None:
+            raise tf.errors.OutOfRangeError(None, None, 'End of sequence')
+        if isinstance(batch, Exception):
+            raise batch
+        self.update_padding_stats(batch)
+        return [batch, len(batch[3])]
+
+    def _stop_producer(self):
+        if self.producer is not None:
+            self.stop_event.set()
+            # unblock the producer if it's waiting on a full queue
+            while self.producer.is_alive():
+                try:
+                    self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.producer = None
+
+    def _put(self, q, item, stop_event):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _process_examples(self, data, ixs):
+        if self.cache is not None:
+            return (self._cached_to_nested(self.cache.get_example(ix), ix) for ix in ixs)
+        examples = [(data[ix][0], data[ix][1], data[ix][2], data[ix][3], ix) for ix in ixs]
+        chunksize = max(1, len(examples)//(self.num_workers*4))
+        if self.ordered:
+            return self.pool.imap(_process_example, examples, chunksize)
+        else:
+            return self.pool.imap_unordered(_process_example, examples, chunksize)
+
+    def _produce(self, data, q, stop_event):
+        try:
+            # Only send a window of examples to the pool at a time, so that a slow consumer can't cause an unbounded
+            # number of processed examples to pile up in memory
+            window = self.batch_size*self.queue_size
+            for e in range(self.num_epochs):
+                order = np.random.permutation(len(data)) if self.shuffle else np.arange(len(data))
+                buckets = {}
+                for start in range(0, len(order), window):
+                    for example in self._process_examples(data, order[start:start+window]):
+                        key = bucket_key(example[0][3], example[1][3]) if self.bucket_batching else 0
+                        buckets.setdefault(key, []).append(example)
+                        if len(buckets[key]) == self.batch_size:
+                            if not self._put(q, collate_batch(buckets.pop(key), self.vocab), stop_event):
+                                return
+                # the tf pipeline batches before repeating, so each epoch ends with partial batches
+                for batch in buckets.values():
+                    if not self._put(q, collate_batch(batch, self.vocab), stop_event):
+                        return
+            self._put(q, None, stop_event)
+        except Exception as err:
+            self._put(q, err, stop_event)
@@ -0,0 +1,59 @@
+import sys,os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+
+from helpers import loader, preprocessing
+from datasources.feature_cache import SquadFeatureCache
+
+data = [("the cat sat on the mat .", "where did the cat sit ?", "on the mat", 12),
+        ("a dog barked at the cat . it ran away .", "what did the dog bark at ?", "the cat", 17)]
+
+# tokenising needs the nltk sentence splitter data
+try:
+    preprocessing.tokenise(b"a sentence .")
+except LookupError:
+    pytest.skip("nltk punkt data not installed", allow_module_level=True)
+
+def get_vocab():
+    words = ['the', 'cat', 'sat', 'on', 'where', 'did', '?', '.', 'what']
+    return loader.Vocab({w: i for i,w in enumerate([loader.PAD, loader.OOV, loader.SOS, loader.EOS]+words)})
+
+def get_cache(vocab, path, latent_switch=False):
+    return SquadFeatureCache(vocab, path, max_copy_size=20, latent_switch=latent_switch)
+
+def check_matches_preprocessing(cache, vocab, latent_switch=False):
+    assert len(cache) == len(data)
+    process_context = preprocessing.process_squad_context(vocab)
+    process_question = preprocessing.process_squad_question(vocab, max_copy_size=20, latent_switch=latent_switch)
+    process_answer = preprocessing.process_squad_answer(vocab)
+    for ix, (context, q, a, a_pos) in enumerate(data):
+        context, q, a = context.encode(), q.encode(), a.encode()
+        expected = process_context(context) + process_question(q, context, a_pos) + process_answer(a, a_pos, context)
+        feats = cache.get_example(ix)
+        assert len(feats) == len(expected)
+        for feat, exp in zip(feats, expected):
+            np.testing.assert_array_equal(feat, exp)
+
+def test_build_and_load(tmpdir):
+    vocab = get_vocab()
+    cache = get_cache(vocab, str(tmpdir)).load_or_build(data)
+    check_matches_preprocessing(cache, vocab)
+
+    # a second cache for the same data loads the existing files rather than rebuilding
+    cache_dir = cache.get_dir(data)
+    mtime = os.path.getmtime(os.path.join(cache_dir, 'meta.json'))
+    reloaded = get_cache(vocab, str(tmpdir)).load_or_build(data)
+    assert os.path.getmtime(os.path.join(cache_dir, 'meta.json')) == mtime
+    assert isinstance(reloaded.arrays['context_ids'], np.memmap)
+    check_matches_preprocessing(reloaded, vocab)
+
+def test_latent_targets(tmpdir):
+    vocab = get_vocab()
+    check_matches_preprocessing(get_cache(vocab, str(tmpdir), latent_switch=True).load_or_build(data), vocab, latent_switch=True)
+
+def test_key_changes_with_settings(tmpdir):
+    vocab = get_vocab()
+    assert get_cache(vocab, str(tmpdir)).get_dir(data) != get_cache(vocab, str(tmpdir), latent_switch=True).get_dir(data)
+    assert get_cache(vocab, str(tmpdir)).get_dir(data) != get_cache(vocab, str(tmpdir)).get_dir(data[:1])
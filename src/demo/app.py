@@ -6,11 +6,14 @@ sys.path.insert(0, "/home/tomhosking/webapps/qgen/qgen/src/")
 import tensorflow as tf
 import numpy as np
 
-from instance import AQInstance
+from instance import AQInstance, FrozenAQInstance
+from batcher import MicroBatcher
+from cache import ResponseCache, get_cache_key
 
-from helpers import preprocessing
+from helpers import preprocessing, loader
 
 import json
+from collections import OrderedDict
 
 import flags
 FLAGS = tf.app.flags.FLAGS
@@ -36,10 +39,21 @@ def get_q():
     ans = request.args['answer']
     ans_pos = ctxt.find(ans)
 
-    if FLAGS.filter_window_size >-1:
-        ctxt,ans_pos = preprocessing.filter_context(ctxt, ans_pos, FLAGS.filter_window_size, FLAGS.filter_max_tokens)
+    window_size_before, window_size_after, max_tokens = current_app.generator.get_filter_settings()
+    if ans_pos > -1 and window_size_before >-1:
+        ctxt,ans_pos = preprocessing.filter_context(ctxt, ans_pos, window_size_before, window_size_after, max_tokens)
     if ans_pos > -1:
-        q =current_app.generator.get_q(ctxt.encode(), ans.encode(), ans_pos)
+        if current_app.cache is not None:
+            cache_key = get_cache_key(ctxt, ans, ans_pos, current_app.generator.chkpt_id, current_app.generator.get_decode_params())
+            q = current_app.cache.get(cache_key)
+            if q is not None:
+                return q
+        if current_app.batcher is not None:
+            q = current_app.batcher(ctxt.encode(), ans.encode(), ans_pos)
+        else:
+            q =current_app.generator.get_q(ctxt.encode(), ans.encode(), ans_pos)
+        if current_app.cache is not None:
+            current_app.cache.put(cache_key, q)
         return q
     else:
         print(request.args)
@@ -47,10 +61,42 @@ def get_q():
         print(ans)
         return "Couldnt find ans in context!"
 
+# Takes one context and any number of answer args, returns a json list of questions in the same order
+@app.route("/api/generate_multi")
+def get_qs():
+    ctxt = request.args['context']
+    answers = request.args.getlist('answer')
+
+    # Filtering depends on where the answer is, so group the answers by the context they end up with
+    results = ["Couldnt find ans in context!" for ans in answers]
+    window_size_before, window_size_after, max_tokens = current_app.generator.get_filter_settings()
+    groups = OrderedDict()
+    for i,ans in enumerate(answers):
+        this_ctxt = ctxt
+        ans_pos = ctxt.find(ans)
+        if ans_pos > -1 and window_size_before >-1:
+            this_ctxt,ans_pos = preprocessing.filter_context(ctxt, ans_pos, window_size_before, window_size_after, max_tokens)
+        if ans_pos > -1:
+            groups.setdefault(this_ctxt, []).append((i, ans, ans_pos))
+
+    for this_ctxt, group in groups.items():
+        ixs, group_ans, group_pos = zip(*group)
+        qs = current_app.generator.get_qs_for_context(this_ctxt.encode(), [ans.encode() for ans in group_ans], group_pos)
+        for i,q in zip(ixs, qs):
+            results[i] = q
+    return json.dumps(results)
+
 @app.route("/api/ping")
 def ping():
     return app.generator.ping()
 
+@app.route("/api/stats")
+def stats():
+    res = app.batcher.get_stats() if app.batcher is not None else {}
+    if app.cache is not None:
+        res['cache'] = app.cache.get_stats()
+    return json.dumps(res)
+
 @app.route("/api/model_list")
 def model_slug():
     return json.dumps(model_list)
@@ -70,12 +116,16 @@ def init():
         chkpt_path = '/home/tomhosking/webapps/qgen/qgen/models/saved/' + model_slug_curr
     else:
         chkpt_path = FLAGS.model_dir+'qgen-saved/' + model_slug_curr
-    with open(chkpt_path+'/vocab.json') as f:
-        vocab = json.load(f)
-    app.generator = AQInstance(vocab=vocab)
-    app.generator.load_from_chkpt(chkpt_path)
+    if FLAGS.demo_frozen_model != "":
+        app.generator = FrozenAQInstance(FLAGS.demo_frozen_model)
+    else:
+        vocab = loader.load_vocab(chkpt_path)
+        app.generator = AQInstance(vocab=vocab)
+        app.generator.load_from_chkpt(chkpt_path)
+    app.batcher = MicroBatcher(app.generator.get_q_batch, window=FLAGS.demo_batch_window, max_batch_size=FLAGS.demo_max_batch_size) if FLAGS.demo_batching else None
+    app.cache = ResponseCache(FLAGS.demo_cache_size, ttl=FLAGS.demo_cache_ttl, disk_path=FLAGS.demo_cache_path if FLAGS.demo_cache_path != '' else None, max_disk_size=FLAGS.demo_cache_disk_size) if FLAGS.demo_cache_size > 0 else None
 
 if __name__ == '__main__':
     init()
     with app.app_context():
-        app.run(port=14045)
+        app.run(port=14045, threaded=True)
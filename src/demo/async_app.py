@@ -0,0 +1,155 @@
+import sys,os
+sys.path.insert(0, "/Users/tom/Dropbox/msc-ml/project/src/")
+sys.path.insert(0, "/home/tomhosking/webapps/qgen/qgen/src/")
+
+# An asyncio version of app.py. Requests are handled on the event loop, preprocessing (tokenisation, filtering and
+# vocab lookup) is pushed out to a thread or process pool, and the session only ever runs on a single dedicated
+# inference thread - so slow clients and preprocessing never hold up the model.
+
+import asyncio
+import json
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import tensorflow as tf
+from aiohttp import web
+
+from instance import AQInstance, FrozenAQInstance, read_frozen_graph, init_preprocess_worker, preprocess_in_worker
+from batcher import MicroBatcher
+from cache import ResponseCache, get_cache_key
+
+from helpers import preprocessing, loader
+
+import flags
+FLAGS = tf.app.flags.FLAGS
+
+from app import model_slug_curr
+
+
+# filter_settings is (window before, window after, max tokens) as given by the generator - passed along with each
+# request, since spawned workers don't have the flags (or the export metadata)
+def _preprocess(ctxt, ans, filter_settings):
+    ans_pos = ctxt.find(ans)
+    if ans_pos < 0:
+        return None
+    window_size_before, window_size_after, max_tokens = filter_settings
+    if window_size_before >-1:
+        ctxt,ans_pos = preprocessing.filter_context(ctxt, ans_pos, window_size_before, window_size_after, max_tokens)
+    return ctxt, ans_pos, preprocess_in_worker(ctxt.encode(), ans.encode(), ans_pos)
+
+
+async def index(request):
+    raise web.HTTPFound('/static/demo.htm')
+
+async def get_q(request):
+    app = request.app
+    if app['inflight'] >= FLAGS.demo_max_inflight:
+        # shed load rather than letting the queue (and everyone's latency) grow without bound
+        return web.Response(status=503, text="Server busy, try again later")
+
+    app['inflight'] += 1
+    try:
+        loop = asyncio.get_event_loop()
+        ctxt = request.query['context']
+        ans = request.query['answer']
+        if ctxt.find(ans) < 0:
+            return web.Response(text="Couldnt find ans in context!")
+
+        # Check the cache before preprocessing, so hits don't pay for tokenisation. The key is on the request as sent,
+        # so the filter settings go in too
+        filter_settings = app['generator'].get_filter_settings()
+        if app['cache'] is not None:
+            cache_key = get_cache_key(ctxt, ans, ctxt.find(ans), app['generator'].chkpt_id, dict(app['generator'].get_decode_params(), filter=filter_settings))
+            q = app['cache'].get(cache_key)
+            if q is not None:
+                return web.Response(text=q)
+
+        res = await loop.run_in_executor(app['preprocess_pool'], _preprocess, ctxt, ans, filter_settings)
+        if res is None:
+            return web.Response(text="Couldnt find ans in context!")
+        ctxt, ans_pos, (ctxt_feats, ans_feats) = res
+
+        if app['batcher'] is not None:
+            q = await asyncio.wrap_future(app['batcher'].submit(ctxt_feats, ans_feats))
+        else:
+            q = (await loop.run_in_executor(app['inference_pool'], app['generator'].run_batch, [ctxt_feats], [ans_feats]))[0]
+        if app['cache'] is not None:
+            app['cache'].put(cache_key, q)
+        return web.Response(text=q)
+    finally:
+        app['inflight'] -= 1
+
+async def ping(request):
+    loop = asyncio.get_event_loop()
+    return web.Response(text=(await loop.run_in_executor(request.app['inference_pool'], request.app['generator'].ping)).decode())
+
+async def stats(request):
+    app = request.app
+    res = app['batcher'].get_stats() if app['batcher'] is not None else {}
+    res['inflight'] = app['inflight']
+    if app['cache'] is not None:
+        res['cache'] = app['cache'].get_stats()
+    return web.Response(text=json.dumps(res))
+
+async def model_current(request):
+    return web.Response(text=model_slug_curr)
+
+async def on_cleanup(app):
+    app['preprocess_pool'].shutdown(wait=False)
+    if app['cache'] is not None:
+        app['cache'].close()
+    app['inference_pool'].shutdown(wait=False)
+
+def init():
+    print('Spinning up async AQ demo app')
+
+    if "WEB" in os.environ:
+        FLAGS.data_path = '/home/tomhosking/webapps/qgen/qgen/data/'
+        FLAGS.log_dir = 'home/tomhosking/webapps/qgen/qgen/logs/'
+        chkpt_path = '/home/tomhosking/webapps/qgen/qgen/models/saved/' + model_slug_curr
+    else:
+        chkpt_path = FLAGS.model_dir+'qgen-saved/' + model_slug_curr
+    if FLAGS.demo_frozen_model != "":
+        # the workers need the exported settings, so they preprocess to match
+        _, metadata, vocab = read_frozen_graph(FLAGS.demo_frozen_model)
+        context_as_set = metadata['context_as_set']
+    else:
+        vocab = loader.load_vocab(chkpt_path)
+        context_as_set = FLAGS.context_as_set
+
+    app = web.Application()
+
+    # The process pool only starts its workers on the first request, by which point the session exists - so they're
+    # spawned rather than forked, as forking a process with the TF runtime (and its threads) running can deadlock
+    if FLAGS.demo_preprocess_processes:
+        app['preprocess_pool'] = ProcessPoolExecutor(FLAGS.demo_preprocess_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_preprocess_worker, initargs=(vocab, context_as_set))
+    else:
+        init_preprocess_worker(vocab, context_as_set)
+        app['preprocess_pool'] = ThreadPoolExecutor(FLAGS.demo_preprocess_workers)
+
+    if FLAGS.demo_frozen_model != "":
+        app['generator'] = FrozenAQInstance(FLAGS.demo_frozen_model)
+    else:
+        app['generator'] = AQInstance(vocab=vocab)
+        app['generator'].load_from_chkpt(chkpt_path)
+
+    # the batcher runs on its own thread, so either way generation only ever runs on one thread
+    app['inference_pool'] = ThreadPoolExecutor(1)
+    app['batcher'] = MicroBatcher(app['generator'].run_batch, window=FLAGS.demo_batch_window, max_batch_size=FLAGS.demo_max_batch_size) if FLAGS.demo_batching else None
+    app['cache'] = ResponseCache(FLAGS.demo_cache_size, ttl=FLAGS.demo_cache_ttl, disk_path=FLAGS.demo_cache_path if FLAGS.demo_cache_path != '' else None, max_disk_size=FLAGS.demo_cache_disk_size) if FLAGS.demo_cache_size > 0 else None
+    app['inflight'] = 0
+
+    app.router.add_get('/', index)
+    app.router.add_get('/api/generate', get_q)
+    app.router.add_get('/api/ping', ping)
+    app.router.add_get('/api/stats', stats)
+    app.router.add_get('/api/model_current', model_current)
+    app.router.add_static('/static/', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'))
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def main(_):
+    web.run_app(init(), port=14045, keepalive_timeout=FLAGS.demo_keepalive_timeout)
+
+if __name__ == '__main__':
+    tf.app.run()
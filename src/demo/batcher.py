@@ -0,0 +1,85 @@
+import threading, time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+# Collects individual requests from concurrent callers into micro-batches, so the model runs one padded batch rather
+# than a queue of batch-of-1 session calls. A batch is run as soon as it's full, or when the oldest request in it
+# has waited for `window` seconds. `fn` takes one list per argument and returns a list of results, in order.
+class MicroBatcher():
+    def __init__(self, fn, window=0.01, max_batch_size=16, stats_size=1000):
+        self.fn = fn
+        self.window = window
+        self.max_batch_size = max_batch_size
+
+        self.pending = deque()
+        self.cond = threading.Condition()
+
+        # metrics
+        self.num_requests = 0
+        self.num_batches = 0
+        self.latencies = deque(maxlen=stats_size)
+        self.batch_sizes = deque(maxlen=stats_size)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # Queue up a request, returns a Future that will hold the result
+    def submit(self, *args):
+        future = Future()
+        with self.cond:
+            self.pending.append((args, future, time.time()))
+            self.cond.notify()
+        return future
+
+    def __call__(self, *args):
+        return self.submit(*args).result()
+
+    def _next_batch(self):
+        with self.cond:
+            while len(self.pending) == 0:
+                self.cond.wait()
+            deadline = self.pending[0][2] + self.window
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return [self.pending.popleft() for _ in range(min(self.max_batch_size, len(self.pending)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            args, futures, start_times = zip(*batch)
+            try:
+                results = list(self.fn(*[list(x) for x in zip(*args)]))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            end_time = time.time()
+            for future, result in zip(futures, results):
+                future.set_result(result)
+            # don't leave callers waiting forever if fn came back short
+            for future in futures[len(results):]:
+                future.set_exception(RuntimeError("Batch function returned {:} results for {:} requests".format(len(results), len(futures))))
+
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            self.batch_sizes.append(len(batch))
+            self.latencies.extend([end_time-t for t in start_times])
+
+    def get_stats(self):
+        latencies = np.asarray(self.latencies)
+        batch_sizes = np.asarray(self.batch_sizes)
+        return {
+            'num_requests': self.num_requests,
+            'num_batches': self.num_batches,
+            'queue_length': len(self.pending),
+            'mean_batch_size': float(np.mean(batch_sizes)) if len(batch_sizes) > 0 else 0.0,
+            'mean_batch_fill': float(np.mean(batch_sizes))/self.max_batch_size if len(batch_sizes) > 0 else 0.0,
+            'latency_mean': float(np.mean(latencies)) if len(latencies) > 0 else 0.0,
+            'latency_p50': float(np.percentile(latencies, 50)) if len(latencies) > 0 else 0.0,
+            'latency_p95': float(np.percentile(latencies, 95)) if len(latencies) > 0 else 0.0,
+        }
@@ -0,0 +1,122 @@
+import threading, time, hashlib, json, shelve
+from collections import OrderedDict
+
+# Collapse whitespace, so trivially different copies of the same passage share an entry
+def normalise_text(text):
+    if isinstance(text, bytes):
+        text = text.decode()
+    return " ".join(text.split())
+
+# Build a key covering everything that can change the generated question
+def get_cache_key(context, answer, ans_pos, model_id, decode_params):
+    return hashlib.sha1(json.dumps([normalise_text(context), normalise_text(answer), int(ans_pos), model_id, decode_params], sort_keys=True).encode()).hexdigest()
+
+# A size bounded LRU cache of generated responses, with optional expiry. If disk_path is set, entries are also written
+# to a shelve db, which is checked on a memory miss - so a restarted server doesn't start cold. The disk tier is
+# bounded too (max_disk_size, default 10x the memory size), and is only synced every sync_every puts and on close.
+class ResponseCache():
+    def __init__(self, max_size=1024, ttl=0, disk_path=None, max_disk_size=0, sync_every=100):
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size if max_disk_size > 0 else max_size*10
+        self.ttl = ttl
+        self.sync_every = sync_every
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk = shelve.open(disk_path) if disk_path else None
+        # key -> timestamp for everything on disk, least recently used first
+        self.disk_order = OrderedDict()
+        self.unsynced = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        if self.disk is not None:
+            self._load_disk_order()
+
+    # Drop anything that expired while the server was down, and order the rest oldest first
+    def _load_disk_order(self):
+        entries = []
+        for key in list(self.disk.keys()):
+            _, timestamp = self.disk[key]
+            if self._expired(timestamp):
+                del self.disk[key]
+            else:
+                entries.append((timestamp, key))
+        for timestamp, key in sorted(entries):
+            self.disk_order[key] = timestamp
+        self._trim_disk()
+
+    def _expired(self, timestamp):
+        return self.ttl > 0 and time.time() - timestamp > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                value, timestamp = self.entries[key]
+                if not self._expired(timestamp):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+
+            if self.disk is not None and key in self.disk_order:
+                value, timestamp = self.disk[key]
+                if not self._expired(timestamp):
+                    self._insert(key, value, timestamp)
+                    self.disk_order.move_to_end(key)
+                    self.disk_hits += 1
+                    return value
+                del self.disk[key]
+                del self.disk_order[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            timestamp = time.time()
+            self._insert(key, value, timestamp)
+            if self.disk is not None:
+                self.disk[key] = (value, timestamp)
+                self.disk_order[key] = timestamp
+                self.disk_order.move_to_end(key)
+                self._trim_disk()
+                self.unsynced += 1
+                if self.unsynced >= self.sync_every:
+                    self.disk.sync()
+                    self.unsynced = 0
+
+    def _insert(self, key, value, timestamp):
+        self.entries[key] = (value, timestamp)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _trim_disk(self):
+        while len(self.disk_order) > self.max_disk_size:
+            key, _ = self.disk_order.popitem(last=False)
+            del self.disk[key]
+            self.disk_evictions += 1
+
+    def close(self):
+        if self.disk is not None:
+            with self.lock:
+                self.disk.close()
+                self.disk = None
+
+    def get_stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'disk_size': len(self.disk_order),
+            'disk_evictions': self.disk_evictions,
+            'hit_rate': (self.hits + self.disk_hits)/total if total > 0 else 0.0,
+        }
@@ -7,53 +7,274 @@ import tensorflow as tf
 import numpy as np
 from seq2seq_model import Seq2SeqModel
 from maluuba_model import MaluubaModel
-from helpers import preprocessing
+from helpers import preprocessing, loader, ops, decoding
 
 import json
+import multiprocessing
 
 import flags
 FLAGS = tf.app.flags.FLAGS
 
 mem_limit=0.9
 
-class AQInstance():
+# Tokenise and look up a single request. This doesn't touch the model, so can be run off the inference thread
+def preprocess_request(vocab, context, ans, ans_pos, context_as_set=False):
+    ctxt_feats = preprocessing.process_squad_context(vocab, context_as_set=context_as_set)(context)
+    ans_feats = preprocessing.process_squad_answer(vocab, context_as_set=context_as_set)(ans, ans_pos, context)
+    return ctxt_feats, ans_feats
+
+# Preprocessing workers get their own copy of the vocab when they start, rather than with every request. The settings
+# are passed in too, since spawned workers don't have the parsed flags
+_worker_vocab = None
+_worker_context_as_set = False
+
+def init_preprocess_worker(vocab, context_as_set=False):
+    global _worker_vocab, _worker_context_as_set
+    _worker_vocab = vocab
+    _worker_context_as_set = context_as_set
+
+def preprocess_in_worker(context, ans, ans_pos):
+    return preprocess_request(_worker_vocab, context, ans, ans_pos, _worker_context_as_set)
+
+# Stack the outputs of process_squad_context/answer into padded arrays, matching the padding used by the streamer
+def pad_context_batch(ctxt_feats, vocab):
+    c_raw, c_ids, c_copy_ids, c_len, c_vocab_size = zip(*ctxt_feats)
+    return (preprocessing.pad_sequences(c_raw, loader.PAD.encode(), dtype=object),
+            preprocessing.pad_sequences(c_ids, vocab[loader.PAD]),
+            preprocessing.pad_sequences(c_copy_ids, 0),
+            np.asarray(c_len, dtype=np.int32),
+            np.asarray(c_vocab_size, dtype=np.int32))
+
+def pad_answer_batch(ans_feats, vocab):
+    a_raw, a_ids, a_len, a_locs = zip(*ans_feats)
+    return (preprocessing.pad_sequences(a_raw, loader.PAD.encode(), dtype=object),
+            preprocessing.pad_sequences(a_ids, vocab[loader.PAD]),
+            np.asarray(a_len, dtype=np.int32),
+            preprocessing.pad_sequences(a_locs, 0))
+
+def get_session(graph):
+    gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
+    return tf.Session(graph=graph, config=tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True))
+
+# Everything that just needs a session and a way of running the decoders - shared by AQInstance, which builds the model
+# and restores a checkpoint, and FrozenAQInstance, which loads an exported graph. Subclasses provide get_decoders,
+# get_decode_params, get_filter_settings, get_feed_dict, run_decoder, run_nbest and ping
+class BaseAQInstance():
+    def __init__(self, vocab, context_as_set=False):
+        self.vocab = vocab
+        self.context_as_set = context_as_set
+        self.preprocess_pool = None
+        self.decoder = FLAGS.demo_decoder
+        self.vocab_table = None
+
+    def get_q(self, context, ans,ans_pos):
+        return self.get_q_batch([context], [ans], [ans_pos])[0]
+
+    # Run a list of (context, answer, answer pos) requests through the model as one padded batch
+    def get_q_batch(self, contexts, answers, ans_positions, decoder=None):
+        feats = [preprocess_request(self.vocab, context, ans, ans_pos, self.context_as_set) for context, ans, ans_pos in zip(contexts, answers, ans_positions)]
+        ctxt_feats, ans_feats = zip(*feats)
+        return self.run_batch(ctxt_feats, ans_feats, decoder=decoder)
+
+    # Generate questions for several answers in the same context. The context is only tokenised and looked up once,
+    # then all the answers are run as a single batch. The encoder itself can't be shared between answers, since the
+    # in-answer feature is one of its inputs.
+    def get_qs_for_context(self, context, answers, ans_positions):
+        ctxt_feats = preprocessing.process_squad_context(self.vocab, context_as_set=self.context_as_set)(context)
+        process_answer = preprocessing.process_squad_answer(self.vocab, context_as_set=self.context_as_set)
+        ans_feats = [process_answer(ans, ans_pos, context) for ans, ans_pos in zip(answers, ans_positions)]
+        return self.run_batch([ctxt_feats]*len(answers), ans_feats)
+
+    # Run a batch of already preprocessed requests - this is the only part that needs the session
+    # Optionally also returns the log prob and length of the output for each example. decoder picks the decoding
+    # strategy ('greedy', 'sample', 'beam' or 'beamN'), and defaults to FLAGS.demo_decoder. max_length caps the number of
+    # decoding steps (including EOS), either for the whole batch or as a list with one per example.
+    def run_batch(self, ctxt_feats, ans_feats, return_scores=False, decoder=None, temperature=None, max_length=None):
+        decoder = self.decoder if decoder is None else decoder
+        if decoder not in self.get_decoders():
+            raise ValueError("Unknown decoder "+decoder+" - this model has "+", ".join(self.get_decoders()))
+        ctxt_batch = pad_context_batch(ctxt_feats, self.vocab)
+        feed_dict = self.get_feed_dict(ctxt_batch, pad_answer_batch(ans_feats, self.vocab), temperature, max_length)
+        q,q_len,q_score = self.run_decoder(decoder, feed_dict, ctxt_batch[0])
+        q_str = [" ".join([w.decode().replace('>','&gt;').replace('<','&lt;') for w in q[i][:q_len[i]-1]]) for i in range(len(ctxt_feats))]
+        if return_scores:
+            return q_str, q_score.tolist(), q_len.tolist()
+        return q_str
+
+    # The top n beam hypotheses for each request, as NBestLists of (lazily decoded) questions with their log probs.
+    # n is capped at the nbest_size the graph was built with
+    def get_nbest(self, contexts, answers, ans_positions, n=None):
+        feats = [preprocess_request(self.vocab, context, ans, ans_pos, self.context_as_set) for context, ans, ans_pos in zip(contexts, answers, ans_positions)]
+        ctxt_feats, ans_feats = zip(*feats)
+        ctxt_batch = pad_context_batch(ctxt_feats, self.vocab)
+        nbest = self.run_nbest(self.get_feed_dict(ctxt_batch, pad_answer_batch(ans_feats, self.vocab)))
+        if self.vocab_table is None:
+            self.vocab_table = ops.get_vocab_table(self.vocab.rev)
+        return [decoding.NBestList(nbest['ids'][i,:n], nbest['lens'][i,:n], nbest['scores'][i,:n], ctxt_batch[0][i], self.vocab_table, self.context_as_set) for i in range(len(ctxt_feats))]
+
+    # Bulk generation for offline use. Takes a list of (context, answer, answer pos) triples and returns the questions
+    # in the same order. Preprocessing is spread over num_workers processes (or done inline if 0), then the examples
+    # are sorted by context length so each model batch of batch_size needs as little padding as possible.
+    def get_qs(self, triples, batch_size=32, num_workers=0, return_scores=False, decoder=None):
+        if num_workers > 0:
+            if self.preprocess_pool is None:
+                # the session is already running by now, and forking a process with the TF runtime in it can deadlock
+                self.preprocess_pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer=init_preprocess_worker, initargs=(self.vocab, self.context_as_set))
+            feats = self.preprocess_pool.starmap(preprocess_in_worker, triples, chunksize=max(1, len(triples)//(num_workers*4)))
+        else:
+            feats = [preprocess_request(self.vocab, *triple, context_as_set=self.context_as_set) for triple in triples]
+
+        order = np.argsort([len(ctxt_feats[1]) for ctxt_feats, _ in feats], kind='stable')
+        qs, scores, lens = [None]*len(feats), [None]*len(feats), [None]*len(feats)
+        for start in range(0, len(order), batch_size):
+            batch_ixs = order[start:start+batch_size]
+            ctxt_feats, ans_feats = zip(*[feats[ix] for ix in batch_ixs])
+            batch_qs, batch_scores, batch_lens = self.run_batch(ctxt_feats, ans_feats, return_scores=True, decoder=decoder)
+            for i, ix in enumerate(batch_ixs):
+                qs[ix], scores[ix], lens[ix] = batch_qs[i], batch_scores[i], batch_lens[i]
+
+        if return_scores:
+            return qs, scores, lens
+        return qs
+
+    def close(self):
+        if self.preprocess_pool is not None:
+            self.preprocess_pool.terminate()
+            self.preprocess_pool = None
+        self.sess.close()
+
+
+class AQInstance(BaseAQInstance):
     def __init__(self, vocab):
         # self.model = Seq2SeqModel(vocab, training_mode=False)
         self.model = MaluubaModel(vocab, training_mode=False)
+        super().__init__(self.model.vocab, FLAGS.context_as_set)
         with self.model.graph.as_default():
             self.model.ping = tf.constant("ack")
         # self.model = MaluubaModel(vocab, training_mode=False)
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
-        self.sess = tf.Session(graph=self.model.graph, config=tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True))
+        self.sess = get_session(self.model.graph)
 
     def load_from_chkpt(self, path):
         self.chkpt_path = path
         with self.model.graph.as_default():
             saver = tf.train.Saver()
-            saver.restore(self.sess, tf.train.latest_checkpoint(path))
+            self.chkpt_id = tf.train.latest_checkpoint(path)
+            saver.restore(self.sess, self.chkpt_id)
             print("Loaded model from "+path)
 
-    def get_q(self, context, ans,ans_pos):
-        # Process and create a batch of 1
-        ctxt_dict = tuple([np.asarray([x]) for x in preprocessing.process_squad_context(self.model.vocab, context_as_set=FLAGS.context_as_set)(context)])
-        ans_dict = tuple([np.asarray([x]) for x in preprocessing.process_squad_answer(self.model.vocab, context_as_set=FLAGS.context_as_set)(ans,ans_pos,context)])
+    # Anything that changes the output for a given input, for use in cache keys
+    def get_decode_params(self):
+        return {'decoder': self.decoder, 'beam_width': FLAGS.beam_width, 'length_penalty': FLAGS.length_penalty, 'context_as_set': self.context_as_set,
+                'max_len': FLAGS.decode_max_len, 'early_stop': FLAGS.beam_early_stop}
 
-        q,q_len = self.sess.run([self.model.q_hat_beam_string,self.model.q_hat_beam_lens], feed_dict={self.model.context_in: ctxt_dict, self.model.answer_in: ans_dict})
-        q_str = " ".join([w.decode().replace('>','&gt;').replace('<','&lt;') for w in q[0][:q_len[0]-1]])
-        return q_str
+    # How contexts should be filtered down around the answer before they're passed in - (window before, window after, max tokens)
+    def get_filter_settings(self):
+        return (FLAGS.filter_window_size_before, FLAGS.filter_window_size_after, FLAGS.filter_max_tokens)
+
+    # The decoders built into the graph - any of these can be passed as `decoder` below
+    def get_decoders(self):
+        return sorted(self.model.decoders.keys())
+
+    def get_feed_dict(self, ctxt_batch, ans_batch, temperature=None, max_length=None):
+        feed_dict = {self.model.context_in: ctxt_batch, self.model.answer_in: ans_batch}
+        if temperature is not None:
+            feed_dict[self.model.sample_temperature] = temperature
+        if max_length is not None:
+            feed_dict[self.model.decode_max_length] = np.broadcast_to(np.asarray(max_length, dtype=np.int32), [len(ctxt_batch[3])])
+        return feed_dict
+
+    # Returns the output tokens, lengths and scores of a decoder
+    def run_decoder(self, decoder, feed_dict, context_raw):
+        outputs = self.model.decoders[decoder]
+        return self.sess.run([outputs['string'],outputs['lens'],outputs['scores']], feed_dict=feed_dict)
+
+    def run_nbest(self, feed_dict):
+        if not hasattr(self.model, 'q_hat_nbest'):
+            raise ValueError("This model was built without n-best outputs - set nbest_size > 0")
+        return self.sess.run(self.model.q_hat_nbest, feed_dict=feed_dict)
 
     def ping(self):
         return self.sess.run(self.model.ping)
 
 
+# Read the graph written by export.py, along with the settings and vocab stored in it. This doesn't need a session, so
+# is safe to call before forking worker processes
+def read_frozen_graph(path):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as fp:
+        graph_def.ParseFromString(fp.read())
+    consts = {node.name: tf.make_ndarray(node.attr['value'].tensor) for node in graph_def.node if node.name in ['export/metadata', 'export/vocab']}
+    metadata = json.loads(consts['export/metadata'].item().decode())
+    vocab = loader.Vocab({w.decode(): i for i,w in enumerate(consts['export/vocab'].tolist())})
+    return graph_def, metadata, vocab
+
+# Serves from a frozen graph written by export.py, rather than building the model and restoring a checkpoint - so
+# no GloVe loading at start up, and only the ops needed for decoding are kept in memory. The model settings (copy
+# mode, beam width etc) are fixed by the export, and are used in place of the flags.
+class FrozenAQInstance(BaseAQInstance):
+    def __init__(self, path):
+        graph_def, self.metadata, vocab = read_frozen_graph(path)
+        super().__init__(vocab, self.metadata['context_as_set'])
+        self.chkpt_path = path
+        self.chkpt_id = self.metadata['chkpt_id']
+
+        # the beam search decoder uses contrib ops, which are registered when tf.contrib.seq2seq is imported (by helpers.decoding)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        existing = set([op.name for op in self.graph.get_operations()])
+        get_tensors = lambda names: [self.graph.get_tensor_by_name(name) if name.split(':')[0] in existing else None for name in names]
+
+        self.context_in = get_tensors(self.metadata['context_in'])
+        self.answer_in = get_tensors(self.metadata['answer_in'])
+        self.decode_max_length, self.sample_temperature = get_tensors([self.metadata['decode_max_length'], self.metadata['sample_temperature']])
+        self.outputs = {name: get_tensors(['export/'+name+'/'+key+':0' for key in ['ids', 'lens', 'scores']]) for name in self.metadata['decoders']+(['nbest'] if self.metadata['nbest'] else [])}
+        self.ping_op = self.graph.get_tensor_by_name('export/ping:0')
+
+        self.sess = get_session(self.graph)
+        self.vocab_table = ops.get_vocab_table(self.vocab.rev)
+        print("Loaded frozen model from "+path)
+
+    def get_decode_params(self):
+        return {'decoder': self.decoder, 'beam_width': self.metadata['beam_width'], 'length_penalty': self.metadata['length_penalty'], 'context_as_set': self.context_as_set,
+                'max_len': self.metadata['decode_max_len'], 'early_stop': self.metadata['beam_early_stop']}
+
+    # the model was trained (and exported) with these, so the flags could be out of date
+    def get_filter_settings(self):
+        return (self.metadata['filter_window_size_before'], self.metadata['filter_window_size_after'], self.metadata['filter_max_tokens'])
+
+    def get_decoders(self):
+        return self.metadata['decoders']
+
+    # Inputs that were pruned from the graph (eg the raw strings) are just not fed
+    def get_feed_dict(self, ctxt_batch, ans_batch, temperature=None, max_length=None):
+        feeds = list(zip(self.context_in, ctxt_batch)) + list(zip(self.answer_in, ans_batch))
+        if temperature is not None:
+            feeds.append((self.sample_temperature, temperature))
+        if max_length is not None:
+            feeds.append((self.decode_max_length, np.broadcast_to(np.asarray(max_length, dtype=np.int32), [len(ctxt_batch[3])])))
+        return {tensor: value for tensor, value in feeds if tensor is not None}
+
+    def run_decoder(self, decoder, feed_dict, context_raw):
+        ids, lens, scores = self.sess.run(self.outputs[decoder], feed_dict=feed_dict)
+        return ops.decode_ids(ids, context_raw, self.vocab_table, self.context_as_set), lens, scores
+
+    def run_nbest(self, feed_dict):
+        if 'nbest' not in self.outputs:
+            raise ValueError("This model was exported without n-best outputs - set nbest_size > 0")
+        return dict(zip(['ids', 'lens', 'scores'], self.sess.run(self.outputs['nbest'], feed_dict=feed_dict)))
+
+    def ping(self):
+        return self.sess.run(self.ping_op)
+
+
 def main(_):
     import matplotlib.pyplot as plt
 
     # chkpt_path = FLAGS.model_dir+'saved/qgen-s2s-shortlist'
 
     chkpt_path = FLAGS.model_dir+'saved2/' + 'MALUUBA-CROP-LATENT-GLOVE/1535108104'
-    with open(chkpt_path+'/vocab.json') as f:
-        vocab = json.load(f)
+    vocab = loader.load_vocab(chkpt_path)
     generator = AQInstance(vocab=vocab)
     generator.load_from_chkpt(chkpt_path)
 
@@ -0,0 +1,43 @@
+import sys,os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Smoke test for the async demo's preprocessing, run with eg: python -m pytest demo/test_async_app.py
+
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('aiohttp')
+pytest.importorskip('flask')
+
+import async_app
+from instance import init_preprocess_worker
+from helpers import loader, preprocessing
+
+FLAGS = tf.app.flags.FLAGS
+
+def get_filter_settings():
+    return (FLAGS.filter_window_size_before, FLAGS.filter_window_size_after, FLAGS.filter_max_tokens)
+
+ctxt="only several hundred are greater than magnitude 3.0 , and only about 15–20 are greater than magnitude 4.0 . the magnitude 6.7 1994 northridge earthquake was particularly destructive , causing a substantial number of deaths , injuries , and structural collapses . it caused the most property damage of any earthquake in u.s. history , estimated at over $ 20 billion ."
+
+def get_vocab():
+    words = sorted(set([w.decode() for w in preprocessing.tokenise(ctxt)]))
+    return loader.Vocab({w: i for i,w in enumerate([loader.PAD, loader.OOV, loader.SOS, loader.EOS]+words)})
+
+def test_preprocess():
+    FLAGS(sys.argv[:1])
+    init_preprocess_worker(get_vocab(), FLAGS.context_as_set)
+
+    ans = "6.7"
+    res = async_app._preprocess(ctxt, ans, get_filter_settings())
+    assert res is not None
+    filt_ctxt, ans_pos, (ctxt_feats, ans_feats) = res
+    assert filt_ctxt[ans_pos:ans_pos+len(ans)] == ans
+    assert len(ctxt_feats) == 5 and len(ans_feats) == 4
+    assert ctxt_feats[3] == len(ctxt_feats[1])
+
+def test_preprocess_missing_answer():
+    FLAGS(sys.argv[:1])
+    init_preprocess_worker(get_vocab(), FLAGS.context_as_set)
+    assert async_app._preprocess(ctxt, "not in the context", get_filter_settings()) is None
@@ -0,0 +1,41 @@
+import sys,os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+
+from batcher import MicroBatcher
+
+def test_batches_concurrent_requests():
+    calls = []
+    def fn(xs, ys):
+        calls.append(len(xs))
+        return [x+y for x,y in zip(xs, ys)]
+
+    # a long window, so all the requests end up in one batch
+    batcher = MicroBatcher(fn, window=1.0, max_batch_size=4)
+    futures = [batcher.submit(i, 10*i) for i in range(4)]
+    assert [f.result(timeout=5) for f in futures] == [0, 11, 22, 33]
+    assert calls == [4]
+    assert batcher.get_stats()['num_requests'] == 4 and batcher.get_stats()['mean_batch_fill'] == 1.0
+
+def test_window_flushes_partial_batch():
+    batcher = MicroBatcher(lambda xs: [x*2 for x in xs], window=0.01, max_batch_size=16)
+    assert batcher(3) == 6
+    assert batcher.get_stats()['mean_batch_size'] == 1.0
+
+def test_errors_go_to_every_caller():
+    def fn(xs):
+        raise ValueError("bad batch")
+    batcher = MicroBatcher(fn, window=1.0, max_batch_size=2)
+    futures = [batcher.submit(i) for i in range(2)]
+    for f in futures:
+        with pytest.raises(ValueError):
+            f.result(timeout=5)
+
+def test_short_results_fail_unmatched_requests():
+    batcher = MicroBatcher(lambda xs: xs[:1], window=1.0, max_batch_size=3)
+    futures = [batcher.submit(i) for i in range(3)]
+    assert futures[0].result(timeout=5) == 0
+    for f in futures[1:]:
+        with pytest.raises(RuntimeError):
+            f.result(timeout=5)
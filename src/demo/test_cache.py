@@ -0,0 +1,62 @@
+import sys,os
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cache
+from cache import ResponseCache, get_cache_key
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_key_normalises_whitespace():
+    assert get_cache_key("a  b\nc", "b", 2, "m", {}) == get_cache_key(b"a b c", "b ", 2, "m", {})
+    assert get_cache_key("a b c", "b", 2, "m", {}) != get_cache_key("a b c", "b", 2, "m", {'beam_width': 2})
+
+def test_lru_eviction():
+    c = ResponseCache(max_size=2)
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+    # b is now the least recently used
+    c.put('c', 3)
+    assert c.get('b') is None
+    assert c.get('a') == 1 and c.get('c') == 3
+    stats = c.get_stats()
+    assert stats['size'] == 2 and stats['evictions'] == 1 and stats['hits'] == 3 and stats['misses'] == 1
+
+def test_ttl(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    c = ResponseCache(max_size=10, ttl=60)
+    c.put('a', 1)
+    clock.now += 30
+    assert c.get('a') == 1
+    clock.now += 31
+    assert c.get('a') is None
+    assert c.get_stats()['size'] == 0
+
+def test_disk_tier(tmpdir, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    path = str(tmpdir.join('cache'))
+    c = ResponseCache(max_size=1, ttl=60, disk_path=path, max_disk_size=2)
+    for key in ['a', 'b', 'c']:
+        c.put(key, key)
+        clock.now += 1
+    # only the most recent goes in memory, the disk tier keeps two
+    assert c.get('b') == 'b'
+    assert c.get('a') is None
+    assert c.get_stats()['disk_hits'] == 1 and c.get_stats()['disk_evictions'] == 1
+    c.close()
+
+    # a restart picks the disk entries back up, minus any that have since expired
+    reopened = ResponseCache(max_size=1, ttl=60, disk_path=path, max_disk_size=2)
+    assert reopened.get('c') == 'c'
+    reopened.close()
+    clock.now += 120
+    reopened = ResponseCache(max_size=1, ttl=60, disk_path=path, max_disk_size=2)
+    assert reopened.get('b') is None and reopened.get_stats()['disk_size'] == 0
+    reopened.close()
@@ -16,24 +16,23 @@ mem_limit=1
 
 # This provides a somewhat normalised interface to a pre-trained QANet model - some tweaks have been made to get it to play nicely when other models are spun up
 class DiscriminatorInstance():
-    def __init__(self, trainable=False, path=None, log_slug=None, force_init=False):
+    def __init__(self, trainable=False, path=None, log_slug=None, force_init=False, session_config=None):
         config = tf.app.flags.FLAGS
         self.run_id = str(int(time.time())) + ("-"+log_slug if log_slug is not None else "")
         self.trainable = trainable
-        self.load_from_chkpt(path, force_init)
+        self.load_from_chkpt(path, force_init, session_config)
         if trainable:
             self.summary_writer = tf.summary.FileWriter(config.log_dir+'disc/'+self.run_id, self.model.graph)
     def __del__(self):
         self.sess.close()
 
 
-    def load_from_chkpt(self, path=None, force_init=False):
+    # session_config overrides the default per model session setup, eg to share thread pools with other models
+    def load_from_chkpt(self, path=None, force_init=False, session_config=None):
 
         config = tf.app.flags.FLAGS
-        with open(config.disc_word_emb_file, "r") as fh:
-            word_mat = np.array(json.load(fh), dtype=np.float32)
-        with open(config.disc_char_emb_file, "r") as fh:
-            char_mat = np.array(json.load(fh), dtype=np.float32)
+        word_mat = loader.load_emb_matrix(config.disc_word_emb_file)
+        char_mat = loader.load_emb_matrix(config.disc_char_emb_file)
         # with open(config.disc_test_meta, "r") as fh:
         #     meta = json.load(fh)
 
@@ -45,8 +44,10 @@ class DiscriminatorInstance():
 
         self.model = Model(config, None, word_mat, char_mat, trainable=self.trainable, demo = True, opt=False)
 
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
-        self.sess = tf.Session(graph=self.model.graph, config=tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True))
+        if session_config is None:
+            gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
+            session_config = tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True)
+        self.sess = tf.Session(graph=self.model.graph, config=session_config)
 
         with self.model.graph.as_default():
             self.saver = tf.train.Saver(max_to_keep=1, save_relative_paths=True)
@@ -19,10 +19,7 @@ from tqdm import tqdm
 from seq2seq_model import Seq2SeqModel
 from maluuba_model import MaluubaModel
 from datasources.squad_streamer import SquadStreamer
-from langmodel.lm import LstmLmInstance
-# from qa.mpcm import MpcmQaInstance
-from qa.qanet.instance import QANetInstance
-from discriminator.instance import DiscriminatorInstance
+from model_host import create_model_host
 
 import flags
 
@@ -55,10 +52,9 @@ def main(_):
 
 
     # vocab = loader.get_vocab(train_contexts, tf.app.flags.FLAGS.vocab_size)
-    with open(chkpt_path+'/vocab.json') as f:
-        vocab = json.load(f)
+    vocab = loader.load_vocab(chkpt_path)
 
-    with SquadStreamer(vocab, FLAGS.eval_batch_size, 1, shuffle=False) as dev_data_source:
+    with SquadStreamer(vocab, FLAGS.eval_batch_size, 1, shuffle=False, feature_cache=FLAGS.feature_cache) as dev_data_source:
 
         glove_embeddings = loader.load_glove(FLAGS.data_path)
 
@@ -78,15 +74,8 @@ def main(_):
             saver = tf.train.Saver()
 
         if FLAGS.eval_metrics:
-            lm = LstmLmInstance()
-            # qa = MpcmQaInstance()
-            qa = QANetInstance()
-
-            lm.load_from_chkpt(FLAGS.model_dir+'saved/lmtest')
-            # qa.load_from_chkpt(FLAGS.model_dir+'saved/qatest')
-            qa.load_from_chkpt(FLAGS.model_dir+'saved/qanet2')
-
-            discriminator = DiscriminatorInstance(trainable=False, path=disc_path)
+            scoring_host = create_model_host(lm_path=FLAGS.model_dir+'saved/lmtest', qa_path=FLAGS.model_dir+'saved/qanet2', disc_path=disc_path)
+            lm, qa, discriminator = scoring_host.lm, scoring_host.qa, scoring_host.discriminator
 
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit)
         with tf.Session(graph=model.graph, config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
@@ -130,7 +119,7 @@ def main(_):
             for e in range(1):
                 for i in tqdm(range(num_steps), desc='Epoch '+str(e)):
                     dev_batch, curr_batch_size = dev_data_source.get_batch()
-                    pred_batch,pred_beam,pred_beam_lens,pred_ids,pred_lens,gold_batch, gold_lens,gold_ids,ctxt,ctxt_len,ans,ans_len,nll,copy_prob= sess.run([model.q_hat_beam_string, model.q_hat_full_beam_str, model.q_hat_full_beam_lens,model.q_hat_beam_ids,model.q_hat_beam_lens,model.question_raw, model.question_length, model.question_ids, model.context_raw, model.context_length, model.answer_locs, model.answer_length, model.nll, model.mean_copy_prob], feed_dict={model.input_batch: dev_batch ,model.is_training:False})
+                    pred_batch,pred_ids,pred_lens,gold_batch, gold_lens,gold_ids,ctxt,ctxt_len,ans,ans_len,nll,copy_prob= sess.run([model.q_hat_beam_string,model.q_hat_beam_ids,model.q_hat_beam_lens,model.question_raw, model.question_length, model.question_ids, model.context_raw, model.context_length, model.answer_locs, model.answer_length, model.nll, model.mean_copy_prob], feed_dict={model.input_batch: dev_batch ,model.is_training:False})
 
                     unfilt_ctxt_batch = [dev_contexts_unfilt[ix] for ix in dev_batch[3]]
                     a_text_batch = ops.byte_token_array_to_str(dev_batch[2][0], dev_batch[2][2], is_array=False)
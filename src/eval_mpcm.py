@@ -17,9 +17,7 @@ from helpers import loader
 from helpers.metrics import f1
 
 def get_padded_batch(seq_batch, vocab):
-    seq_batch_ids = [[vocab[loader.SOS]]+[vocab[tok if tok in vocab.keys() else loader.OOV] for tok in tokenise(sent, asbytes=False)]+[vocab[loader.EOS]] for sent in seq_batch]
-    max_seq_len = max([len(seq) for seq in seq_batch_ids])
-    padded_batch = np.asarray([seq + [vocab[loader.PAD] for i in range(max_seq_len-len(seq))] for seq in seq_batch_ids])
+    padded_batch, _ = vocab.encode_batch([tokenise(sent, asbytes=False) for sent in seq_batch], add_sos_eos=True)
     return padded_batch
 
 FLAGS = tf.app.flags.FLAGS
@@ -36,8 +34,7 @@ def main(_):
     dev_contexts, dev_qs, dev_as, dev_a_pos = zip(*dev_data)
 
     # vocab = loader.get_vocab(train_contexts, tf.app.flags.FLAGS.qa_vocab_size)
-    with open(chkpt_path+'/vocab.json') as f:
-        vocab = json.load(f)
+    vocab = loader.load_vocab(chkpt_path)
 
     model = MpcmQa(vocab, training_mode=False)
     with model.graph.as_default():
@@ -0,0 +1,94 @@
+import os, json
+
+# Export a trained model as a single frozen inference graph - the variables are folded in as constants, and everything
+# not needed to run the decoders (losses, summaries, optimiser state, the training decoder) is pruned away. The vocab
+# and the settings the graph was built with are stored in the graph too, so serving needs nothing else.
+# Load it with demo.instance.FrozenAQInstance, eg by passing --demo_frozen_model to the demo apps.
+
+import tensorflow as tf
+import numpy as np
+import helpers.loader as loader
+
+from seq2seq_model import Seq2SeqModel
+from maluuba_model import MaluubaModel
+
+import flags
+
+FLAGS = tf.app.flags.FLAGS
+
+def main(_):
+    model_type=FLAGS.model_type
+    chkpt_path = FLAGS.model_dir+'qgen/'+ model_type+'/'+FLAGS.eval_model_id
+    export_path = FLAGS.export_path if FLAGS.export_path != "" else chkpt_path+'/frozen_model.pb'
+
+    if not os.path.exists(chkpt_path):
+        exit('Checkpoint path doesnt exist! '+chkpt_path)
+    vocab = loader.load_vocab(chkpt_path)
+
+    # no need for the LM or QA models, they're only used for rewards
+    FLAGS.policy_gradient = False
+    FLAGS.qa_weight = 0
+    FLAGS.lm_weight = 0
+    if model_type[:7] == "SEQ2SEQ":
+        model = Seq2SeqModel(vocab, training_mode=False)
+    elif model_type[:7] == "MALUUBA":
+        model = MaluubaModel(vocab, training_mode=False)
+    else:
+        exit("Unrecognised model type: "+model_type)
+
+    chkpt_id = tf.train.latest_checkpoint(chkpt_path)
+
+    with model.graph.as_default():
+        saver = tf.train.Saver()
+
+        # Give the outputs fixed names. Strings are left out on purpose - with context_as_set they need a py_func,
+        # which can't be serialised, so the loader decodes the ids instead
+        output_names = []
+        with tf.name_scope('export'):
+            for name, decoder in model.decoders.items():
+                for key in ['ids', 'lens', 'scores']:
+                    output_names.append(tf.identity(decoder[key], name=name+'/'+key).op.name)
+            if hasattr(model, 'q_hat_nbest'):
+                for key in ['ids', 'lens', 'scores']:
+                    output_names.append(tf.identity(model.q_hat_nbest[key], name='nbest/'+key).op.name)
+
+            metadata = {
+                'model_type': model_type,
+                'chkpt_id': chkpt_id,
+                'decoders': sorted(model.decoders.keys()),
+                'nbest': hasattr(model, 'q_hat_nbest'),
+                'context_in': [t.name for t in model.context_in],
+                'answer_in': [t.name for t in model.answer_in],
+                'decode_max_length': model.decode_max_length.name,
+                'sample_temperature': model.sample_temperature.name,
+                'context_as_set': FLAGS.context_as_set,
+                'max_copy_size': FLAGS.max_copy_size,
+                'beam_width': FLAGS.beam_width,
+                'length_penalty': FLAGS.length_penalty,
+                'decode_max_len': FLAGS.decode_max_len,
+                'beam_early_stop': FLAGS.beam_early_stop,
+                'filter_window_size_before': FLAGS.filter_window_size_before,
+                'filter_window_size_after': FLAGS.filter_window_size_after,
+                'filter_max_tokens': FLAGS.filter_max_tokens,
+            }
+            output_names.append(tf.constant(json.dumps(metadata), name='metadata').op.name)
+            output_names.append(tf.constant(np.asarray([w.encode() for w in model.rev_vocab], dtype=object), name='vocab').op.name)
+            output_names.append(tf.constant("ack", name='ping').op.name)
+
+    with tf.Session(graph=model.graph) as sess:
+        saver.restore(sess, chkpt_id)
+        frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess, model.graph.as_graph_def(), output_names)
+
+    # Anything still needing a feed that the loader doesn't know about means a decoder depends on the training inputs
+    known_inputs = set([name.split(':')[0] for name in metadata['context_in']+metadata['answer_in']])
+    unfed = [node.name for node in frozen_graph_def.node if node.op == 'Placeholder' and node.name not in known_inputs]
+    if len(unfed) > 0:
+        exit("Exported graph depends on inputs that won't be fed: "+", ".join(unfed))
+
+    with open(export_path, 'wb') as fp:
+        fp.write(frozen_graph_def.SerializeToString())
+
+    print('Exported', len(frozen_graph_def.node), 'nodes to', export_path, '({:.1f}MB)'.format(frozen_graph_def.ByteSize()/1e6))
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -24,6 +24,15 @@ tf.app.flags.DEFINE_integer("eval_batch_size", 16, "Batch size")
 tf.app.flags.DEFINE_string("data_path", './data/', "Path to dataset")
 tf.app.flags.DEFINE_string("log_dir", './logs/', "Path to logs")
 tf.app.flags.DEFINE_string("model_dir", './models/', "Path to checkpoints")
+tf.app.flags.DEFINE_boolean("feature_cache", False, "Preprocess the dataset once and stream features from an on-disk cache, instead of preprocessing every epoch")
+tf.app.flags.DEFINE_string("feature_cache_dir", './data/cache/', "Path to preprocessed feature cache")
+tf.app.flags.DEFINE_integer("streamer_workers", 0, "Number of worker processes to use for preprocessing the training stream. Set 0 to use the tf.data pipeline")
+tf.app.flags.DEFINE_boolean("streamer_ordered", True, "When using worker processes, preserve the (shuffled) order of examples. Disable to return them as soon as they're ready")
+tf.app.flags.DEFINE_integer("streamer_queue_size", 16, "Max number of preprocessed batches to buffer when using worker processes")
+tf.app.flags.DEFINE_boolean("bucket_batching", False, "Batch training examples of similar context (then question) length together to reduce padding")
+tf.app.flags.DEFINE_integer("bucket_ctxt_width", 20, "Width (in tokens) of each context length bucket")
+tf.app.flags.DEFINE_integer("bucket_q_width", 5, "Width (in tokens) of each question length bucket")
+tf.app.flags.DEFINE_integer("bucket_max_q_len", 40, "Questions longer than this all go in the same bucket")
 
 # hyperparams
 tf.app.flags.DEFINE_integer("filter_window_size_before", 1, "Filter contexts down to the sentences around the answer. Set -1 to disable filtering")
@@ -61,6 +70,13 @@ tf.app.flags.DEFINE_boolean("disable_shortlist", False, "Prevent the model from
 tf.app.flags.DEFINE_float("length_penalty", 0.12, "TF beam search length penalty hparam")
 
 tf.app.flags.DEFINE_integer("pg_burnin", 200, "Num steps to burn in reward whitening before updating")
+tf.app.flags.DEFINE_integer("reward_workers", 4, "Num threads used to run the reward models concurrently during PG training - 0 runs them one after another")
+tf.app.flags.DEFINE_integer("pg_max_staleness", 0, "Max number of updates a PG batch can lag behind the policy that sampled it. >0 overlaps sampling, reward scoring and updates - 0 runs them in lockstep")
+tf.app.flags.DEFINE_string("qa_gold_cache_path", "", "Path to a shelve db of QA predictions for the gold training questions, so they persist across runs - leave empty to cache in memory only")
+tf.app.flags.DEFINE_integer("qa_gold_cache_size", 100000, "Max number of gold QA predictions kept when qa_gold_cache_path is empty - the least recently used are dropped")
+tf.app.flags.DEFINE_boolean("model_host_process", False, "Run the LM, QA and discriminator models used for scoring in a separate worker process")
+tf.app.flags.DEFINE_integer("host_intra_op_threads", 0, "Intra-op threads for the scoring models with model_host_process - 0 splits the cores evenly between them")
+tf.app.flags.DEFINE_integer("host_inter_op_threads", 0, "Size of the inter-op thread pool shared by the scoring model sessions - 0 lets TF choose")
 tf.app.flags.DEFINE_boolean("pg_dropout", False, "Use dropout when generating the examples for policy gradient")
 
 tf.app.flags.DEFINE_float("lm_weight", 0.25, "Loss multiplier for LM in Maluuba model. Paper gives 0.1 alone or 0.25 joint")
@@ -88,6 +104,10 @@ tf.app.flags.DEFINE_float("lm_dropout", 0.3, "LM num epochs")
 
 # eval params
 tf.app.flags.DEFINE_integer("beam_width", 32, "Beam width for decoding")
+tf.app.flags.DEFINE_integer("decode_max_len", 40, "Default max number of decoding steps, including EOS")
+tf.app.flags.DEFINE_boolean("beam_early_stop", False, "Prune the unfinished beams for an example once none of them can beat its best finished beam, so beam search stops as soon as the results are settled")
+tf.app.flags.DEFINE_integer("nbest_size", 5, "Max number of beam hypotheses per example exposed by the n-best output of inference graphs (0 to disable)")
+tf.app.flags.DEFINE_string("decode_beam_widths", "", "Comma separated list of extra beam widths to build into inference graphs, eg '4,8'. Greedy and sampling decoders are always built")
 # tf.app.flags.DEFINE_integer("num_dev_samples", 4691, "How many examples to use for OOS evaluations")
 tf.app.flags.DEFINE_integer("num_dev_samples", 10570, "How many examples to use for OOS evaluations")
 # tf.app.flags.DEFINE_integer("num_eval_samples", 5609, "How many examples to use for evaluations")
@@ -96,3 +116,19 @@ tf.app.flags.DEFINE_boolean("eval_on_dev", True, "Should the eval script use the
 tf.app.flags.DEFINE_boolean("eval_on_test", False, "Should the eval script use the test set?")
 tf.app.flags.DEFINE_string("eval_model_id", "", "Run ID of the saved model to be evaluated")
 tf.app.flags.DEFINE_boolean("eval_metrics", True, "Calculate metrics when evaling - disable to speed up results generation")
+tf.app.flags.DEFINE_string("export_path", "", "Where to write the frozen inference graph - defaults to frozen_model.pb in the checkpoint dir")
+
+# demo server params
+tf.app.flags.DEFINE_boolean("demo_batching", False, "Collect concurrent demo requests into micro-batches before running the model")
+tf.app.flags.DEFINE_string("demo_decoder", "beam", "Decoder used by the demo - greedy, sample, beam (at beam_width) or beamN for any width in decode_beam_widths")
+tf.app.flags.DEFINE_float("demo_batch_window", 0.01, "Max time (s) to wait for more requests before running a batch")
+tf.app.flags.DEFINE_integer("demo_max_batch_size", 16, "Max number of requests per batch")
+tf.app.flags.DEFINE_integer("demo_preprocess_workers", 4, "Num workers used for preprocessing requests in the async demo server")
+tf.app.flags.DEFINE_boolean("demo_preprocess_processes", False, "Use a process pool rather than threads for preprocessing in the async demo server")
+tf.app.flags.DEFINE_integer("demo_max_inflight", 64, "Max requests in progress before the async demo server starts rejecting them")
+tf.app.flags.DEFINE_float("demo_keepalive_timeout", 75, "How long (s) the async demo server keeps idle connections open")
+tf.app.flags.DEFINE_integer("demo_cache_size", 1024, "Max number of generated questions to cache in the demo server - 0 disables the cache")
+tf.app.flags.DEFINE_float("demo_cache_ttl", 3600, "How long (s) to keep cached questions for - 0 means forever")
+tf.app.flags.DEFINE_string("demo_cache_path", "", "Path to a shelve db for persisting the demo cache across restarts - leave empty to keep it in memory only")
+tf.app.flags.DEFINE_integer("demo_cache_disk_size", 0, "Max number of generated questions to keep in the demo_cache_path db - 0 means 10x demo_cache_size")
+tf.app.flags.DEFINE_string("demo_frozen_model", "", "Serve from a frozen graph written by export.py rather than rebuilding the model from a checkpoint")
@@ -0,0 +1,88 @@
+import tensorflow as tf
+import numpy as np
+
+import helpers.ops as ops
+
+
+# The stock SampleEmbeddingHelper treats the decoder outputs as logits, but the copy layer outputs a probability
+# distribution (mixing the shortlist and copy softmaxes), so take logs before sampling. Zero prob tokens get -inf and
+# so are never picked.
+class ProbSampleEmbeddingHelper(tf.contrib.seq2seq.SampleEmbeddingHelper):
+    def sample(self, time, outputs, state, name=None):
+        logits = tf.log(outputs)
+        if self._softmax_temperature is not None:
+            logits = logits / self._softmax_temperature
+        return tf.cast(tf.multinomial(logits, 1, seed=self._seed)[:,0], tf.int32)
+
+# Total log prob of a batch of decoded sequences, given the output distributions at each step
+def sequence_log_prob(probs, ids, lengths):
+    mask = tf.sequence_mask(lengths, tf.shape(ids)[1], dtype=tf.float32)
+    token_probs = tf.reduce_sum(tf.one_hot(ids, depth=tf.shape(probs)[2])*probs, axis=2)
+    return tf.reduce_sum(ops.safe_log(token_probs)*mask, axis=1)
+
+# Parse a comma separated list of beam widths from a flag
+def parse_beam_widths(widths):
+    return sorted(set([int(w) for w in widths.split(',') if w.strip() != '']))
+
+# A beam search decoder that can stop early. Per example max lengths (a [batch] tensor of the max number of steps,
+# including EOS) cut that example's beams off once they're reached - the last token is replaced with EOS, so they look
+# the same as beams that finished by themselves. With stop_on_top_beams, an example's unfinished beams are also pruned
+# as soon as none of them can beat its best finished beam, so the batch stops once that's true for every example.
+class EarlyStoppingBeamSearchDecoder(tf.contrib.seq2seq.BeamSearchDecoder):
+    def __init__(self, *args, max_lengths=None, stop_on_top_beams=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._max_lengths = max_lengths
+        self._stop_on_top_beams = stop_on_top_beams
+
+    def _length_penalty(self, lengths):
+        return tf.pow((5. + tf.to_float(lengths))/6., self._length_penalty_weight)
+
+    def step(self, time, inputs, state, name=None):
+        outputs, next_state, next_inputs, finished = super().step(time, inputs, state, name=name)
+
+        if self._max_lengths is not None:
+            truncated = tf.logical_and(tf.logical_not(finished), tf.expand_dims(tf.greater_equal(time+1, self._max_lengths), axis=1))
+            end_tokens = tf.fill(tf.shape(outputs.predicted_ids), self._end_token)
+            outputs = outputs._replace(predicted_ids=tf.where(truncated, end_tokens, outputs.predicted_ids))
+            finished = tf.logical_or(finished, truncated)
+        next_state = next_state._replace(finished=finished)
+
+        if self._stop_on_top_beams and self._max_lengths is not None:
+            # Log probs only go down as a beam grows, and the length penalty is biggest at the max length, so an
+            # unfinished beam can never score more than its log prob now over the penalty at the max length. Once the
+            # best finished beam beats that for every unfinished beam, the result can't change (none of them can even
+            # push it out of the beam), so they're pruned.
+            no_score = tf.fill(tf.shape(next_state.log_probs), -np.inf)
+            best_finished = tf.reduce_max(tf.where(finished, next_state.log_probs/self._length_penalty(next_state.lengths), no_score), axis=1)
+            best_unfinished = tf.reduce_max(tf.where(finished, no_score, next_state.log_probs/tf.expand_dims(self._length_penalty(self._max_lengths), axis=1)), axis=1)
+            pruned = tf.logical_and(tf.logical_not(finished), tf.expand_dims(best_finished >= best_unfinished, axis=1))
+            # Pruned beams are only marked finished in the state, so they emit EOS on the next step (which the length
+            # then includes) instead of being cut off without one
+            next_state = next_state._replace(finished=tf.logical_or(finished, pruned))
+
+        return outputs, next_state, next_inputs, finished
+
+# The n-best hypotheses for one example, as fetched from model.q_hat_nbest. Hypotheses are only converted to words
+# when they're read, so callers that just want the top few (or only the scores) don't pay for the rest
+class NBestList():
+    def __init__(self, ids, lens, scores, context, vocab_table, context_as_set=False):
+        self.ids = ids
+        self.lens = lens
+        self.scores = scores
+        self.context = np.asarray(context, dtype=object)
+        self.vocab_table = vocab_table
+        self.context_as_set = context_as_set
+
+    def __len__(self):
+        return len(self.lens)
+
+    # The tokens of the i'th hypothesis, without the trailing EOS
+    def get_tokens(self, i):
+        ids = self.ids[i:i+1, :max(self.lens[i]-1, 0)]
+        return [w.decode() for w in ops.decode_ids(ids, self.context[None,:], self.vocab_table, self.context_as_set)[0]]
+
+    def __getitem__(self, i):
+        return " ".join(self.get_tokens(i))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
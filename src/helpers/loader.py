@@ -1,4 +1,4 @@
-import json
+import json, os
 
 import re
 from collections import defaultdict
@@ -12,27 +12,178 @@ EOS = '</Sent>'
 PAD='<PAD>'
 OOV='<OOV>'
 
-def load_squad_dataset(path, dev=False, test=False, v2=False):
-    expected_version = 'v2.0' if v2 else '1.1'
+# the tokenizer is stateless, so share one instance rather than building a new one per sentence
+_tokenizer = TreebankWordTokenizer()
+
+# A vocab is still a plain {word: id} dict (so it can be json dumped and used anywhere a dict was before), but it also
+# keeps a reverse list for decoding and can encode/decode whole batches at once
+class Vocab(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._rev = None
+
+    # anything that changes the mapping has to drop the cached reverse list
+    def __setitem__(self, word, id):
+        super().__setitem__(word, id)
+        self._rev = None
+
+    def __delitem__(self, word):
+        super().__delitem__(word)
+        self._rev = None
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._rev = None
+
+    def setdefault(self, word, id=None):
+        self._rev = None
+        return super().setdefault(word, id)
+
+    def pop(self, *args):
+        self._rev = None
+        return super().pop(*args)
+
+    def popitem(self):
+        self._rev = None
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self._rev = None
+
+    @property
+    def rev(self):
+        if self._rev is None:
+            rev = [None]*len(self)
+            for word, id in self.items():
+                rev[id] = word
+            self._rev = rev
+        return self._rev
+
+    def encode(self, word):
+        return self.get(word, self[OOV])
+
+    def decode(self, id):
+        return self.rev[id]
+
+    # Takes a list of token lists, returns a padded int32 array of ids and the lengths
+    def encode_batch(self, seqs, add_sos_eos=False):
+        oov = self[OOV]
+        if add_sos_eos:
+            seqs = [[SOS]+list(seq)+[EOS] for seq in seqs]
+        lengths = np.asarray([len(seq) for seq in seqs], dtype=np.int32)
+        ids = np.full([len(seqs), max(lengths) if len(seqs) > 0 else 0], self[PAD], dtype=np.int32)
+        for i, seq in enumerate(seqs):
+            ids[i, :lengths[i]] = [self.get(w, oov) for w in seq]
+        return ids, lengths
+
+    def decode_batch(self, ids, lengths=None):
+        rev = self.rev
+        return [[rev[id] for id in row[:(lengths[i] if lengths is not None else len(row))]] for i, row in enumerate(np.asarray(ids).tolist())]
+
+    # Write the words out in id order as a fixed width byte array, that can be memory mapped back in
+    def save(self, path):
+        np.save(path, np.asarray([w.encode() for w in self.rev], dtype=np.bytes_))
+
+    # The words are stored in id order, so they're already the reverse list. The file is memory mapped and decoded a
+    # chunk at a time, so the whole byte array never has to be read in (and copied to a list of bytes) up front
+    @classmethod
+    def load(cls, path, chunk_size=65536):
+        words = np.load(path, mmap_mode='r')
+        rev = []
+        for start in range(0, len(words), chunk_size):
+            rev.extend(w.decode() for w in words[start:start+chunk_size].tolist())
+        vocab = cls((w, id) for id, w in enumerate(rev))
+        vocab._rev = rev
+        return vocab
+
+def as_vocab(vocab):
+    return vocab if isinstance(vocab, Vocab) else Vocab(vocab)
+
+# Vocabs are never modified once trained, so all the models in a process can share one per checkpoint
+_vocabs = {}
+
+def load_vocab(chkpt_path):
+    key = os.path.realpath(chkpt_path)
+    if key not in _vocabs:
+        if os.path.exists(chkpt_path+'/vocab.npy'):
+            _vocabs[key] = Vocab.load(chkpt_path+'/vocab.npy')
+        else:
+            with open(chkpt_path+'/vocab.json', encoding="utf-8") as f:
+                _vocabs[key] = Vocab(json.load(f))
+    return _vocabs[key]
+
+# Save both formats - the json version is still what older code (and humans) expect to find
+def save_vocab(vocab, chkpt_path):
+    with open(chkpt_path+'/vocab.json', 'w', encoding="utf-8") as outfile:
+        json.dump(vocab, outfile)
+    as_vocab(vocab).save(chkpt_path+'/vocab.npy')
+
+def get_squad_filename(dev=False, test=False, v2=False):
     if v2:
-        filename = 'train-v2.0.json' if not dev else 'dev-v2.0.json'
+        return 'train-v2.0.json' if not dev else 'dev-v2.0.json'
     elif test and not dev:
-        filename = 'test-v1.1.json'
+        return 'test-v1.1.json'
     else:
-        filename = 'train-v1.1.json' if not dev else 'dev-v1.1.json'
-    with open(path+filename) as dataset_file:
-        dataset_json = json.load(dataset_file)
-        if (dataset_json['version'] != expected_version):
-            print('Expected SQuAD v-' + expected_version +
-                  ', but got dataset with v-' + dataset_json['version'])
-        dataset = dataset_json['data']
-        return(dataset)
+        return 'train-v1.1.json' if not dev else 'dev-v1.1.json'
+
+# Incrementally parse a SQuAD file, yielding one article at a time rather than loading the whole json tree into memory.
+# Anything outside the "data" list (ie the version) is collected into header, which is filled in once parsing finishes
+def iter_squad_articles(filename, header=None, chunk_size=2**20):
+    decoder = json.JSONDecoder()
+    with open(filename, encoding='utf-8') as fp:
+        buf = ''
+        # find the start of the data list
+        while True:
+            match = re.search(r'"data"\s*:\s*\[', buf)
+            if match is not None:
+                break
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                raise ValueError('Couldnt find SQuAD data list in '+filename)
+            buf += chunk
+        prefix = buf[:match.end()-1]
+        buf = buf[match.end():]
+        ix = 0
+        while True:
+            # skip to the start of the next article
+            while ix < len(buf) and (buf[ix].isspace() or buf[ix] == ','):
+                ix += 1
+            if ix == len(buf):
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    raise ValueError('Unexpected end of file in '+filename)
+                buf, ix = buf[ix:] + chunk, 0
+                continue
+            if buf[ix] == ']':
+                break
+            try:
+                article, end_ix = decoder.raw_decode(buf, ix)
+            except json.JSONDecodeError:
+                # the article isn't complete yet - read some more and try again
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    raise
+                buf, ix = buf[ix:] + chunk, 0
+                continue
+            yield article
+            ix = end_ix
+        if header is not None:
+            header.update(json.loads(prefix + '[]' + buf[ix+1:] + fp.read()))
+            del header['data']
 
-def load_squad_triples(path, dev=False, test=False, v2=False, as_dict=False, ans_list=False):
-    raw_data = load_squad_dataset(path, dev=dev, test=test, v2=v2)
-    triples=[] if not as_dict else {}
-    for doc in raw_data:
+def load_squad_dataset(path, dev=False, test=False, v2=False):
+    return list(iter_squad_articles(path+get_squad_filename(dev=dev, test=test, v2=v2)))
+
+# Lazily yield (id, para_ix, context, question, answer, answer_pos) for each question in a SQuAD file
+# para_ix is the index of the paragraph within the file. Questions on the same paragraph share one context string
+def iter_squad_questions(path, dev=False, test=False, v2=False, ans_list=False):
+    expected_version = 'v2.0' if v2 else '1.1'
+    header = {}
+    para_ix = -1
+    for doc in iter_squad_articles(path+get_squad_filename(dev=dev, test=test, v2=v2), header=header):
         for para in doc['paragraphs']:
+            para_ix += 1
             for qa in para['qas']:
                 id = qa['id']
                 # NOTE: this only takes the first answer per question! ToDo handle this more intelligently
@@ -44,15 +195,24 @@ def load_squad_triples(path, dev=False, test=False, v2=False, as_dict=False, ans
                     ans_pos = int(qa['answers'][0]['answer_start'])
                 if v2:
                     if qa['is_impossible']:
-                        el = (para['context'], qa['question'], qa['plausible_answers'][0]['text'] if not dev else "", int(qa['plausible_answers'][0]['answer_start']) if not dev else None, True)
+                        el = (qa['question'], qa['plausible_answers'][0]['text'] if not dev else "", int(qa['plausible_answers'][0]['answer_start']) if not dev else None, True)
                     else:
-                        el =  (para['context'], qa['question'], qa['answers'][0]['text'], int(qa['answers'][0]['answer_start']), False)
-                else:
-                    el =  (para['context'], qa['question'], ans_text, ans_pos)
-                if as_dict:
-                    triples[id] = el
+                        el =  (qa['question'], qa['answers'][0]['text'], int(qa['answers'][0]['answer_start']), False)
                 else:
-                    triples.append(el)
+                    el =  (qa['question'], ans_text, ans_pos)
+                yield (id, para_ix, para['context']) + el
+    if (header.get('version') != expected_version):
+        print('Expected SQuAD v-' + expected_version +
+              ', but got dataset with v-' + str(header.get('version')))
+
+def load_squad_triples(path, dev=False, test=False, v2=False, as_dict=False, ans_list=False):
+    triples=[] if not as_dict else {}
+    for id, para_ix, *el in iter_squad_questions(path, dev=dev, test=test, v2=v2, ans_list=ans_list):
+        el = tuple(el)
+        if as_dict:
+            triples[id] = el
+        else:
+            triples.append(el)
     return triples
 
 
@@ -117,7 +277,7 @@ def load_multiline(path, limit_length=32, vocab_size=5000):
 def get_vocab(corpus, vocab_size=2000):
     def tokenise(text):
         sents = [s for s in sent_tokenize(text)]
-        tokens = [tok.lower() for sent in sents for tok in TreebankWordTokenizer().tokenize(sent)]
+        tokens = [tok.lower() for sent in sents for tok in _tokenizer.tokenize(sent)]
         return tokens
     vocab = {PAD:0,OOV:1, SOS:2, EOS:3}
     word_count = defaultdict(float)
@@ -128,7 +288,7 @@ def get_vocab(corpus, vocab_size=2000):
     vocab_list = sorted(word_count, key=word_count.__getitem__,reverse=True)[:min(vocab_size,len(word_count))]
     for w in vocab_list:
         vocab[w] = len(vocab)
-    return vocab
+    return Vocab(vocab)
 
 
 
@@ -136,7 +296,7 @@ def get_glove_vocab(path, size=2000, d=200, variant='6B', filter_to_squad=False)
     # this is a copy of the function in preprocessing.py - but we can't use it as we'd get a circular import!
     def tokenise(text):
         sents = [s for s in sent_tokenize(text)]
-        tokens = [tok.lower() for sent in sents for tok in TreebankWordTokenizer().tokenize(sent)]
+        tokens = [tok.lower() for sent in sents for tok in _tokenizer.tokenize(sent)]
         return tokens
 
     vocab = {PAD:0,OOV:1, SOS:2, EOS:3}
@@ -148,17 +308,13 @@ def get_glove_vocab(path, size=2000, d=200, variant='6B', filter_to_squad=False)
             squad_words |= set(tokenise(triple[0]))
             squad_words |= set(tokenise(triple[1]))
             squad_words |= set(tokenise(triple[2]))
-    with open(path+'glove.'+variant+'/glove.'+variant+'.'+str(d)+'d.txt') as fp:
-        entries = fp.readlines()
-    for i,row in enumerate(entries):
+    glove = load_glove(path, d=d, variant=variant)
+    for word in glove.words:
         if len(vocab)-4>= size and size > 0:
             break
-        cols = row.strip().split(' ')
-        if len(cols) < d+1:
-            print(row)
-        if (filter_to_squad and cols[0] in squad_words) or not filter_to_squad:
-            vocab[cols[0]] = len(vocab)
-    return vocab
+        if (filter_to_squad and word in squad_words) or not filter_to_squad:
+            vocab[word] = len(vocab)
+    return Vocab(vocab)
 
 # def get_vocab(corpus, vocab_size=1000):
 #     lines = [re.sub(r'([\,\?\!\.]+)',r' \1 ', line).lower() for line in corpus]
@@ -241,34 +397,117 @@ def load_multiline_aligned(path_src, path_tgt, limit_length=32, vocab_size=1000)
 
     return id_arr_src, id_arr_tgt, vocab_src, vocab_tgt
 
+def get_glove_filename(path, d=200, variant='6B'):
+    return path+'glove.'+variant+'/glove.'+variant+'.'+str(d)+'d'
+
+# Parse the glove text file once, and write it out as a float32 matrix (.npy) plus a word list, so that later loads
+# can just memory map it. Rows with the wrong number of columns are skipped.
+def convert_glove(path, d=200, variant='6B'):
+    filename = get_glove_filename(path, d, variant)
+    with open(filename+'.txt', 'r', encoding='utf-8') as fp:
+        num_rows = sum(1 for _ in fp)
+
+    # write to temp files then move into place, so an interrupted conversion is never picked up
+    matrix = np.lib.format.open_memmap(filename+'.npy.tmp', mode='w+', dtype=np.float32, shape=(num_rows, d))
+    words = []
+    with open(filename+'.txt', 'r', encoding='utf-8') as fp:
+        for row in fp:
+            cols = row.rstrip().split(' ')
+            if len(cols) != d+1:
+                print(row)
+                continue
+            matrix[len(words)] = np.asarray(cols[1:], dtype=np.float32)
+            words.append(cols[0])
+    matrix.flush()
+    del matrix
+
+    # trim off any skipped rows
+    if len(words) < num_rows:
+        np.save(filename+'.npy.tmp2', np.load(filename+'.npy.tmp', mmap_mode='r')[:len(words)])
+        os.replace(filename+'.npy.tmp2.npy', filename+'.npy.tmp')
+
+    with open(filename+'.vocab.tmp', 'w', encoding='utf-8') as fp:
+        fp.write('\n'.join(words))
+    os.replace(filename+'.npy.tmp', filename+'.npy')
+    os.replace(filename+'.vocab.tmp', filename+'.vocab')
+
+# A read only, dict-like view of the glove vectors, backed by a memory mapped matrix. The OS page cache is shared, so
+# several processes can load the same store without each holding their own copy.
+class GloveStore():
+    def __init__(self, words, matrix):
+        self.words = words
+        self.matrix = matrix
+        self.index = {w: i for i, w in enumerate(words)}
+
+    @classmethod
+    def load(cls, path, d=200, variant='6B'):
+        filename = get_glove_filename(path, d, variant)
+        if not os.path.exists(filename+'.npy') or not os.path.exists(filename+'.vocab'):
+            print('Converting glove to binary format at ', filename+'.npy')
+            convert_glove(path, d, variant)
+        with open(filename+'.vocab', 'r', encoding='utf-8') as fp:
+            words = fp.read().split('\n')
+        matrix = np.load(filename+'.npy', mmap_mode='r')
+        return cls(words, matrix)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __getitem__(self, word):
+        return self.matrix[self.index[word]]
+
+    def get(self, word, default=None):
+        return self.matrix[self.index[word]] if word in self.index else default
+
+    def keys(self):
+        return self.index.keys()
+
+# Stores are read only, so keep one per file for the life of the process
+_glove_stores = {}
+
 def load_glove(path, d=200, variant='6B'):
-    glove = {}
-    with open(path+'glove.'+variant+'/glove.'+variant+'.'+str(d)+'d.txt', 'r+', encoding='utf-8') as fp:
-        entries = fp.readlines()
-    for row in entries:
-        cols = row.strip().split(' ')
-        if len(cols) < d+1:
-            print(row)
-        glove[cols[0]] = np.asarray(cols[1:], dtype=float)
-    return glove
-
-def get_embeddings(vocab, glove, D):
-    rev_vocab = {v:k for k,v in vocab.items()}
-    embeddings=[]
+    key = get_glove_filename(path, d, variant)
+    if key not in _glove_stores:
+        _glove_stores[key] = GloveStore.load(path, d, variant)
+    return _glove_stores[key]
+
+# The QANet and discriminator embedding matrices are stored as json, which is slow to parse. Convert each to .npy
+# the first time it's loaded, then memory map it, keeping one copy per file for the life of the process
+_emb_matrices = {}
+
+def load_emb_matrix(filename):
+    if filename not in _emb_matrices:
+        npy_filename = os.path.splitext(filename)[0]+'.npy'
+        if not os.path.exists(npy_filename) or os.path.getmtime(npy_filename) < os.path.getmtime(filename):
+            print('Converting embeddings to binary format at ', npy_filename)
+            with open(filename, 'r') as fp:
+                matrix = np.array(json.load(fp), dtype=np.float32)
+            np.save(npy_filename+'.tmp', matrix)
+            os.replace(npy_filename+'.tmp.npy', npy_filename)
+        _emb_matrices[filename] = np.load(npy_filename, mmap_mode='r')
+    return _emb_matrices[filename]
+
+def get_embeddings(vocab, glove, D, seed=None):
+    rev_vocab = as_vocab(vocab).rev
 
     # rand = np.random.normal(size=(len(vocab),D))
     # q,r = np.linalg.qr(rand)
     glorot_limit = np.sqrt(6 / (D + len(vocab)))
 
-    # clunky, but guarantees the order will be correct
-    for id in range(len(rev_vocab)):
-        word = rev_vocab[id]
-        if word in glove.keys():
-            embeddings.append(glove[word])
-        else:
-            # embeddings.append(q[id,:])
-            embeddings.append(np.random.uniform(-glorot_limit, glorot_limit, size=(D)).tolist())
-    return np.asarray(embeddings, dtype=np.float32)
+    # map each vocab id to its glove row (or -1 if it's missing) - iterating over ids guarantees the order will be correct
+    rows = np.asarray([glove.index.get(word, -1) for word in rev_vocab], dtype=np.int64)
+    found = rows >= 0
+
+    embeddings = np.empty((len(rows), D), dtype=np.float32)
+    embeddings[found] = glove.matrix[rows[found]]
+
+    # draw all the random rows for missing words in one go
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    embeddings[~found] = rng.uniform(-glorot_limit, glorot_limit, size=(np.sum(~found), D))
+    return embeddings
 
 if __name__ == "__main__":
     import sys
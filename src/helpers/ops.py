@@ -1,3 +1,5 @@
+import hashlib
+
 import tensorflow as tf
 import numpy as np
 from helpers.loader import EOS,PAD,OOV
@@ -11,41 +13,71 @@ def log2(x):
   denominator = tf.log(tf.constant(2, dtype=numerator.dtype))
   return numerator / denominator
 
+# Build the table of words that copy ids refer to, for each row of the context - either the context itself, or its
+# sorted set of unique tokens (excluding EOS and PAD), padded with PAD
+def get_copy_table(context, context_as_set=False):
+    if not context_as_set:
+        return context
+    pad = PAD.encode()
+    context_sets = [sorted(set(row)-{EOS.encode(), pad}) for row in context.tolist()]
+    copy_table = np.full([len(context_sets), max([len(row) for row in context_sets]+[1])], pad, dtype=object)
+    for i,row in enumerate(context_sets):
+        copy_table[i,:len(row)] = row
+    return copy_table
+
+# Vectorised conversion of a batch of ids (shortlist or copy) to words, outside of the graph. ids outside the valid
+# range for that row are returned as PAD
+def decode_ids(ids, context, vocab_table, context_as_set=False):
+    ids = np.asarray(ids)
+    vocab_table = np.asarray(vocab_table, dtype=object)
+    copy_table = get_copy_table(np.asarray(context, dtype=object), context_as_set)
+    vocab_size = len(vocab_table)
+
+    shortlist = vocab_table[np.clip(ids, 0, vocab_size-1)]
+    copy_ix = ids-vocab_size
+    copied = copy_table[np.arange(ids.shape[0])[:,None], np.clip(copy_ix, 0, copy_table.shape[1]-1)]
+    words = np.where(ids < vocab_size, shortlist, copied)
+    return np.where((ids < 0) | (copy_ix >= copy_table.shape[1]), PAD.encode(), words)
+
+def get_vocab_table(rev_vocab):
+    return np.asarray([w.encode() for w in rev_vocab], dtype=object)
+
 def ids_to_string(rev_vocab, context_as_set=False):
+    vocab_table = get_vocab_table(rev_vocab)
     def _ids_to_string(ids, context):
-        row_str=[]
-        for i,row in enumerate(ids):
-            # print(context[i])
-            context_tokens = [w.decode() for w in context[i].tolist()]
-            if context_as_set:
-                context_set = sorted(set(context_tokens)-{EOS,PAD})
-            out_str = []
-            for j in row:
-                if j <0:
-                    print("Negative token id!")
-                    print(row)
-                    exit()
-                elif j< len(rev_vocab):
-                    out_str.append(rev_vocab[j])
-                elif not context_as_set and j < len(rev_vocab)+len(context_tokens):
-                    out_str.append(context_tokens[j-len(rev_vocab)])
-                elif context_as_set and j < len(rev_vocab)+len(context_set):
-                    out_str.append(context_set[j-len(rev_vocab)])
-                else:
-                    print("Token ID out of range of vocab")
-                    print(j, len(rev_vocab), len(context_tokens))
-                    if context_as_set:
-                        print(len(context_set))
-
-            row_str.append(out_str)
-
-            # print(context_tokens)
-            # print(out_str)
-        return [row_str]
+        return decode_ids(ids, context, vocab_table, context_as_set)
     return _ids_to_string
 
+# One constant vocab table per graph, rather than one per call. It's kept in a collection on the graph itself (named by
+# the vocab contents), so it goes away with the graph
+def get_vocab_table_tensor(rev_vocab):
+    graph = tf.get_default_graph()
+    key = 'vocab_table_'+hashlib.sha1("\n".join(rev_vocab).encode()).hexdigest()
+    tables = graph.get_collection(key)
+    if len(tables) == 0:
+        with tf.device('/cpu:*'):
+            tables = [tf.constant(get_vocab_table(rev_vocab), dtype=tf.string)]
+        graph.add_to_collection(key, tables[0])
+    return tables[0]
+
+# Convert a tensor of ids to words. Without context_as_set, the copy ids are just positions in the context, so this
+# can be done with gathers in the graph. The set version needs a sorted set of unique context tokens per row, which
+# TF can't build, so that goes through numpy instead.
 def id_tensor_to_string(ids, rev_vocab, context, context_as_set=False):
-    return tf.py_func(ids_to_string(rev_vocab, context_as_set), [ids, context], tf.string)
+    if context_as_set:
+        return tf.py_func(ids_to_string(rev_vocab, context_as_set), [ids, context], tf.string, stateful=False)
+
+    vocab_size = len(rev_vocab)
+    shortlist = tf.gather(get_vocab_table_tensor(rev_vocab), tf.clip_by_value(ids, 0, vocab_size-1))
+
+    copy_ix = ids - vocab_size
+    context_len = tf.shape(context)[1]
+    batch_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(ids)[0]), axis=1), [1, tf.shape(ids)[1]])
+    copied = tf.gather_nd(context, tf.stack([batch_ix, tf.clip_by_value(copy_ix, 0, context_len-1)], axis=2))
+
+    words = tf.where(ids < vocab_size, shortlist, copied)
+    invalid = tf.logical_or(ids < 0, copy_ix >= context_len)
+    return tf.where(invalid, tf.fill(tf.shape(ids), PAD), words)
 
 # This is v similar to lookup_vocab(), but works on tensors and doesnt use a context
 def string_to_ids(vocab):
@@ -55,10 +87,7 @@ def string_to_ids(vocab):
             ids_row=[]
             for w in row:
                 w=w.decode()
-                if w in vocab.keys():
-                    ids_row.append(vocab[w])
-                else:
-                    ids_row.append(vocab[OOV])
+                ids_row.append(vocab.get(w, vocab[OOV]))
             ids.append(ids_row)
         return np.asarray(ids, dtype=np.int32)
     return _string_to_ids
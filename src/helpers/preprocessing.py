@@ -1,10 +1,19 @@
 import numpy as np
 import string
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from functools import lru_cache
 # import tensorflow as tf
 
 from nltk.tokenize import TreebankWordTokenizer, sent_tokenize
 use_nltk = True
 
+# the tokenizer is stateless, so share one instance rather than building a new one per sentence
+_tokenizer = TreebankWordTokenizer()
+
+# max number of distinct texts to keep the tokenisation of
+TOKENISE_CACHE_SIZE = 16384
+
 from helpers.loader import OOV, PAD, EOS, SOS
 
 # def get_2d_spans(text, tokenss):
@@ -36,77 +45,83 @@ from helpers.loader import OOV, PAD, EOS, SOS
 #     return idxs[0], (idxs[-1][0], idxs[-1][1] + 1)
 
 
+# Of a sorted list of positions, find the one nearest to pos - ties go to the earlier position
+def nearest_position(positions, pos):
+    i = bisect_left(positions, pos)
+    if i == 0:
+        return positions[0]
+    if i == len(positions):
+        return positions[-1]
+    return positions[i-1] if pos-positions[i-1] <= positions[i]-pos else positions[i]
+
 def lookup_vocab(words, vocab, context=None, ans_tok_pos=None, do_tokenise=True, append_eos=False, context_as_set=False, copy_priority=False, asbytes=True, smart_copy=True, find_all=False ):
     ids = []
 
     decoded_context = [w.decode() if asbytes else w for w in tokenise(context)] if context is not None else []
     words = [w.decode() if asbytes else w for w in tokenise(words)] if do_tokenise else [w.decode() if asbytes else w for w in words]
+
+    # Build lookups once per context, so that resolving each word is O(1) rather than a scan over the context
+    context_positions = {}
+    for i,w in enumerate(decoded_context):
+        context_positions.setdefault(w, []).append(i)
     if context_as_set:
-        context_set = sorted(set(decoded_context))
+        context_set = sorted(context_positions.keys())
+        context_set_rank = {w:i for i,w in enumerate(context_set)}
+
+    # Decide where to copy w from
+    def _copy_ix(w, use_heuristics):
+        positions = context_positions[w]
+        if use_heuristics and len(positions) > 1 and ans_tok_pos is not None:
+            # Multiple options, either pick the one that flows from previous, or pick the nearest to answer
+            if len(ids) > 0 and ids[-1]>=len(vocab) and len(decoded_context)>=ids[-1]-len(vocab)+2 and decoded_context[ids[-1]-len(vocab)+1] == w:
+                return ids[-1]-len(vocab)+1
+            else:
+                return nearest_position(positions, ans_tok_pos)
+        else:
+            return positions[0]
 
     for w in words:
+        in_context = context is not None and not context_as_set and w in context_positions
+        in_context_set = context is not None and context_as_set and w in context_positions
         # Use a few heuristics to decide where to copy from
         if find_all:
             this_ids=[]
-            if context is not None and not context_as_set and w in decoded_context:
-                indices = [i+len(vocab) for i, x in enumerate(decoded_context) if x == w]
-                this_ids.extend(indices)
-            if context is not None and context_as_set and w in context_set:
-                this_ids.append(len(vocab) + context_set.index(w))
-            if w in vocab.keys():
+            if in_context:
+                this_ids.extend([i+len(vocab) for i in context_positions[w]])
+            if in_context_set:
+                this_ids.append(len(vocab) + context_set_rank[w])
+            if w in vocab:
                 this_ids.append(vocab[w])
             if len(this_ids) ==0 :
                 this_ids.append(vocab[OOV])
             ids.append(this_ids)
         elif copy_priority and smart_copy:
-            if context is not None and not context_as_set and w in decoded_context:
-                if decoded_context.count(w) > 1 and ans_tok_pos is not None:
-                    # Multiple options, either pick the one that flows from previous, or pick the nearest to answer
-                    if len(ids) > 0 and ids[-1]>=len(vocab) and len(decoded_context)>=ids[-1]-len(vocab)+2 and decoded_context[ids[-1]-len(vocab)+1] == w:
-                        copy_ix = ids[-1]-len(vocab)+1
-                    else:
-                        indices = [i for i, x in enumerate(decoded_context) if x == w]
-                        distances = [abs(ix-ans_tok_pos) for ix in indices]
-                        copy_ix=indices[np.argmin(distances)]
-                else:
-                    copy_ix = decoded_context.index(w)
-                ids.append(len(vocab) + copy_ix)
-            elif context is not None and context_as_set and w in context_set:
-                ids.append(len(vocab) + context_set.index(w))
-            elif w in vocab.keys():
+            if in_context:
+                ids.append(len(vocab) + _copy_ix(w, True))
+            elif in_context_set:
+                ids.append(len(vocab) + context_set_rank[w])
+            elif w in vocab:
                 ids.append(vocab[w])
             else:
                 ids.append(vocab[OOV])
         # Copy using first occurence
         elif copy_priority:
-            if context is not None and not context_as_set and w in decoded_context:
-                ids.append(len(vocab) + decoded_context.index(w))
-            elif context is not None and context_as_set and w in context_set:
-                ids.append(len(vocab) + context_set.index(w))
-                # print(len(context_set), len(vocab) + context_set.index(w))
-            elif w in vocab.keys():
+            if in_context:
+                ids.append(len(vocab) + _copy_ix(w, False))
+            elif in_context_set:
+                ids.append(len(vocab) + context_set_rank[w])
+            elif w in vocab:
                 ids.append(vocab[w])
             else:
                 ids.append(vocab[OOV])
         # Shortlist priority
         else:
-            if w in vocab.keys():
+            if w in vocab:
                 ids.append(vocab[w])
-            elif context is not None and not context_as_set and w in decoded_context:
-                if smart_copy and decoded_context.count(w) > 1 and ans_tok_pos is not None:
-                    # Multiple options, either pick the one that flows from previous, or pick the nearest to answer
-                    if len(ids) > 0 and ids[-1]>=len(vocab) and len(decoded_context)>=ids[-1]-len(vocab)+2 and decoded_context[ids[-1]-len(vocab)+1] == w:
-                        copy_ix = ids[-1]-len(vocab)+1
-                    else:
-                        indices = [i for i, x in enumerate(decoded_context) if x == w]
-                        distances = [abs(ix-ans_tok_pos) for ix in indices]
-                        copy_ix=indices[np.argmin(distances)]
-                else:
-                    copy_ix = decoded_context.index(w)
-                ids.append(len(vocab) + copy_ix)
-            elif context is not None and context_as_set and w in context_set:
-                ids.append(len(vocab) + context_set.index(w))
-                # print(len(context_set), len(vocab) + context_set.index(w))
+            elif in_context:
+                ids.append(len(vocab) + _copy_ix(w, smart_copy))
+            elif in_context_set:
+                ids.append(len(vocab) + context_set_rank[w])
             else:
                 ids.append(vocab[OOV])
     if append_eos:
@@ -131,13 +146,28 @@ def lookup_vocab(words, vocab, context=None, ans_tok_pos=None, do_tokenise=True,
 #         print(key)
 #         return expanded.index(key)
 
+# Everything we need to know about how a piece of text tokenises: the sentences and their char offsets, the
+# (lowercased) tokens, and the char spans of the tokens both per sentence and flattened
+TokenisedText = namedtuple('TokenisedText', ['sents', 'offsets', 'tokens', 'sent_spans', 'spans', 'span_ends'])
+
+# The same contexts get tokenised many times over (once per question, and several times per example), so do the
+# work once per distinct text and cache it
+@lru_cache(maxsize=TOKENISE_CACHE_SIZE)
+def analyse_text(text):
+    sents = [s for s in sent_tokenize(text)]
+    offsets = []
+    for i,sent in enumerate(sents):
+        offsets.append(text.find(sent, offsets[i-1]+len(sents[i-1]) if i>0 else 0))
+    tokens = tuple(tok.lower() for sent in sents for tok in _tokenizer.tokenize(sent))
+    sent_spans = tuple(tuple((span[0]+offsets[i], span[1]+offsets[i]) for span in _tokenizer.span_tokenize(sent)) for i,sent in enumerate(sents))
+    spans = tuple(span for sent in sent_spans for span in sent)
+    return TokenisedText(tuple(sents), tuple(offsets), tokens, sent_spans, spans, tuple(span[1] for span in spans))
+
 def tokenise(text, asbytes=True, append_eos=False):
 
     text = text.decode() if asbytes else text
     if use_nltk:
-        sents = [s for s in sent_tokenize(text)]
-
-        tokens = [tok.lower() for sent in sents for tok in TreebankWordTokenizer().tokenize(sent)]
+        tokens = analyse_text(text).tokens
     else:
         for char in string.punctuation+'()-–':
             text = text.replace(char, ' '+char+' ')
@@ -153,18 +183,11 @@ def char_pos_to_word(text, tokens, char_pos, asbytes=True):
     ix=0
     text=text.decode() if asbytes else text
     if use_nltk:
-        sents = [s for s in sent_tokenize(text)]
-        spans = [[s for s in TreebankWordTokenizer().span_tokenize(sent)] for sent in sents]
-        # lens = [len(sent)+1  for sent in sents]
-        offsets = []
-        for i,sent in enumerate(sents):
-            offsets.append(text.find(sent, offsets[i-1]+len(sents[i-1]) if i>0 else 0)) # can we do this faster?
-        spans = [(span[0]+offsets[i], span[1]+offsets[i]) for i,sent in enumerate(spans) for span in sent]
-        # print(char_pos)
-        for ix,s in enumerate(spans):
-            # print(s, tokens[ix])
-            if s[1] > char_pos:
-                return ix
+        # find the first token that ends after char_pos
+        span_ends = analyse_text(text).span_ends
+        ix = bisect_right(span_ends, char_pos)
+        if ix < len(span_ends):
+            return ix
         print('couldnt find the char pos via nltk')
         print(text, char_pos, len(text))
     else:
@@ -183,17 +206,8 @@ def char_pos_to_word(text, tokens, char_pos, asbytes=True):
 
 # Filter a complete context down to the sentence containing the start of the answer span
 def filter_context(ctxt, char_pos, window_size_before=0, window_size_after=0, max_tokens=-1):
-    sents = [s for s in sent_tokenize(ctxt)]
-    spans = [[s for s in TreebankWordTokenizer().span_tokenize(sent)] for sent in sents]
-    # lens = [len(sent)+1  for sent in sents]
-    offsets = []
-    for i,sent in enumerate(sents):
-        # print(ctxt.find(sent, offsets[i-1]+len(sents[i-1]) if i>0 else 0))
-        # print(len(sents[i-1]) if i>0 else 0)
-        # print(offsets[i-1] if i>0 else 0)
-        # print(offsets[i-1]+len(sents[i-1]) if i>0 else 0)
-        offsets.append(ctxt.find(sent, offsets[i-1]+len(sents[i-1]) if i>0 else 0)) # can we do this faster?
-    spans = [[(span[0]+offsets[i], span[1]+offsets[i]) for span in sent] for i,sent in enumerate(spans) ]
+    analysed = analyse_text(ctxt)
+    sents, offsets, spans = analysed.sents, analysed.offsets, analysed.sent_spans
     for ix,sent in enumerate(spans):
         # print(sent[0][0], sent[-1][1], char_pos)
         if char_pos >= sent[0][0] and char_pos < sent[-1][1]:
@@ -203,7 +217,7 @@ def filter_context(ctxt, char_pos, window_size_before=0, window_size_after=0, ma
             # new_ix=char_pos-offsets[start]
             # print(new_ix)
             # print(" ".join(sents[start:end+1])[new_ix:new_ix+10])
-            flat_spans=[span for sen in spans for span in sen]
+            flat_spans=analysed.spans
             if max_tokens > -1 and len([span for sen in spans[start:end+1] for span in sen]) > max_tokens:
                 for i,span in enumerate(flat_spans):
                     if char_pos < span[1]:
@@ -247,6 +261,17 @@ def process_squad_context(vocab, context_as_set=False):
 
     return _process_squad_context
 
+# Build a [len x k] matrix of target ids, padded with -1. Each row holds all the valid ids for that token - for
+# a normal one-hot target k=1, but with a latent switch a token may be both copyable and in the shortlist.
+# The (many-)hot distribution can then be built on device, rather than shipping a [len x vocab+copy] matrix around
+def get_target_ids(ids):
+    ids = [np.atleast_1d(x) for x in ids]
+    max_alts = max([len(x) for x in ids]) if len(ids) > 0 else 1
+    target_ids = np.full([len(ids), max_alts], -1, dtype=np.int32)
+    for i,x in enumerate(ids):
+        target_ids[i, :len(x)] = x
+    return target_ids
+
 def process_squad_question(vocab, max_copy_size, context_as_set=False, copy_priority=False, smart_copy=True, latent_switch=False):
     def _process_squad_question(question, context, ans_loc):
         ans_tok_pos=char_pos_to_word(context, tokenise(context), ans_loc)
@@ -254,15 +279,10 @@ def process_squad_question(vocab, max_copy_size, context_as_set=False, copy_prio
         question_len = np.asarray(len(question_ids), dtype=np.int32)
         if latent_switch:
             all_ids = lookup_vocab(question, vocab, context=context, ans_tok_pos=ans_tok_pos, append_eos=True, context_as_set=context_as_set, copy_priority=copy_priority, smart_copy=smart_copy, find_all=True)
-            # print(all_ids)
-            question_oh = np.asarray([np.sum(np.eye(len(vocab)+max_copy_size, dtype=np.float32)[ids], axis=0) for ids in all_ids], dtype=np.float32)
-            # print(np.shape(np.eye(len(vocab)+max_copy_size, dtype=np.float32)[all_ids[0]]))
-            # print(all_ids)
-            # print(np.shape(question_oh))
-            # exit()
+            question_target_ids = get_target_ids(all_ids)
         else:
-            question_oh = np.eye(len(vocab)+max_copy_size, dtype=np.float32)[question_ids]
-        return [tokenise(question,append_eos=True), question_ids, question_oh, question_len]
+            question_target_ids = get_target_ids(question_ids)
+        return [tokenise(question,append_eos=True), question_ids, question_target_ids, question_len]
     return _process_squad_question
 
 def process_squad_answer(vocab, context_as_set=False):
@@ -277,3 +297,40 @@ def process_squad_answer(vocab, context_as_set=False):
 
         return [tokenise(answer,append_eos=False), answer_ids, answer_len, answer_locs]
     return _process_squad_answer
+
+# Pad a list of variable length arrays (1D, or 2D ragged in both dims) into a single array, matching tf's padded_batch
+def pad_sequences(seqs, pad_value, dtype=np.int32):
+    seqs = [np.asarray(s, dtype=dtype if dtype is not object else None) for s in seqs]
+    shape = [len(seqs)] + [max([np.shape(s)[d] for s in seqs]+[0]) for d in range(np.ndim(seqs[0]) if len(seqs) > 0 else 1)]
+    padded = np.full(shape, pad_value, dtype=dtype)
+    for i,s in enumerate(seqs):
+        padded[(i,)+tuple(slice(0,d) for d in np.shape(s))] = s
+    return padded
+
+# Build a PG batch - every component is duplicated, then the question in the first half is replaced by the sampled
+# one (so the first half gets the policy gradient and the second the usual XE loss). Padding matches the streamer,
+# and the sampled questions' target ids use a single alternative per token.
+# schema is (c,q,a,ix) and (raw,ids,len,?ans_pos)
+def duplicate_batch_and_inject(batch, pred_q_ids, pred_q_str, pred_q_lens):
+    context, question, answer, ix = batch
+    q_raw, q_ids, q_target_ids, q_len = question
+    batch_size = len(q_len)
+    pred_q_ids = np.asarray(pred_q_ids, dtype=np.int32)
+    pred_q_str = np.asarray(pred_q_str, dtype=object)
+
+    new_raw = np.full([2*batch_size, max(pred_q_str.shape[1], q_raw.shape[1])], PAD.encode(), dtype=object)
+    new_raw[:batch_size, :pred_q_str.shape[1]] = pred_q_str
+    new_raw[batch_size:, :q_raw.shape[1]] = q_raw
+
+    new_ids = np.zeros([2*batch_size, max(pred_q_ids.shape[1], q_ids.shape[1])], dtype=np.int32)
+    new_ids[:batch_size, :pred_q_ids.shape[1]] = pred_q_ids
+    new_ids[batch_size:, :q_ids.shape[1]] = q_ids
+
+    # pad with -1, which gets mapped to an all zero target
+    new_target_ids = np.full([2*batch_size, max(pred_q_ids.shape[1], q_target_ids.shape[1]), max(q_target_ids.shape[2], 1)], -1, dtype=np.int32)
+    new_target_ids[:batch_size, :pred_q_ids.shape[1], 0] = pred_q_ids
+    new_target_ids[batch_size:, :q_target_ids.shape[1], :q_target_ids.shape[2]] = q_target_ids
+
+    new_question = (new_raw, new_ids, new_target_ids, np.concatenate([np.asarray(pred_q_lens, dtype=np.int32), np.asarray(q_len, dtype=np.int32)]))
+    duplicate = lambda x: np.concatenate([x, x], axis=0)
+    return (tuple(duplicate(x) for x in context), new_question, tuple(duplicate(x) for x in answer), duplicate(ix))
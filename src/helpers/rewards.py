@@ -0,0 +1,146 @@
+import os, shelve, threading, hashlib, json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import helpers.metrics as metrics
+
+# Identifies a checkpoint - its path, plus when it was written in case it's been overwritten in place
+def get_checkpoint_id(chkpt_id):
+    if chkpt_id is None:
+        return ""
+    index_file = chkpt_id+'.index'
+    return chkpt_id + ('@'+str(os.path.getmtime(index_file)) if os.path.exists(index_file) else '')
+
+# QA predictions for the gold questions only depend on the example and the (frozen) QA model, so only need working out
+# once per example rather than every epoch. Entries are keyed by a hash of the QA model id and the context, question
+# and answer as the scorer sees them, so a change to the dataset, the preprocessing or the QA checkpoint never picks up
+# a stale prediction. They're kept in a shelve db if path is set, so they survive restarts - otherwise they're kept in
+# memory, and only the max_size most recently used are held on to.
+class GoldQACache():
+    def __init__(self, path=None, model_id="", max_size=100000):
+        self.entries = shelve.open(path) if path else OrderedDict()
+        self.model_id = model_id
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_key(self, context, question, answer):
+        return hashlib.sha1(json.dumps([self.model_id, context, question, answer]).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if isinstance(self.entries, OrderedDict):
+                    self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, pred, f1):
+        with self.lock:
+            self.entries[key] = (pred, f1)
+            if isinstance(self.entries, OrderedDict):
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+    def sync(self):
+        if hasattr(self.entries, 'sync'):
+            self.entries.sync()
+
+    def close(self):
+        if hasattr(self.entries, 'close'):
+            self.entries.close()
+
+# Runs the reward models for a batch of generated questions concurrently. Each model has its own tf.Session, and
+# session.run releases the GIL, so the scoring for a PG step takes as long as the slowest model rather than the sum
+# of all of them. With num_workers=0 everything runs in order on the calling thread. If the discriminator is being
+# trained as well, train it through train_discriminator, so a training step never overlaps with it scoring a batch.
+class RewardScorer():
+    def __init__(self, lm, qa, discriminator=None, num_workers=4, gold_cache=None):
+        self.lm = lm
+        self.qa = qa
+        self.discriminator = discriminator
+        self.gold_cache = gold_cache
+        self.pool = ThreadPoolExecutor(num_workers) if num_workers > 0 else None
+        self.disc_lock = threading.Lock()
+
+    def _submit(self, fn, *args):
+        if self.pool is None:
+            return _Done(fn(*args))
+        return self.pool.submit(fn, *args)
+
+    # Returns a dict of per example rewards: 'lm' (negative perplexity, so higher is better), 'qa' (F1 of the answer
+    # the QA model finds using the generated question) and 'disc', plus 'qa_pred' and 'qa_pred_gold', the answers found
+    # using the generated and gold questions, and 'qa_gold', the F1 using the gold question. If there's a gold cache,
+    # the gold question is only run through QA on a cache miss.
+    def get_rewards(self, pred_str, gold_q_str, contexts, ans_text, ans_pos, gold_ans_str):
+        futures = {
+            'lm': self._submit(self.lm.get_seq_perplexity, pred_str),
+            'qa_pred': self._submit(self.qa.get_ans, contexts, pred_str),
+        }
+        if self.gold_cache is not None:
+            gold_keys = [self.gold_cache.get_key(contexts[b], gold_q_str[b], gold_ans_str[b]) for b in range(len(pred_str))]
+            gold_cached = [self.gold_cache.get(key) for key in gold_keys]
+            gold_missing = [b for b, entry in enumerate(gold_cached) if entry is None]
+            if len(gold_missing) > 0:
+                futures['qa_pred_gold'] = self._submit(self.qa.get_ans, [contexts[b] for b in gold_missing], [gold_q_str[b] for b in gold_missing])
+        else:
+            gold_cached = [None]*len(pred_str)
+            gold_missing = list(range(len(pred_str)))
+            futures['qa_pred_gold'] = self._submit(self.qa.get_ans, contexts, gold_q_str)
+        if self.discriminator is not None:
+            futures['disc'] = self._submit(self._get_disc_pred, contexts, pred_str, ans_text, ans_pos)
+
+        # raises the first exception from any of the scorers
+        results = {name: future.result() for name, future in futures.items()}
+
+        results['lm'] = (-1*results['lm']).tolist() # lower perplexity is better
+        results['qa'] = [metrics.f1(metrics.normalize_answer(gold_ans_str[b]), metrics.normalize_answer(results['qa_pred'][b])) for b in range(len(pred_str))]
+
+        for b, pred in zip(gold_missing, results.get('qa_pred_gold', [])):
+            gold_cached[b] = (pred, metrics.f1(metrics.normalize_answer(gold_ans_str[b]), metrics.normalize_answer(pred)))
+            if self.gold_cache is not None:
+                self.gold_cache.put(gold_keys[b], *gold_cached[b])
+        if self.gold_cache is not None and len(gold_missing) > 0:
+            self.gold_cache.sync()
+        results['qa_pred_gold'], results['qa_gold'] = [list(x) for x in zip(*gold_cached)]
+        return results
+
+    def _get_disc_pred(self, *args):
+        with self.disc_lock:
+            return self.discriminator.get_pred(*args)
+
+    def train_discriminator(self, *args, **kwargs):
+        with self.disc_lock:
+            return self.discriminator.train_step(*args, **kwargs)
+
+    def save_discriminator(self, *args, **kwargs):
+        with self.disc_lock:
+            return self.discriminator.save_to_chkpt(*args, **kwargs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        if self.gold_cache is not None:
+            self.gold_cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Stands in for a Future when running inline
+class _Done():
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
@@ -0,0 +1,57 @@
+import pytest
+import numpy as np
+
+tf = pytest.importorskip('tensorflow')
+
+from helpers import decoding
+
+VOCAB_SIZE = 8
+EOS = 1
+UNITS = 16
+
+# Run a small beam search with fixed random weights - eos_bias makes EOS more or less likely
+def run_beam_search(max_len, stop_on_top_beams, length_penalty, eos_bias=0.0, batch_size=4, beam_width=3, seed=0):
+    rng = np.random.RandomState(seed)
+    init_state = rng.randn(batch_size, UNITS).astype(np.float32)
+    bias = np.zeros([VOCAB_SIZE], dtype=np.float32)
+    bias[EOS] = eos_bias
+
+    graph = tf.Graph()
+    with graph.as_default():
+        # op level seeds, so both runs get the same weights
+        cell = tf.nn.rnn_cell.GRUCell(UNITS, kernel_initializer=tf.random_normal_initializer(seed=seed))
+        output_layer = tf.layers.Dense(VOCAB_SIZE, kernel_initializer=tf.random_normal_initializer(stddev=2.0, seed=seed+1), bias_initializer=tf.constant_initializer(bias))
+        decoder = decoding.EarlyStoppingBeamSearchDecoder(cell=cell,
+                                                          embedding=tf.eye(VOCAB_SIZE),
+                                                          start_tokens=tf.zeros([batch_size], dtype=tf.int32),
+                                                          end_token=EOS,
+                                                          initial_state=tf.contrib.seq2seq.tile_batch(tf.constant(init_state), multiplier=beam_width),
+                                                          beam_width=beam_width,
+                                                          output_layer=output_layer,
+                                                          length_penalty_weight=length_penalty,
+                                                          max_lengths=tf.fill([batch_size], max_len),
+                                                          stop_on_top_beams=stop_on_top_beams)
+        outputs, state, lens = tf.contrib.seq2seq.dynamic_decode(decoder, impute_finished=False, maximum_iterations=max_len)
+        with tf.Session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            return sess.run([outputs.predicted_ids, lens, state.log_probs])
+
+@pytest.mark.parametrize('length_penalty', [0.0, 1.0])
+def test_early_stop_matches_full_search(length_penalty):
+    ids, lens, scores = run_beam_search(12, False, length_penalty)
+    es_ids, es_lens, es_scores = run_beam_search(12, True, length_penalty)
+
+    assert es_ids.shape[1] <= ids.shape[1]
+    for b in range(len(lens)):
+        assert es_lens[b,0] == lens[b,0]
+        np.testing.assert_array_equal(es_ids[b,:es_lens[b,0],0], ids[b,:lens[b,0],0])
+        np.testing.assert_allclose(es_scores[b,0], scores[b,0], rtol=1e-5)
+
+def test_truncated_beams_end_with_eos():
+    # EOS is never picked by itself, so every beam gets cut off at the max length
+    ids, lens, _ = run_beam_search(4, False, 0.0, eos_bias=-100.0)
+
+    assert ids.shape[1] == 4
+    assert np.all(lens == 4)
+    assert np.all(ids[:,3,:] == EOS)
+    assert np.all(ids[:,:3,:] != EOS)
@@ -0,0 +1,39 @@
+import numpy as np
+
+from helpers import loader
+
+def get_vocab():
+    return loader.Vocab({w: i for i,w in enumerate([loader.PAD, loader.OOV, loader.SOS, loader.EOS, 'the', 'cat', 'héllo'])})
+
+def test_save_load_round_trip(tmpdir):
+    vocab = get_vocab()
+    path = str(tmpdir.join('vocab.npy'))
+    vocab.save(path)
+    loaded = loader.Vocab.load(path, chunk_size=3)
+    assert loaded == vocab
+    assert loaded.rev == vocab.rev
+    assert loaded.decode(6) == 'héllo'
+
+def test_encode_decode_batch():
+    vocab = get_vocab()
+    ids, lens = vocab.encode_batch([['the', 'cat'], ['dog']], add_sos_eos=True)
+    np.testing.assert_array_equal(lens, [4, 3])
+    np.testing.assert_array_equal(ids, [[2, 4, 5, 3], [2, 1, 3, 0]])
+    assert vocab.decode_batch(ids, lens) == [[loader.SOS, 'the', 'cat', loader.EOS], [loader.SOS, loader.OOV, loader.EOS]]
+
+def test_rev_follows_changes():
+    vocab = get_vocab()
+    assert vocab.rev[5] == 'cat'
+    vocab['dog'] = 7
+    assert vocab.rev[7] == 'dog'
+    vocab.update({'bird': 8})
+    assert vocab.decode(8) == 'bird'
+    vocab.pop('bird')
+    assert len(vocab.rev) == 8
+    vocab.setdefault('fish', 8)
+    assert vocab.rev[-1] == 'fish'
+    del vocab['fish']
+    vocab.popitem()
+    assert vocab.rev == get_vocab().rev
+    vocab.clear()
+    assert vocab.rev == []
@@ -0,0 +1,24 @@
+import pytest
+import numpy as np
+
+tf = pytest.importorskip('tensorflow')
+
+from helpers import ops
+from helpers.loader import PAD
+
+def test_decode_ids():
+    vocab_table = ops.get_vocab_table([PAD, 'a', 'b'])
+    context = np.asarray([[b'x', b'y'], [b'z', PAD.encode()]], dtype=object)
+    ids = np.asarray([[1, 3, 4, -1], [2, 3, 9, 0]])
+    words = ops.decode_ids(ids, context, vocab_table)
+
+    # ids past the end of the vocab copy from the context, anything out of range comes out as padding
+    np.testing.assert_array_equal(words[0], [b'a', b'x', b'y', PAD.encode()])
+    np.testing.assert_array_equal(words[1], [b'b', b'z', PAD.encode(), PAD.encode()])
+
+def test_decode_ids_context_as_set():
+    vocab_table = ops.get_vocab_table([PAD, 'a', 'b'])
+    context = np.asarray([[b'y', b'x', b'y']], dtype=object)
+    # copy ids index the sorted unique context tokens instead
+    words = ops.decode_ids([[3, 4, 5]], context, vocab_table, context_as_set=True)
+    np.testing.assert_array_equal(words[0], [b'x', b'y', PAD.encode()])
@@ -0,0 +1,41 @@
+import numpy as np
+
+from helpers import preprocessing
+from helpers.loader import PAD
+
+def test_get_target_ids_pads_alternatives():
+    res = preprocessing.get_target_ids([3, [4, 5], np.asarray([6, 7, 8])])
+    assert res.dtype == np.int32
+    np.testing.assert_array_equal(res, [[3, -1, -1], [4, 5, -1], [6, 7, 8]])
+
+def test_get_target_ids_empty():
+    assert preprocessing.get_target_ids([]).shape == (0, 1)
+
+def get_batch(batch_size=2, q_len=3, k=2):
+    context = (np.full([batch_size, 4], b'c', dtype=object), np.ones([batch_size, 4], dtype=np.int32), np.full([batch_size], 4, dtype=np.int32))
+    question = (np.full([batch_size, q_len], b'g', dtype=object), np.full([batch_size, q_len], 7, dtype=np.int32),
+                np.full([batch_size, q_len, k], 7, dtype=np.int32), np.full([batch_size], q_len, dtype=np.int32))
+    answer = (np.full([batch_size, 1], b'a', dtype=object), np.full([batch_size], 1, dtype=np.int32))
+    return context, question, answer, np.arange(batch_size)
+
+def test_duplicate_batch_and_inject():
+    pred_ids = [[1, 2, 3, 4, 5], [1, 2, 0, 0, 0]]
+    pred_str = [[b'p']*5, [b'p', b'p', PAD.encode(), PAD.encode(), PAD.encode()]]
+    context, question, answer, ix = preprocessing.duplicate_batch_and_inject(get_batch(), pred_ids, pred_str, [5, 2])
+    q_raw, q_ids, q_target_ids, q_len = question
+
+    # the predictions come first, then the gold questions, padded out to the longer of the two
+    assert q_ids.shape == (4, 5) and q_target_ids.shape == (4, 5, 2)
+    np.testing.assert_array_equal(q_ids[:2], pred_ids)
+    np.testing.assert_array_equal(q_ids[2:], [[7, 7, 7, 0, 0]]*2)
+    np.testing.assert_array_equal(q_len, [5, 2, 3, 3])
+    assert q_raw[0, 4] == b'p' and q_raw[2, 3] == PAD.encode()
+
+    # predictions only have one target per step, with -1 for padding
+    np.testing.assert_array_equal(q_target_ids[:2, :, 0], pred_ids)
+    assert np.all(q_target_ids[:2, :, 1] == -1)
+    assert np.all(q_target_ids[2:, :3] == 7) and np.all(q_target_ids[2:, 3:] == -1)
+
+    # everything else is just repeated
+    np.testing.assert_array_equal(ix, [0, 1, 0, 1])
+    assert all(len(x) == 4 for x in context+answer)
@@ -89,21 +89,21 @@ class LstmLm(TFModel):
 # This should handle a concrete instance of a LM, loading params, spinning up the graph etc, to be used by other models
 class LstmLmInstance():
     def get_padded_batch(self, seq_batch):
-        seq_batch_ids = [[self.vocab[loader.SOS]]+[self.vocab[tok if tok in self.vocab.keys() else loader.OOV] for tok in tokenise(sent, asbytes=False)]+[self.vocab[loader.EOS]] for sent in seq_batch]
-        max_seq_len = max([len(seq) for seq in seq_batch_ids])
-        padded_batch = np.asarray([seq + [self.vocab[loader.PAD] for i in range(max_seq_len-len(seq))] for seq in seq_batch_ids])
+        padded_batch, _ = self.vocab.encode_batch([tokenise(sent, asbytes=False) for sent in seq_batch], add_sos_eos=True)
         return padded_batch
 
     def __del__(self):
         self.sess.close()
 
-    def load_from_chkpt(self, path):
-        with open(path+'/vocab.json') as f:
-            self.vocab = json.load(f)
+    # session_config overrides the default per model session setup, eg to share thread pools with other models
+    def load_from_chkpt(self, path, session_config=None):
+        self.vocab = loader.load_vocab(path)
 
         self.model = LstmLm(self.vocab, num_units=FLAGS.lm_units, training_mode=False)
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
-        self.sess = tf.Session(graph=self.model.graph, config=tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True))
+        if session_config is None:
+            gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
+            session_config = tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True)
+        self.sess = tf.Session(graph=self.model.graph, config=session_config)
 
         with self.model.graph.as_default():
             saver = tf.train.Saver()
@@ -2,9 +2,7 @@ import tensorflow as tf
 from helpers.ops import safe_log, total_params
 from seq2seq_model import Seq2SeqModel
 
-from langmodel.lm import LstmLmInstance
-from qa.mpcm import MpcmQaInstance
-from qa.qanet.instance import QANetInstance
+from model_host import create_model_host
 
 from helpers.misc_utils import debug_shape
 
@@ -24,15 +22,15 @@ class MaluubaModel(Seq2SeqModel):
         print('Modifying Seq2Seq model to incorporate RL rewards')
 
         if FLAGS.policy_gradient:
-            print('Building and loading LM')
-            self.lm = LstmLmInstance()
-            self.lm.load_from_chkpt(FLAGS.model_dir+'saved/lmtest')
-
-            print('Building and loading QA model')
-            # self.qa = MpcmQaInstance()
-            # self.qa.load_from_chkpt(FLAGS.model_dir+'saved/qatest')
-            self.qa = QANetInstance()
-            self.qa.load_from_chkpt(FLAGS.model_dir+'saved/qanet2')
+            # the discriminator is only needed if it's part of the reward, or being trained
+            use_disc = FLAGS.disc_weight > 0 or FLAGS.disc_train
+            print('Building and loading LM and QA model' + (' and discriminator' if use_disc else ''))
+            self.reward_host = create_model_host(lm_path=FLAGS.model_dir+'saved/lmtest', qa_path=FLAGS.model_dir+'saved/qanet2',
+                disc_path=FLAGS.model_dir+'saved/discriminator-trained-latent' if use_disc else None, disc_trainable=FLAGS.disc_train,
+                num_workers=FLAGS.reward_workers, gold_cache_path=FLAGS.qa_gold_cache_path if FLAGS.qa_gold_cache_path != "" else None)
+            self.lm = self.reward_host.lm
+            self.qa = self.reward_host.qa
+            self.discriminator = self.reward_host.discriminator
 
         with self.graph.as_default():
 
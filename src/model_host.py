@@ -0,0 +1,201 @@
+import sys, threading, itertools, multiprocessing, queue, traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import tensorflow as tf
+
+from helpers.rewards import RewardScorer, GoldQACache, get_checkpoint_id
+
+from langmodel.lm import LstmLmInstance
+from qa.qanet.instance import QANetInstance
+from discriminator.instance import DiscriminatorInstance
+
+import flags
+FLAGS = tf.app.flags.FLAGS
+
+# Session config shared by all the hosted models - they all share one named inter-op pool, rather than each getting
+# their own. The intra-op pool is global to the process and sized by the first session created, so it's only set (by
+# splitting the cores between the sessions, or to host_intra_op_threads) when num_sessions is given, ie when the host
+# has a worker process to itself - otherwise it would also throttle the generator.
+def get_session_config(num_sessions=None):
+    config = tf.ConfigProto(allow_soft_placement=True)
+    if num_sessions is not None:
+        config.intra_op_parallelism_threads = FLAGS.host_intra_op_threads if FLAGS.host_intra_op_threads > 0 else max(1, multiprocessing.cpu_count()//max(num_sessions, 1))
+    config.gpu_options.allow_growth = True
+    config.gpu_options.visible_device_list = '0'
+    pool = config.session_inter_op_thread_pool.add()
+    pool.num_threads = FLAGS.host_inter_op_threads
+    pool.global_name = 'model_host'
+    return config
+
+# Loads the models used to score generated questions (LM, QANet and discriminator) into one process, sharing one session
+# config and the embedding stores, and gives a single API for getting rewards from them. Any path left as None isn't
+# loaded. The models themselves are available as .lm, .qa and .discriminator. Set own_process if nothing else runs in
+# this process, so the intra-op threads can be split between the models.
+class ModelHost():
+    def __init__(self, lm_path=None, qa_path=None, disc_path=None, disc_trainable=False, num_workers=4, gold_cache_path=None, own_process=False):
+        session_config = get_session_config(len([path for path in [lm_path, qa_path, disc_path] if path is not None]) if own_process else None)
+
+        self.lm = self.qa = self.discriminator = None
+        if lm_path is not None:
+            self.lm = LstmLmInstance()
+            self.lm.load_from_chkpt(lm_path, session_config=session_config)
+        if qa_path is not None:
+            self.qa = QANetInstance()
+            self.qa.load_from_chkpt(qa_path, session_config=session_config)
+        if disc_path is not None:
+            self.discriminator = DiscriminatorInstance(trainable=disc_trainable, path=disc_path, session_config=session_config)
+
+        self.scorer = None
+        if self.lm is not None and self.qa is not None:
+            self.scorer = RewardScorer(self.lm, self.qa, self.discriminator, num_workers=num_workers, gold_cache=GoldQACache(gold_cache_path, model_id=get_checkpoint_id(self.qa.chkpt_id), max_size=FLAGS.qa_gold_cache_size))
+
+    def get_loaded(self):
+        return {'lm': self.lm is not None, 'qa': self.qa is not None, 'discriminator': self.discriminator is not None}
+
+    # See RewardScorer.get_rewards
+    def get_rewards(self, pred_str, gold_q_str, contexts, ans_text, ans_pos, gold_ans_str):
+        if self.scorer is None:
+            raise ValueError("Getting rewards needs both the LM and QA models loading")
+        return self.scorer.get_rewards(pred_str, gold_q_str, contexts, ans_text, ans_pos, gold_ans_str)
+
+    # See RewardScorer.train_discriminator
+    def train_discriminator(self, *args, **kwargs):
+        if self.scorer is None:
+            raise ValueError("Training the discriminator through the host needs the LM and QA models loading")
+        return self.scorer.train_discriminator(*args, **kwargs)
+
+    def save_discriminator(self, *args, **kwargs):
+        if self.scorer is None:
+            raise ValueError("Saving the discriminator through the host needs the LM and QA models loading")
+        return self.scorer.save_discriminator(*args, **kwargs)
+
+    def close(self):
+        if self.scorer is not None:
+            self.scorer.close()
+            self.scorer = None
+
+# Runs a ModelHost in a separate worker process, so the scoring models' sessions, threads and GPU memory are kept out
+# of the calling process. Calls are sent over a pair of queues, and run on a few threads in the worker so concurrent
+# callers don't block each other. .lm, .qa and .discriminator are proxies with the same methods as the real models.
+class RemoteModelHost():
+    def __init__(self, worker_threads=4, **host_args):
+        # TF isn't fork safe, so the worker has to start from scratch
+        ctx = multiprocessing.get_context('spawn')
+        self.requests = ctx.Queue()
+        self.responses = ctx.Queue()
+        self.process = ctx.Process(target=_run_host_worker, args=(self.requests, self.responses, host_args, worker_threads, FLAGS.flag_values_dict()), daemon=True)
+        self.process.start()
+
+        # the worker replies once everything is loaded
+        _, ok, loaded = self.responses.get()
+        if not ok:
+            self.process.join()
+            raise loaded
+
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.thread = threading.Thread(target=self._read_responses, daemon=True)
+        self.thread.start()
+
+        self.lm = _RemoteModel(self, 'lm') if loaded['lm'] else None
+        self.qa = _RemoteModel(self, 'qa') if loaded['qa'] else None
+        self.discriminator = _RemoteModel(self, 'discriminator') if loaded['discriminator'] else None
+
+    def submit(self, target, method, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            req_id = next(self.ids)
+            self.futures[req_id] = future
+        self.requests.put((req_id, target, method, args, kwargs))
+        return future
+
+    def call(self, target, method, *args, **kwargs):
+        return self.submit(target, method, *args, **kwargs).result()
+
+    def _read_responses(self):
+        while True:
+            try:
+                msg = self.responses.get(timeout=1)
+            except queue.Empty:
+                if self.process is None or self.process.is_alive():
+                    continue
+                # the worker died, so nothing pending will ever come back
+                with self.lock:
+                    for future in self.futures.values():
+                        future.set_exception(RuntimeError("Model host worker exited"))
+                    self.futures = {}
+                return
+            if msg is None:
+                return
+            req_id, ok, result = msg
+            with self.lock:
+                future = self.futures.pop(req_id)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def get_rewards(self, pred_str, gold_q_str, contexts, ans_text, ans_pos, gold_ans_str):
+        return self.call(None, 'get_rewards', pred_str, gold_q_str, contexts, ans_text, ans_pos, gold_ans_str)
+
+    def train_discriminator(self, *args, **kwargs):
+        return self.call(None, 'train_discriminator', *args, **kwargs)
+
+    def save_discriminator(self, *args, **kwargs):
+        return self.call(None, 'save_discriminator', *args, **kwargs)
+
+    def close(self):
+        if self.process is not None:
+            self.requests.put(None)
+            self.process.join()
+            self.process = None
+
+class _RemoteModel():
+    def __init__(self, host, target):
+        self.host = host
+        self.target = target
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.host.call(self.target, method, *args, **kwargs)
+
+def _run_host_worker(requests, responses, host_args, worker_threads, flag_values):
+    # flags don't carry over to a spawned process, so copy over whatever the parent had
+    FLAGS(sys.argv[:1])
+    for name, value in flag_values.items():
+        if hasattr(FLAGS, name):
+            setattr(FLAGS, name, value)
+
+    try:
+        host = ModelHost(own_process=True, **host_args)
+    except Exception as e:
+        responses.put((None, False, RuntimeError(traceback.format_exc())))
+        return
+    responses.put((None, True, host.get_loaded()))
+
+    def handle(req_id, target, method, args, kwargs):
+        try:
+            obj = host if target is None else getattr(host, target)
+            responses.put((req_id, True, getattr(obj, method)(*args, **kwargs)))
+        except Exception as e:
+            # the original exception might not pickle, so send the traceback instead
+            responses.put((req_id, False, RuntimeError(traceback.format_exc())))
+
+    pool = ThreadPoolExecutor(worker_threads)
+    while True:
+        req = requests.get()
+        if req is None:
+            break
+        pool.submit(handle, *req)
+    pool.shutdown(wait=True)
+    host.close()
+    responses.put(None)
+
+# Loads the scoring models in this process, or in a worker process if model_host_process is set. A discriminator that's
+# being trained stays in this process, since it's updated (and saved) from the training loop
+def create_model_host(**host_args):
+    if FLAGS.model_host_process and not (host_args.get('disc_path') is not None and host_args.get('disc_trainable')):
+        return RemoteModelHost(**host_args)
+    return ModelHost(**host_args)
@@ -202,15 +202,12 @@ class MpcmQaInstance():
         self.sess.close()
 
     def get_padded_batch(self, seq_batch):
-        seq_batch_ids = [[self.vocab[loader.SOS]]+[self.vocab[tok if tok in self.vocab.keys() else loader.OOV] for tok in tokenise(sent, asbytes=False)]+[self.vocab[loader.EOS]] for sent in seq_batch]
-        max_seq_len = max([len(seq) for seq in seq_batch_ids])
-        padded_batch = np.asarray([seq + [self.vocab[loader.PAD] for i in range(max_seq_len-len(seq))] for seq in seq_batch_ids])
+        padded_batch, _ = self.vocab.encode_batch([tokenise(sent, asbytes=False) for sent in seq_batch], add_sos_eos=True)
         return padded_batch
 
 
     def load_from_chkpt(self, path):
-        with open(path+'/vocab.json') as f:
-            self.vocab = json.load(f)
+        self.vocab = loader.load_vocab(path)
 
         self.model = MpcmQa(self.vocab, training_mode=False)
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
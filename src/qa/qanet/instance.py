@@ -21,13 +21,12 @@ mem_limit=0.95
 
 # This provides a somewhat normalised interface to a pre-trained QANet model - some tweaks have been made to get it to play nicely when other models are spun up
 class QANetInstance():
-    def load_from_chkpt(self, path, trainable=False):
+    # session_config overrides the default per model session setup, eg to share thread pools with other models
+    def load_from_chkpt(self, path, trainable=False, session_config=None):
 
         config = tf.app.flags.FLAGS
-        with open(config.word_emb_file, "r") as fh:
-            word_mat = np.array(json.load(fh), dtype=np.float32)
-        with open(config.char_emb_file, "r") as fh:
-            char_mat = np.array(json.load(fh), dtype=np.float32)
+        word_mat = loader.load_emb_matrix(config.word_emb_file)
+        char_mat = loader.load_emb_matrix(config.char_emb_file)
         # with open(config.test_meta, "r") as fh:
         #     meta = json.load(fh)
 
@@ -38,15 +37,19 @@ class QANetInstance():
 
         self.model = Model(config, None, word_mat, char_mat, trainable=trainable, demo = True)
 
-        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
-        self.sess = tf.Session(graph=self.model.graph, config=tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True))
+        if session_config is None:
+            gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit,allow_growth = True,visible_device_list='0')
+            session_config = tf.ConfigProto(gpu_options=gpu_options,allow_soft_placement=True)
+        self.sess = tf.Session(graph=self.model.graph, config=session_config)
 
         with self.model.graph.as_default():
             self.saver = tf.train.Saver()
             if trainable:
+                self.chkpt_id = None
                 self.sess.run(tf.global_variables_initializer())
             else:
-                self.saver.restore(self.sess, tf.train.latest_checkpoint(path))
+                self.chkpt_id = tf.train.latest_checkpoint(path)
+                self.saver.restore(self.sess, self.chkpt_id)
             if config.decay < 1.0:
                 self.sess.run(self.model.assign_vars)
     def __del__(self):
@@ -8,6 +8,8 @@ from collections import Counter
 import numpy as np
 from codecs import open
 
+from helpers.loader import iter_squad_articles
+
 
 '''
 This file is taken and modified from R-Net by HKUST-KnowComp
@@ -41,50 +43,49 @@ def process_file(filename, data_type, word_counter, char_counter):
     examples = []
     eval_examples = {}
     total = 0
-    with open(filename, "r") as fh:
-        source = json.load(fh)
-        for article in tqdm(source["data"]):
-            for para in article["paragraphs"]:
-                context = para["context"].replace(
+    # stream the articles in one at a time, rather than loading the whole json tree
+    for article in tqdm(iter_squad_articles(filename)):
+        for para in article["paragraphs"]:
+            context = para["context"].replace(
+                "''", '" ').replace("``", '" ')
+            context_tokens = word_tokenize(context)
+            context_chars = [list(token) for token in context_tokens]
+            spans = convert_idx(context, context_tokens)
+            for token in context_tokens:
+                word_counter[token] += len(para["qas"])
+                for char in token:
+                    char_counter[char] += len(para["qas"])
+            for qa in para["qas"]:
+                total += 1
+                ques = qa["question"].replace(
                     "''", '" ').replace("``", '" ')
-                context_tokens = word_tokenize(context)
-                context_chars = [list(token) for token in context_tokens]
-                spans = convert_idx(context, context_tokens)
-                for token in context_tokens:
-                    word_counter[token] += len(para["qas"])
+                ques_tokens = word_tokenize(ques)
+                ques_chars = [list(token) for token in ques_tokens]
+                for token in ques_tokens:
+                    word_counter[token] += 1
                     for char in token:
-                        char_counter[char] += len(para["qas"])
-                for qa in para["qas"]:
-                    total += 1
-                    ques = qa["question"].replace(
-                        "''", '" ').replace("``", '" ')
-                    ques_tokens = word_tokenize(ques)
-                    ques_chars = [list(token) for token in ques_tokens]
-                    for token in ques_tokens:
-                        word_counter[token] += 1
-                        for char in token:
-                            char_counter[char] += 1
-                    y1s, y2s = [], []
-                    answer_texts = []
-                    for answer in qa["answers"]:
-                        answer_text = answer["text"]
-                        answer_start = answer['answer_start']
-                        answer_end = answer_start + len(answer_text)
-                        answer_texts.append(answer_text)
-                        answer_span = []
-                        for idx, span in enumerate(spans):
-                            if not (answer_end <= span[0] or answer_start >= span[1]):
-                                answer_span.append(idx)
-                        y1, y2 = answer_span[0], answer_span[-1]
-                        y1s.append(y1)
-                        y2s.append(y2)
-                    example = {"context_tokens": context_tokens, "context_chars": context_chars, "ques_tokens": ques_tokens,
-                               "ques_chars": ques_chars, "y1s": y1s, "y2s": y2s, "id": total}
-                    examples.append(example)
-                    eval_examples[str(total)] = {
-                        "context": context, "spans": spans, "answers": answer_texts, "uuid": qa["id"]}
-        random.shuffle(examples)
-        print("{} questions in total".format(len(examples)))
+                        char_counter[char] += 1
+                y1s, y2s = [], []
+                answer_texts = []
+                for answer in qa["answers"]:
+                    answer_text = answer["text"]
+                    answer_start = answer['answer_start']
+                    answer_end = answer_start + len(answer_text)
+                    answer_texts.append(answer_text)
+                    answer_span = []
+                    for idx, span in enumerate(spans):
+                        if not (answer_end <= span[0] or answer_start >= span[1]):
+                            answer_span.append(idx)
+                    y1, y2 = answer_span[0], answer_span[-1]
+                    y1s.append(y1)
+                    y2s.append(y2)
+                example = {"context_tokens": context_tokens, "context_chars": context_chars, "ques_tokens": ques_tokens,
+                           "ques_chars": ques_chars, "y1s": y1s, "y2s": y2s, "id": total}
+                examples.append(example)
+                eval_examples[str(total)] = {
+                    "context": context, "spans": spans, "answers": answer_texts, "uuid": qa["id"]}
+    random.shuffle(examples)
+    print("{} questions in total".format(len(examples)))
     return examples, eval_examples
 
 
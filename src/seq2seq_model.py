@@ -14,6 +14,7 @@ import helpers.loader as loader
 from copy_mechanism import copy_attention_wrapper, copy_layer
 
 import helpers.ops as ops
+import helpers.decoding as decoding
 from helpers.misc_utils import debug_shape, debug_tensor, debug_op
 
 FLAGS = tf.app.flags.FLAGS
@@ -22,8 +23,8 @@ FLAGS = tf.app.flags.FLAGS
 
 class Seq2SeqModel(TFModel):
     def __init__(self, vocab, advanced_condition_encoding=False, training_mode=False, use_embedding_loss=False):
-        self.vocab=vocab
-        self.rev_vocab = {v:k for k,v in self.vocab.items()}
+        self.vocab=loader.as_vocab(vocab)
+        self.rev_vocab = self.vocab.rev
 
         self.training_mode = training_mode
         self.use_embedding_loss = use_embedding_loss
@@ -35,29 +36,120 @@ class Seq2SeqModel(TFModel):
         self.advanced_condition_encoding = advanced_condition_encoding
         super().__init__()
 
+    # Build a beam search decoder of a given width. All of its variables are shared with the training decoder, but the
+    # beam width has to be fixed when the graph is built, so each width needs its own copy of the decoder
+    def build_beam_decoder(self, beam_width, unroll_scope):
+        curr_batch_size = tf.shape(self.answer_ids)[0]
+
+        with tf.variable_scope('decoder_init'):
+            beam_memory = tf.contrib.seq2seq.tile_batch( self.context_encoder_output, multiplier=beam_width )
+            beam_memory_sequence_length = tf.contrib.seq2seq.tile_batch( self.context_length, multiplier=beam_width)
+            s0_tiled = tf.contrib.seq2seq.tile_batch( self.s0, multiplier=beam_width)
+            beam_init_state = tf.contrib.rnn.LSTMStateTuple(s0_tiled, tf.contrib.seq2seq.tile_batch(tf.zeros([curr_batch_size, self.decoder_units]), multiplier=beam_width))
+
+        with tf.variable_scope('attn_mech', reuse=True) as scope:
+            scope.reuse_variables()
+            beam_attention_mechanism = copy_attention_wrapper.BahdanauAttention(
+                            num_units=self.decoder_units, memory=beam_memory,
+                            memory_sequence_length=beam_memory_sequence_length, name='bahdanau_attn')
+
+            if FLAGS.separate_copy_mech:
+                beam_copy_mechanism = copy_attention_wrapper.BahdanauAttention(
+                                num_units=self.decoder_units, memory=beam_memory,
+                                memory_sequence_length=beam_memory_sequence_length, name='bahdanau_attn_copy')
+            else:
+                beam_copy_mechanism = beam_attention_mechanism
+
+            with tf.variable_scope('decoder_cell', reuse=True):
+                beam_decoder_cell = tf.contrib.rnn.DropoutWrapper(
+                        cell=tf.contrib.rnn.BasicLSTMCell(num_units=self.decoder_units),
+                        input_keep_prob=(tf.cond(self.is_training,lambda: 1.0 - self.dropout_prob,lambda: 1.)),
+                        state_keep_prob=(tf.cond(self.is_training,lambda: 1.0 - self.dropout_prob,lambda: 1.)),
+                        output_keep_prob=(tf.cond(self.is_training,lambda: 1.0 - self.dropout_prob,lambda: 1.)),
+                        input_size=len(self.vocab)+FLAGS.max_copy_size+self.decoder_units//2,
+                        variational_recurrent=True,
+                        dtype=tf.float32)
+
+            beam_decoder_cell = copy_attention_wrapper.CopyAttentionWrapper(beam_decoder_cell,
+                                                                beam_attention_mechanism,
+                                                                attention_layer_size=self.decoder_units / 2,
+                                                                alignment_history=False,
+                                                                copy_mechanism=beam_copy_mechanism,
+                                                                output_attention=True,
+                                                                initial_cell_state=beam_init_state, name='copy_attention_wrapper')
+
+            beam_init_state = beam_decoder_cell.zero_state(curr_batch_size*(beam_width), tf.float32).clone(cell_state=beam_init_state)
+
+        # We have to make separate copies of the layer as beam search uses different shapes - but force them to share variables
+        with tf.variable_scope('copy_layer', reuse=True) as scope:
+            scope.reuse_variables()
+            answer_mask_beam = tf.contrib.seq2seq.tile_batch(self.answer_mask, multiplier=beam_width)
+
+            beam_projection_layer = copy_layer.CopyLayer(FLAGS.decoder_units//2, FLAGS.max_context_len,
+                                            switch_units=FLAGS.switch_units,
+                                            source_provider=lambda: self.context_copy_ids if FLAGS.context_as_set else self.context_ids,
+                                            source_provider_sl=lambda: self.context_ids,
+                                            condition_encoding=lambda: self.context_encoding,
+                                            vocab_size=len(self.vocab),
+                                            training_mode=self.is_training,
+                                            output_mask=lambda: answer_mask_beam,
+                                            context_as_set=FLAGS.context_as_set,
+                                            max_copy_size=FLAGS.max_copy_size,
+                                            mask_oovs=tf.logical_not(self.is_training),
+                                            name="copy_layer")
+
+        with tf.variable_scope(unroll_scope, reuse=True):
+            start_tokens = tf.tile(tf.constant([self.vocab[SOS]], dtype=tf.int32), [ curr_batch_size  ] )
+            end_token = self.vocab[EOS]
+
+            beam_decoder = decoding.EarlyStoppingBeamSearchDecoder( cell = beam_decoder_cell,
+                                                               embedding = tf.eye(len(self.vocab) + FLAGS.max_copy_size),
+                                                               start_tokens = start_tokens,
+                                                               end_token = end_token,
+                                                               initial_state = beam_init_state,
+                                                               beam_width = beam_width,
+                                                               output_layer = beam_projection_layer ,
+                                                               length_penalty_weight=FLAGS.length_penalty,
+                                                               max_lengths=self.decode_max_length,
+                                                               stop_on_top_beams=FLAGS.beam_early_stop)
+
+            beam_outputs, beam_decoder_states,beam_out_lens = tf.contrib.seq2seq.dynamic_decode(  beam_decoder,
+                                                                    impute_finished=False,
+                                                                   maximum_iterations=tf.reduce_max(self.decode_max_length) )
+        return beam_outputs, beam_decoder_states, beam_out_lens
+
+    # Build a greedy or sampling decoder. These don't need tiled copies of anything, so can share the training cell
+    def build_sampling_decoder(self, helper, cell, init_state, projection_layer, unroll_scope):
+        with tf.variable_scope(unroll_scope, reuse=True):
+            decoder = tf.contrib.seq2seq.BasicDecoder(cell, helper, initial_state=init_state, output_layer=projection_layer)
+            outputs, _, out_lens = tf.contrib.seq2seq.dynamic_decode(decoder, impute_finished=True, maximum_iterations=tf.reduce_max(self.decode_max_length))
+
+        pred_ids = outputs.sample_id*tf.sequence_mask(out_lens, tf.shape(outputs.sample_id)[1], dtype=tf.int32)
+        return pred_ids, out_lens, decoding.sequence_log_prob(outputs.rnn_output, pred_ids, out_lens)
+
     def build_model(self):
 
         with tf.device('/cpu:*'):
-            self.context_raw = tf.placeholder(tf.string, [None, None])  # source vectors of unknown size
-            self.question_raw  = tf.placeholder(tf.string, [None, None])  # target vectors of unknown size
-            self.answer_raw  = tf.placeholder(tf.string, [None, None])  # target vectors of unknown size
-        self.context_ids = tf.placeholder(tf.int32, [None, None])  # source vectors of unknown size
-        self.context_copy_ids = tf.placeholder(tf.int32, [None, None])  # source vectors of unknown size
-        self.context_length  = tf.placeholder(tf.int32, [None])     # size(source)
-        self.context_vocab_size  = tf.placeholder(tf.int32, [None])     # size(source_vocab)
-        self.question_ids = tf.placeholder(tf.int32, [None, None])  # target vectors of unknown size
-        self.question_onehot = tf.placeholder(tf.float32, [None, None, None])  # target vectors of unknown size
-        self.question_length  = tf.placeholder(tf.int32, [None])     # size(source)
-        self.answer_ids  = tf.placeholder(tf.int32, [None, None])  # target vectors of unknown size
-        self.answer_length  = tf.placeholder(tf.int32, [None])
-        self.answer_locs  = tf.placeholder(tf.int32, [None,None])
-        self.original_ix  = tf.placeholder(tf.int32, [None]) # unused - gives the index of the input in the unshuffled dataset
+            self.context_raw = tf.placeholder(tf.string, [None, None], "context_raw")  # source vectors of unknown size
+            self.question_raw  = tf.placeholder(tf.string, [None, None], "question_raw")  # target vectors of unknown size
+            self.answer_raw  = tf.placeholder(tf.string, [None, None], "answer_raw")  # target vectors of unknown size
+        self.context_ids = tf.placeholder(tf.int32, [None, None], "context_ids")  # source vectors of unknown size
+        self.context_copy_ids = tf.placeholder(tf.int32, [None, None], "context_copy_ids")  # source vectors of unknown size
+        self.context_length  = tf.placeholder(tf.int32, [None], "context_length")     # size(source)
+        self.context_vocab_size  = tf.placeholder(tf.int32, [None], "context_vocab_size")     # size(source_vocab)
+        self.question_ids = tf.placeholder(tf.int32, [None, None], "question_ids")  # target vectors of unknown size
+        self.question_target_ids = tf.placeholder(tf.int32, [None, None, None], "question_target_ids")  # all valid target ids per token, padded with -1
+        self.question_length  = tf.placeholder(tf.int32, [None], "question_length")     # size(source)
+        self.answer_ids  = tf.placeholder(tf.int32, [None, None], "answer_ids")  # target vectors of unknown size
+        self.answer_length  = tf.placeholder(tf.int32, [None], "answer_length")
+        self.answer_locs  = tf.placeholder(tf.int32, [None,None], "answer_locs")
+        self.original_ix  = tf.placeholder(tf.int32, [None], "original_ix") # unused - gives the index of the input in the unshuffled dataset
 
         self.hide_answer_in_copy = tf.placeholder_with_default(False, (),"hide_answer_in_copy")
 
 
         self.context_in = (self.context_raw, self.context_ids, self.context_copy_ids, self.context_length, self.context_vocab_size)
-        self.question_in = (self.question_raw, self.question_ids, self.question_onehot, self.question_length)
+        self.question_in = (self.question_raw, self.question_ids, self.question_target_ids, self.question_length)
         self.answer_in = (self.answer_raw, self.answer_ids, self.answer_length, self.answer_locs)
         self.input_batch = (self.context_in, self.question_in, self.answer_in, self.original_ix)
 
@@ -66,7 +158,8 @@ class Seq2SeqModel(TFModel):
         with tf.variable_scope('input_pipeline'):
             # build teacher output - coerce to vocab and pad with SOS/EOS
             # also build output for loss - one hot over vocab+context
-
+            # build the (many-)hot targets on device from the ids, padding (-1) maps to all zeros
+            self.question_onehot = tf.reduce_sum(tf.one_hot(self.question_target_ids, depth=len(self.vocab)+FLAGS.max_copy_size), axis=2)
             self.question_teach_oh = tf.concat([tf.one_hot(tf.tile(tf.constant(self.vocab[SOS], shape=[1, 1]), [curr_batch_size,1]), depth=len(self.vocab)+FLAGS.max_copy_size), self.question_onehot[:,:-1,:]], axis=1)
 
 
@@ -199,12 +292,6 @@ class Seq2SeqModel(TFModel):
         # decode
         # TODO: for Maluuba model, decoder inputs are concat of context and answer encoding
         with tf.variable_scope('decoder_init'):
-
-            beam_memory = tf.contrib.seq2seq.tile_batch( self.context_encoder_output, multiplier=FLAGS.beam_width )
-            beam_memory_sequence_length = tf.contrib.seq2seq.tile_batch( self.context_length, multiplier=FLAGS.beam_width)
-            s0_tiled = tf.contrib.seq2seq.tile_batch( self.s0, multiplier=FLAGS.beam_width)
-            beam_init_state = tf.contrib.rnn.LSTMStateTuple(s0_tiled, tf.contrib.seq2seq.tile_batch(tf.zeros([curr_batch_size, self.decoder_units]), multiplier=FLAGS.beam_width))
-
             train_memory = self.context_encoder_output
             train_memory_sequence_length = self.context_length
             train_init_state = tf.contrib.rnn.LSTMStateTuple(self.s0, tf.zeros([curr_batch_size, self.decoder_units]))
@@ -245,41 +332,7 @@ class Seq2SeqModel(TFModel):
         #                 num_units=self.decoder_units, memory=memory,
         #                 memory_sequence_length=memory_sequence_length)
 
-        with tf.variable_scope('attn_mech', reuse=True) as scope:
-            scope.reuse_variables()
-            beam_attention_mechanism = copy_attention_wrapper.BahdanauAttention(
-                            num_units=self.decoder_units, memory=beam_memory,
-                            memory_sequence_length=beam_memory_sequence_length, name='bahdanau_attn')
-
-            if FLAGS.separate_copy_mech:
-                beam_copy_mechanism = copy_attention_wrapper.BahdanauAttention(
-                                num_units=self.decoder_units, memory=beam_memory,
-                                memory_sequence_length=beam_memory_sequence_length, name='bahdanau_attn_copy')
-            else:
-                beam_copy_mechanism = beam_attention_mechanism
-
-            with tf.variable_scope('decoder_cell', reuse=True):
-                beam_decoder_cell = tf.contrib.rnn.DropoutWrapper(
-                        cell=tf.contrib.rnn.BasicLSTMCell(num_units=self.decoder_units),
-                        input_keep_prob=(tf.cond(self.is_training,lambda: 1.0 - self.dropout_prob,lambda: 1.)),
-                        state_keep_prob=(tf.cond(self.is_training,lambda: 1.0 - self.dropout_prob,lambda: 1.)),
-                        output_keep_prob=(tf.cond(self.is_training,lambda: 1.0 - self.dropout_prob,lambda: 1.)),
-                        input_size=len(self.vocab)+FLAGS.max_copy_size+self.decoder_units//2,
-                        variational_recurrent=True,
-                        dtype=tf.float32)
-
-            beam_decoder_cell = copy_attention_wrapper.CopyAttentionWrapper(beam_decoder_cell,
-                                                                beam_attention_mechanism,
-                                                                attention_layer_size=self.decoder_units / 2,
-                                                                alignment_history=False,
-                                                                copy_mechanism=beam_copy_mechanism,
-                                                                output_attention=True,
-                                                                initial_cell_state=beam_init_state, name='copy_attention_wrapper')
-
-            beam_init_state = beam_decoder_cell.zero_state(curr_batch_size*(FLAGS.beam_width), tf.float32).clone(cell_state=beam_init_state)
-
-
-        # We have to make two copies of the layer as beam search uses different shapes - but force them to share variables
+        # The beam search decoders get their own copies of this layer (see build_beam_decoder)
         with tf.variable_scope('copy_layer') as scope:
             ans_mask = 1-tf.reshape(self.in_answer_feature,[curr_batch_size,-1])
             self.answer_mask = tf.cond(self.hide_answer_in_copy, lambda: ans_mask, lambda: tf.ones(tf.shape(ans_mask)))
@@ -297,22 +350,6 @@ class Seq2SeqModel(TFModel):
                                             mask_oovs=tf.logical_not(self.is_training),
                                             name="copy_layer")
 
-            scope.reuse_variables()
-            answer_mask_beam = tf.contrib.seq2seq.tile_batch(self.answer_mask, multiplier=FLAGS.beam_width)
-
-
-            beam_projection_layer = copy_layer.CopyLayer(FLAGS.decoder_units//2, FLAGS.max_context_len,
-                                            switch_units=FLAGS.switch_units,
-                                            source_provider=lambda: self.context_copy_ids if FLAGS.context_as_set else self.context_ids,
-                                            source_provider_sl=lambda: self.context_ids,
-                                            condition_encoding=lambda: self.context_encoding,
-                                            vocab_size=len(self.vocab),
-                                            training_mode=self.is_training,
-                                            output_mask=lambda: answer_mask_beam,
-                                            context_as_set=FLAGS.context_as_set,
-                                            max_copy_size=FLAGS.max_copy_size,
-                                            mask_oovs=tf.logical_not(self.is_training),
-                                            name="copy_layer")
 
         with tf.variable_scope('decoder_unroll') as scope:
             # Helper - training
@@ -334,23 +371,12 @@ class Seq2SeqModel(TFModel):
 
             training_probs=training_outputs.rnn_output
 
-        with tf.variable_scope(scope, reuse=True):
-            start_tokens = tf.tile(tf.constant([self.vocab[SOS]], dtype=tf.int32), [ curr_batch_size  ] )
-            end_token = self.vocab[EOS]
-
-            beam_decoder = tf.contrib.seq2seq.BeamSearchDecoder( cell = beam_decoder_cell,
-                                                               embedding = tf.eye(len(self.vocab) + FLAGS.max_copy_size),
-                                                               start_tokens = start_tokens,
-                                                               end_token = end_token,
-                                                               initial_state = beam_init_state,
-                                                               beam_width = FLAGS.beam_width,
-                                                               output_layer = beam_projection_layer ,
-                                                               length_penalty_weight=FLAGS.length_penalty)
+        # max number of decoding steps (including EOS) for each example - can be overridden per request
+        self.decode_max_length = tf.placeholder_with_default(tf.fill([curr_batch_size], FLAGS.decode_max_len), [None], "decode_max_length")
 
-            beam_outputs, beam_decoder_states,beam_out_lens = tf.contrib.seq2seq.dynamic_decode(  beam_decoder,
-                                                                    impute_finished=False,
-                                                                   maximum_iterations=40 )
+        beam_outputs, beam_decoder_states, beam_out_lens = self.build_beam_decoder(FLAGS.beam_width, scope)
 
+        with tf.variable_scope(scope, reuse=True):
             beam_pred_ids = beam_outputs.predicted_ids[:,:,0]
 
             # tf1.4 (and maybe others) return -1 for parts of the sequence outside the valid length, replace this with PAD (0)
@@ -362,6 +388,27 @@ class Seq2SeqModel(TFModel):
             # pred_ids = debug_shape(pred_ids, "pred ids")
             beam_probs = tf.one_hot(beam_pred_ids, depth=len(self.vocab)+FLAGS.max_copy_size)
 
+        # Extra decoders for inference, so the decoding strategy can be picked at run time without rebuilding the graph
+        self.decoders = {}
+        if not self.training_mode:
+            start_tokens = tf.tile(tf.constant([self.vocab[SOS]], dtype=tf.int32), [ curr_batch_size  ] )
+            decoder_embedding = tf.eye(len(self.vocab) + FLAGS.max_copy_size)
+            self.sample_temperature = tf.placeholder_with_default(1.0, (), "sample_temperature")
+
+            greedy_helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(decoder_embedding, start_tokens, self.vocab[EOS])
+            sample_helper = decoding.ProbSampleEmbeddingHelper(decoder_embedding, start_tokens, self.vocab[EOS], softmax_temperature=self.sample_temperature)
+
+            for name, helper in [('greedy', greedy_helper), ('sample', sample_helper)]:
+                ids, lens, scores = self.build_sampling_decoder(helper, train_decoder_cell, train_init_state, train_projection_layer, scope)
+                self.decoders[name] = {'ids': ids, 'lens': lens, 'scores': scores}
+
+            for width in decoding.parse_beam_widths(FLAGS.decode_beam_widths):
+                if width == FLAGS.beam_width:
+                    continue
+                outputs, states, lens = self.build_beam_decoder(width, scope)
+                ids = outputs.predicted_ids[:,:,0]*tf.sequence_mask(lens[:,0], tf.shape(outputs.predicted_ids)[1], dtype=tf.int32)
+                self.decoders['beam'+str(width)] = {'ids': ids, 'lens': lens[:,0], 'scores': states.log_probs[:,0]}
+
 
         self.q_hat = training_probs#tf.nn.softmax(logits, dim=2)
 
@@ -379,9 +426,25 @@ class Seq2SeqModel(TFModel):
             self.q_hat_beam_ids = beam_pred_ids
             self.q_hat_beam_string = ops.id_tensor_to_string(self.q_hat_beam_ids, self.rev_vocab, self.context_raw, context_as_set=FLAGS.context_as_set)
 
-            self.q_hat_full_beam_str = [ops.id_tensor_to_string(ids*tf.sequence_mask(beam_out_lens[:,i], tf.shape(beam_pred_ids)[1], dtype=tf.int32), self.rev_vocab, self.context_raw, context_as_set=FLAGS.context_as_set) for i,ids in enumerate(tf.unstack(beam_outputs.predicted_ids,axis=2))]
-            self.q_hat_full_beam_lens = [len for len in tf.unstack(beam_out_lens,axis=1)]
             self.q_hat_beam_lens = beam_out_lens[:,0]
+            self.q_hat_beam_scores = beam_decoder_states.log_probs[:,0] # total log prob of the top beam
+
+            # n-best hypotheses from the beam, as compact id/len/score arrays rather than strings - convert only the
+            # ones you need with decoding.NBestList. Nothing here is run unless it's fetched
+            if not self.training_mode and FLAGS.nbest_size > 0:
+                nbest_size = min(FLAGS.nbest_size, FLAGS.beam_width)
+                nbest_ids = tf.transpose(beam_outputs.predicted_ids[:,:,:nbest_size], [0,2,1])
+                nbest_lens = beam_out_lens[:,:nbest_size]
+                self.q_hat_nbest = {
+                    'ids': nbest_ids*tf.sequence_mask(nbest_lens, tf.shape(nbest_ids)[2], dtype=tf.int32),
+                    'lens': nbest_lens,
+                    'scores': beam_decoder_states.log_probs[:,:nbest_size]}
+
+            # 'beam' is always the default width decoder
+            self.decoders['beam'] = self.decoders['beam'+str(FLAGS.beam_width)] = {'ids': self.q_hat_beam_ids, 'lens': self.q_hat_beam_lens, 'scores': self.q_hat_beam_scores, 'string': self.q_hat_beam_string}
+            for decoder in self.decoders.values():
+                if 'string' not in decoder:
+                    decoder['string'] = ops.id_tensor_to_string(decoder['ids'], self.rev_vocab, self.context_raw, context_as_set=FLAGS.context_as_set)
 
             self.q_gold = ops.id_tensor_to_string(self.question_ids, self.rev_vocab, self.context_raw, context_as_set=FLAGS.context_as_set)
             self._output_summaries.extend(
@@ -1,4 +1,6 @@
-import os,time, json,datetime
+import os,time, json,datetime, contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # CUDA config
 # os.environ["CUDA_VISIBLE_DEVICES"] = "1"
@@ -15,9 +17,8 @@ from tqdm import tqdm
 
 from seq2seq_model import Seq2SeqModel
 from maluuba_model import MaluubaModel
-from discriminator.instance import DiscriminatorInstance
 
-from datasources.squad_streamer import SquadStreamer
+from datasources.squad_streamer import SquadStreamer, SquadPoolStreamer
 
 import flags
 FLAGS = tf.app.flags.FLAGS
@@ -25,45 +26,6 @@ FLAGS = tf.app.flags.FLAGS
 import helpers.metrics as metrics
 
 
-# TODO: Move this somewhere more appropriate
-# unpack a batch, duplicate the components, and insert a pred into the first half
-# schema is (c,q,a,ix) and (raw,ids,len,?ans_pos)
-def duplicate_batch_and_inject(batch, pred_q_ids, pred_q_str, pred_q_lens):
-    new_batch=[]
-    for i,x in enumerate(batch):
-        new_subbatch=[]
-        if i == 3: # ix is not nested
-            new_batch.append(np.asarray(x.tolist()+x.tolist()))
-        else:
-            for j,y in enumerate(x):
-                if i==1 and j==0:
-                    # create a valid padded batch
-                    new_str_batch=pred_q_str.tolist()+y.tolist()
-                    max_len = max([len(q) for q in new_str_batch])
-                    new_str_batch = [q+[loader.PAD.encode() for k in range(max_len-len(q))] for q in new_str_batch]
-                    new_subbatch.append(np.asarray(new_str_batch))
-                elif i==1 and j==1:
-                    # create a valid padded batch
-                    new_id_batch=pred_q_ids.tolist()+y.tolist()
-                    max_len = max([len(q) for q in new_id_batch])
-                    new_id_batch = [q+[0 for k in range(max_len-len(q))] for q in new_id_batch]
-                    new_subbatch.append(np.asarray(new_id_batch))
-                elif i==1 and j==2:
-                    # create a valid padded batch
-                    d=np.shape(y)[2]
-                    new_oh_batch=[np.eye(d)[q_ids].tolist() for q_ids in pred_q_ids.tolist()]+y.tolist()
-                    max_len = max([len(q) for q in new_oh_batch])
-                    new_oh_batch = [q+np.zeros([max_len-len(q),d]).tolist() for q in new_oh_batch]
-                    new_subbatch.append(np.asarray(new_oh_batch))
-                elif i==1 and j==3:
-                    new_subbatch.append(np.asarray(pred_q_lens.tolist()+y.tolist()))
-                else:
-                    new_subbatch.append(np.asarray(y.tolist()+y.tolist())) # just duplicate
-            new_batch.append(tuple(new_subbatch))
-    return tuple(new_batch)
-
-
-
 def main(_):
     if FLAGS.testing:
         print('TEST MODE - reducing model size')
@@ -78,7 +40,6 @@ def main(_):
     chkpt_path = FLAGS.model_dir+'qgen/'+FLAGS.model_type+'/'+run_id
     restore_path=FLAGS.model_dir+'qgen/'+ FLAGS.restore_path if FLAGS.restore_path is not None else None#'MALUUBA-CROP-LATENT'+'/'+'1534123959'
     # restore_path=FLAGS.model_dir+'saved/qgen-maluuba-crop-glove-smart'
-    disc_path = FLAGS.model_dir+'saved/discriminator-trained-latent'
 
     print("Run ID is ", run_id)
     print("Model type is ", FLAGS.model_type)
@@ -111,16 +72,13 @@ def main(_):
     if FLAGS.restore:
         if restore_path is None:
             exit('You need to specify a restore path!')
-        with open(restore_path+'/vocab.json', encoding="utf-8") as f:
-            vocab = json.load(f)
+        vocab = loader.load_vocab(restore_path)
     elif FLAGS.glove_vocab:
         vocab = loader.get_glove_vocab(FLAGS.data_path, size=FLAGS.vocab_size, d=FLAGS.embedding_size)
-        with open(chkpt_path+'/vocab.json', 'w', encoding="utf-8") as outfile:
-            json.dump(vocab, outfile)
+        loader.save_vocab(vocab, chkpt_path)
     else:
         vocab = loader.get_vocab(train_contexts+train_qs, FLAGS.vocab_size)
-        with open(chkpt_path+'/vocab.json', 'w', encoding="utf-8") as outfile:
-            json.dump(vocab, outfile)
+        loader.save_vocab(vocab, chkpt_path)
 
 
 
@@ -137,12 +95,16 @@ def main(_):
         #     qa_vocab=model.qa.vocab
         #     lm_vocab=model.lm.vocab
         if FLAGS.policy_gradient:
-            discriminator = DiscriminatorInstance(trainable=FLAGS.disc_train, path=disc_path)
+            reward_scorer = model.reward_host
     else:
         exit("Unrecognised model type: "+FLAGS.model_type)
 
     # create data streamer
-    with SquadStreamer(vocab, FLAGS.batch_size, FLAGS.num_epochs, shuffle=True) as train_data_source, SquadStreamer(vocab, FLAGS.eval_batch_size, 1, shuffle=True) as dev_data_source:
+    if FLAGS.streamer_workers > 0:
+        train_streamer = SquadPoolStreamer(vocab, FLAGS.batch_size, FLAGS.num_epochs, shuffle=True, feature_cache=FLAGS.feature_cache, bucket_batching=FLAGS.bucket_batching, num_workers=FLAGS.streamer_workers, ordered=FLAGS.streamer_ordered, queue_size=FLAGS.streamer_queue_size)
+    else:
+        train_streamer = SquadStreamer(vocab, FLAGS.batch_size, FLAGS.num_epochs, shuffle=True, feature_cache=FLAGS.feature_cache, bucket_batching=FLAGS.bucket_batching)
+    with train_streamer as train_data_source, SquadStreamer(vocab, FLAGS.eval_batch_size, 1, shuffle=True, feature_cache=FLAGS.feature_cache) as dev_data_source:
 
         with model.graph.as_default():
             saver = tf.train.Saver(max_to_keep=1, save_relative_paths=True)
@@ -150,7 +112,7 @@ def main(_):
 
         # change visible devices if using RL models
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=mem_limit, visible_device_list='0',allow_growth = True)
-        with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=False), graph=model.graph) as sess:
+        with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=False), graph=model.graph) as sess, contextlib.ExitStack() as cleanup:
 
             summary_writer = tf.summary.FileWriter(FLAGS.log_dir+'qgen/'+FLAGS.model_type+'/'+run_id, sess.graph)
 
@@ -189,51 +151,77 @@ def main(_):
             qa_score_moments = online_moments.OnlineMoment()
             disc_score_moments = online_moments.OnlineMoment()
 
-            # for e in range(start_e,start_e+FLAGS.num_epochs):
-                # Train for one epoch
-            for i in tqdm(range(num_steps_train*FLAGS.num_epochs), desc='Training'):
-                # Get a batch
+            # PG pipeline - sampling runs on its own thread, reward scoring in the background, and updates on this one.
+            # Up to pg_max_staleness batches are sampled ahead of the one being used for an update, so with 0 everything
+            # runs in lockstep (every batch is sampled from the current policy), and with more the generator doesn't sit
+            # waiting on QA/LM/disc. Exactly one batch is sampled per step, so every batch gets its update.
+            num_steps_total = num_steps_train*FLAGS.num_epochs
+            pg_pending = deque()
+            pg_num_sampled = 0
+            pg_num_updates = 0
+            if FLAGS.model_type[:7] == "MALUUBA" and FLAGS.policy_gradient:
+                # these run in reverse order, so the pools are drained before the reward models are closed
+                cleanup.callback(reward_scorer.close)
+                reward_pool = ThreadPoolExecutor(1)
+                cleanup.callback(reward_pool.shutdown)
+                sample_pool = ThreadPoolExecutor(1)
+                cleanup.callback(sample_pool.shutdown)
+
+            def score_batch(*args):
+                start_time = time.time()
+                return reward_scorer.get_rewards(*args), time.time()-start_time
+
+            # Get a batch, do a fwd pass to sample questions for it, then send them off for scoring
+            def sample_batch():
                 train_batch, curr_batch_size = train_data_source.get_batch()
+                updates_at_sample = pg_num_updates
 
-                # Are we doing policy gradient? Do a forward pass first, then build the PG batch and do an update step
-                if FLAGS.model_type[:10] == "MALUUBA_RL" and FLAGS.policy_gradient:
-
-                    # do a fwd pass first, get the score, then do another pass and optimize
-                    qhat_str,qhat_ids, qhat_lens= sess.run([model.q_hat_beam_string, model.q_hat_beam_ids, model.q_hat_beam_lens],
-                        feed_dict={model.input_batch: train_batch,
-                        model.is_training: FLAGS.pg_dropout,
-                        model.hide_answer_in_copy: True})
-
-                    # The output is as long as the max allowed len - remove the pointless extra padding
-                    qhat_ids = qhat_ids[:,:np.max(qhat_lens)]
-                    qhat_str = qhat_str[:,:np.max(qhat_lens)]
+                gen_start = time.time()
+                qhat_str,qhat_ids, qhat_lens= sess.run([model.q_hat_beam_string, model.q_hat_beam_ids, model.q_hat_beam_lens],
+                    feed_dict={model.input_batch: train_batch,
+                    model.is_training: FLAGS.pg_dropout,
+                    model.hide_answer_in_copy: True})
 
-                    pred_str = byte_token_array_to_str(qhat_str, qhat_lens-1)
-                    gold_q_str = byte_token_array_to_str(train_batch[1][0], train_batch[1][3])
+                # The output is as long as the max allowed len - remove the pointless extra padding
+                qhat_ids = qhat_ids[:,:np.max(qhat_lens)]
+                qhat_str = qhat_str[:,:np.max(qhat_lens)]
 
-                    # Get reward values
-                    lm_score = (-1*model.lm.get_seq_perplexity(pred_str)).tolist() # lower perplexity is better
+                pred_str = byte_token_array_to_str(qhat_str, qhat_lens-1)
+                gold_q_str = byte_token_array_to_str(train_batch[1][0], train_batch[1][3])
 
+                # retrieve the uncropped context for QA evaluation
+                unfilt_ctxt_batch = [train_contexts_unfilt[ix] for ix in train_batch[3]]
+                ans_text_batch = [ans_text_unfilt[ix] for ix in train_batch[3]]
+                ans_pos_batch = [ans_pos_unfilt[ix] for ix in train_batch[3]]
 
+                gold_ans_str = byte_token_array_to_str(train_batch[2][0], train_batch[2][2], is_array=False)
+                gen_time = time.time()-gen_start
 
+                # Get reward values - the LM, QA and discriminator all run at the same time, in the background
+                rewards_future = reward_pool.submit(score_batch, pred_str, gold_q_str, unfilt_ctxt_batch, ans_text_batch, ans_pos_batch, gold_ans_str)
+                return (train_batch, curr_batch_size, qhat_str, qhat_ids, qhat_lens, pred_str, gold_q_str, unfilt_ctxt_batch, ans_text_batch, ans_pos_batch, gen_time, updates_at_sample, rewards_future)
 
-                    # retrieve the uncropped context for QA evaluation
-                    unfilt_ctxt_batch = [train_contexts_unfilt[ix] for ix in train_batch[3]]
-                    ans_text_batch = [ans_text_unfilt[ix] for ix in train_batch[3]]
-                    ans_pos_batch = [ans_pos_unfilt[ix] for ix in train_batch[3]]
-
-                    qa_pred = model.qa.get_ans(unfilt_ctxt_batch, pred_str)
-                    qa_pred_gold = model.qa.get_ans(unfilt_ctxt_batch, gold_q_str)
-
-                    # gold_str=[]
-                    # pred_str=[]
-                    qa_f1s = []
-                    gold_ans_str = byte_token_array_to_str(train_batch[2][0], train_batch[2][2], is_array=False)
-
+            # for e in range(start_e,start_e+FLAGS.num_epochs):
+                # Train for one epoch
+            for i in tqdm(range(num_steps_total), desc='Training'):
 
-                    qa_f1s.extend([metrics.f1(metrics.normalize_answer(gold_ans_str[b]), metrics.normalize_answer(qa_pred[b])) for b in range(curr_batch_size)])
+                # Are we doing policy gradient? Take the oldest batch from the pipeline, then build the PG batch and do an update step
+                if FLAGS.model_type[:10] == "MALUUBA_RL" and FLAGS.policy_gradient:
 
-                    disc_scores = discriminator.get_pred(unfilt_ctxt_batch, pred_str, ans_text_batch, ans_pos_batch )
+                    # keep the pipeline topped up
+                    while len(pg_pending) <= FLAGS.pg_max_staleness and pg_num_sampled < num_steps_total:
+                        pg_pending.append(sample_pool.submit(sample_batch))
+                        pg_num_sampled += 1
+
+                    wait_start = time.time()
+                    train_batch, curr_batch_size, qhat_str, qhat_ids, qhat_lens, pred_str, gold_q_str, unfilt_ctxt_batch, ans_text_batch, ans_pos_batch, gen_time, updates_at_sample, rewards_future = pg_pending.popleft().result()
+                    rewards, reward_time = rewards_future.result()
+                    reward_wait_time = time.time()-wait_start
+                    update_time = 0
+                    lm_score = rewards['lm']
+                    qa_pred, qa_pred_gold = rewards['qa_pred'], rewards['qa_pred_gold']
+                    qa_f1s = rewards['qa']
+                    disc_scores = rewards['disc'] if 'disc' in rewards else np.zeros(curr_batch_size)
 
                     if i > FLAGS.pg_burnin//2:
                         lm_score_moments.push(lm_score)
@@ -256,6 +244,9 @@ def main(_):
                         qa_summary = tf.Summary(value=[tf.Summary.Value(tag="rl_rewards/qa",
                                                          simple_value=np.mean(qa_f1s))])
                         summary_writer.add_summary(qa_summary, global_step=(i))
+                        qa_gold_summary = tf.Summary(value=[tf.Summary.Value(tag="rl_rewards/qa_gold",
+                                                         simple_value=np.mean(rewards['qa_gold']))])
+                        summary_writer.add_summary(qa_gold_summary, global_step=(i))
                         disc_summary = tf.Summary(value=[tf.Summary.Value(tag="rl_rewards/disc",
                                                          simple_value=np.mean(disc_scores))])
                         summary_writer.add_summary(disc_summary, global_step=(i))
@@ -271,7 +262,7 @@ def main(_):
                         summary_writer.add_summary(disc_white_summary, global_step=(i))
 
                         # Build a combined batch - half ground truth for MLE, half generated for PG
-                        train_batch_ext = duplicate_batch_and_inject(train_batch, qhat_ids, qhat_str, qhat_lens)
+                        train_batch_ext = preprocessing.duplicate_batch_and_inject(train_batch, qhat_ids, qhat_str, qhat_lens)
 
                         # print(qhat_ids)
                         # print(qhat_lens)
@@ -294,9 +285,11 @@ def main(_):
                         else:
                             res_offset=0
                         ops.extend([model.lm_loss, model.qa_loss])
+                        update_start = time.time()
                         res= sess.run(ops, feed_dict={model.input_batch: train_batch_ext,
                             model.is_training:False,
                             **rl_dict})
+                        update_time = time.time()-update_start
                         summary_writer.add_summary(res[1], global_step=(i))
 
                         # Log only the first half of the PG related losses
@@ -312,9 +305,20 @@ def main(_):
                         ixs = np.round(np.random.binomial(1,0.5,curr_batch_size))
                         qbatch = [pred_str[ix].replace(" </Sent>","").replace(" <PAD>","") if ixs[ix] < 0.5 else gold_q_str[ix].replace(" </Sent>","").replace(" <PAD>","") for ix in range(curr_batch_size)]
 
-                        loss = discriminator.train_step(unfilt_ctxt_batch, qbatch, ans_text_batch, ans_pos_batch, ixs, step=(i) )
+                        # goes through the scorer, so it can't run at the same time as the disc is scoring another batch
+                        loss = reward_scorer.train_discriminator(unfilt_ctxt_batch, qbatch, ans_text_batch, ans_pos_batch, ixs, step=(i) )
+
+                    # reward_wait is how long the update sat idle waiting for a sample and its rewards - ideally ~0
+                    for stage, stage_time in [('generate', gen_time), ('rewards', reward_time), ('reward_wait', reward_wait_time), ('update', update_time)]:
+                        summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="pg_timing/"+stage, simple_value=stage_time)]), global_step=(i))
+                    # how many updates behind the policy that sampled this batch is - a count, not a time
+                    summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="pg/staleness", simple_value=pg_num_updates-updates_at_sample)]), global_step=(i))
+                    pg_num_updates += 1
 
                 else:
+                    # Get a batch
+                    train_batch, curr_batch_size = train_data_source.get_batch()
+
                     # Normal single pass update step. If model has PG capability, fill in the placeholders with empty values
                     if FLAGS.model_type[:7] == "MALUUBA" and not FLAGS.policy_gradient:
                         rl_dict={model.lm_score: [0 for b in range(curr_batch_size)],
@@ -361,14 +365,21 @@ def main(_):
                     summary_writer.add_summary(f1summary, global_step=(i))
                     summary_writer.add_summary(bleusummary, global_step=(i))
 
+                    # How much of each batch was real tokens rather than padding, since the last report
+                    ctxt_pad_eff, q_pad_eff = train_data_source.get_padding_efficiency()
+                    train_data_source.reset_padding_stats()
+                    summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="input/context_padding_efficiency",
+                                                     simple_value=ctxt_pad_eff)]), global_step=(i))
+                    summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag="input/question_padding_efficiency",
+                                                     simple_value=q_pad_eff)]), global_step=(i))
+
                     # Evaluate against dev set
                     f1s=[]
                     bleus=[]
                     nlls=[]
 
-                    np.random.shuffle(dev_data)
-                    dev_subset = dev_data[:num_dev_samples]
-                    dev_data_source.initialise(dev_subset)
+                    # a new random subset each time, but the feature cache covers all of dev_data so only gets built once
+                    dev_data_source.initialise(dev_data, num_samples=num_dev_samples)
                     for j in tqdm(range(num_steps_dev), desc='Eval '+str(i)):
                         dev_batch, curr_batch_size = dev_data_source.get_batch()
                         pred_batch,pred_ids,pred_lens,gold_batch, gold_lens,ctxt,ctxt_len,ans,ans_len,nll= sess.run([model.q_hat_beam_string, model.q_hat_beam_ids,model.q_hat_beam_lens,model.question_raw, model.question_length, model.context_raw, model.context_length, model.answer_locs, model.answer_length, model.nll], feed_dict={model.input_batch: dev_batch ,model.is_training:False})
@@ -410,6 +421,7 @@ def main(_):
                             saver.save(sess, chkpt_path+'/model.checkpoint', global_step=i)
                         if FLAGS.disc_train:
                             print("Saving disc")
-                            discriminator.save_to_chkpt(FLAGS.model_dir, i)
+                            # the disc may still be scoring a batch in the background
+                            reward_scorer.save_discriminator(FLAGS.model_dir, i)
 if __name__ == '__main__':
     tf.app.run()
@@ -34,8 +34,7 @@ def main(_):
     _, dev_qs, _,_ = zip(*dev_data)
     vocab = loader.get_vocab(train_qs, tf.app.flags.FLAGS.lm_vocab_size)
 
-    with open(chkpt_path+'/vocab.json', 'w') as outfile:
-        json.dump(vocab, outfile)
+    loader.save_vocab(vocab, chkpt_path)
 
     unique_sents = list(set(train_qs))
     print(len(unique_sents)," unique sentences")
@@ -69,9 +68,7 @@ def main(_):
             for i in tqdm(range(num_steps), desc='Epoch '+str(e)):
                 seq_batch = unique_sents[i*FLAGS.batch_size:(i+1)*FLAGS.batch_size]
 
-                seq_batch_ids = [[vocab[loader.SOS]]+[vocab[tok if tok in vocab.keys() else loader.OOV] for tok in tokenise(sent, asbytes=False)]+[vocab[loader.EOS]] for sent in seq_batch]
-                max_seq_len = max([len(seq) for seq in seq_batch_ids])
-                padded_batch = np.asarray([seq + [vocab[loader.PAD] for i in range(max_seq_len-len(seq))] for seq in seq_batch_ids])
+                padded_batch, _ = vocab.encode_batch([tokenise(sent, asbytes=False) for sent in seq_batch], add_sos_eos=True)
 
                 summ, _, pred, gold, seq = sess.run([model.train_summary, model.optimise, model.preds, model.tgt_output, model.input_seqs], feed_dict={model.input_seqs: padded_batch})
                 summary_writer.add_summary(summ, global_step=(e*num_steps+i))
@@ -87,9 +84,7 @@ def main(_):
             num_steps_dev = len(dev_qs)//FLAGS.batch_size
             for i in tqdm(range(num_steps_dev), desc="Eval"):
                 seq_batch = dev_qs[i*FLAGS.batch_size:(i+1)*FLAGS.batch_size]
-                seq_batch_ids = [[vocab[loader.SOS]]+[vocab[tok if tok in vocab.keys() else loader.OOV] for tok in tokenise(sent, asbytes=False)]+[vocab[loader.EOS]] for sent in seq_batch]
-                max_seq_len = max([len(seq) for seq in seq_batch_ids])
-                padded_batch = np.asarray([seq + [vocab[loader.PAD] for i in range(max_seq_len-len(seq))] for seq in seq_batch_ids])
+                padded_batch, _ = vocab.encode_batch([tokenise(sent, asbytes=False) for sent in seq_batch], add_sos_eos=True)
 
                 perp = sess.run(model.perplexity, feed_dict={model.input_seqs: padded_batch})
                 perps.extend(perp)
@@ -17,9 +17,7 @@ from helpers.metrics import f1, normalize_answer
 
 
 def get_padded_batch(seq_batch, vocab):
-    seq_batch_ids = [[vocab[loader.SOS]]+[vocab[tok if tok in vocab.keys() else loader.OOV] for tok in tokenise(sent, asbytes=False)]+[vocab[loader.EOS]] for sent in seq_batch]
-    max_seq_len = max([len(seq) for seq in seq_batch_ids])
-    padded_batch = np.asarray([seq + [vocab[loader.PAD] for i in range(max_seq_len-len(seq))] for seq in seq_batch_ids])
+    padded_batch, _ = vocab.encode_batch([tokenise(sent, asbytes=False) for sent in seq_batch], add_sos_eos=True)
     return padded_batch
 
 FLAGS = tf.app.flags.FLAGS
@@ -57,12 +55,10 @@ def main(_):
     dev_contexts, dev_qs, dev_as,dev_a_pos = zip(*dev_data)
 
     if FLAGS.restore:
-        with open(restore_path+'/vocab.json') as f:
-            vocab = json.load(f)
+        vocab = loader.load_vocab(restore_path)
     else:
         vocab = loader.get_vocab(train_contexts+train_qs, tf.app.flags.FLAGS.qa_vocab_size)
-        with open(chkpt_path+'/vocab.json', 'w') as outfile:
-            json.dump(vocab, outfile)
+        loader.save_vocab(vocab, chkpt_path)
 
 
 